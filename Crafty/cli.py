@@ -6,14 +6,11 @@ import json
 grandparent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, grandparent_dir)
 
-from Crafty.pipeline.chapters import Chapters
-from Crafty.pipeline.notes import Notes
-from Crafty.pipeline.script import Script
-from Crafty.pipeline.sections import Sections
-from Crafty.pipeline.slides import Slides
-from Crafty.pipeline.topic import Topic
-from Crafty.pipeline.video import Video
-from Crafty.pipeline.voice import Voice
+from Crafty.config import Config
+from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.steps import load_step
+from Crafty.pipeline.chapter_pipeline import ChapterPipeline
+from Crafty.pipeline.utils.trace import Tracer
 
 CONFIG_FILE = "config.json"
 
@@ -56,9 +53,15 @@ def cli():
 @click.option('--craft_notes', is_flag=True, help='Generate content based on uploaded file by users.', required=False, default=False)
 @click.option('--file_name', type=str, help='The name of the file used when craft_notes is True.', required=False)
 @click.option('--language', type=str, help='The language of the content.', required=False, default='en')
+@click.option('--force', is_flag=True, help='Rebuild every step even if its outputs are up to date.', required=False, default=False)
+@click.option('--structured_output', is_flag=True, help='Declare the JSON shape of topic, chapter and section responses to the model.', required=False, default=False)
+@click.option('--llm_dedup', is_flag=True, help='De-duplicate the sections with the model instead of locally.', required=False, default=False)
+@click.option('--section_slides', is_flag=True, help='Generate the slides of each section concurrently and stitch them together.', required=False, default=False)
+@click.option('--stream', is_flag=True, help='Voice and encode each slide as soon as its script is ready, instead of step by step.', required=False, default=False)
+@click.option('--pipeline_depth', type=int, help='The number of chapters in flight at once, each one at its own step.', required=False)
 
 def create(topic, llm_source, temperature, creative_temperature, slides_template_file, slides_style, content_slide_pages, parallel_processing, advanced_model, sections_per_chapter, max_note_expansion_words, short_video, \
-           craft_notes, file_name, language):
+           craft_notes, file_name, language, force, structured_output, llm_dedup, section_slides, stream, pipeline_depth):
     if content_slide_pages is None:
         content_slide_pages = 2 if short_video else 30
     if sections_per_chapter < 5:
@@ -86,69 +89,110 @@ def create(topic, llm_source, temperature, creative_temperature, slides_template
         'craft_notes': craft_notes,
         'file_name': file_name,
         'chunk_size': 2000,
+
+        'force': force,
+        'structured_output': structured_output,
+        'llm_dedup': llm_dedup,
+        'section_slides': section_slides,
     }
-    topic_step = Topic(para)
-    click.secho(f'Start generating topic {topic}... Course ID: {topic_step.course_id}', fg='green')
-    topic_step.execute()
+    # All the steps of the course are driven by one event loop, which their model clients, semaphores
+    # and rate limiters are shared on.
+    pipeline = PipelineStep.run_sync(create_course(para, short_video, stream, pipeline_depth))
+    click.secho('All steps are done.', fg='green')
+    click.echo(Tracer.get().summary_table())
+    click.echo(pipeline.report())
+    from Crafty.pipeline.science.prompt_registry import PromptRegistry
+    click.echo(PromptRegistry.report())
+    from Crafty.pipeline.science.api_handler import coalescing_report
+    click.echo(coalescing_report())
+    click.echo(f"Trace written to {Config.OUTPUT_DIR + para['course_id'] + '/' + Config.TRACE_FILE}")
+
+
+async def create_course(para, short_video, stream=False, pipeline_depth=None):
+    """
+    Run every step of a course on the running event loop, the chapters through a ChapterPipeline.
+
+    :param stream: Stream the scripts, voices and video of each chapter slide by slide, see ChapterStream.
+    :param pipeline_depth: Chapters in flight at once, Config.PIPELINE_DEPTH by default.
+    :return: The ChapterPipeline of the chapters.
+    """
+    topic_step = load_step('topic')(para)
+    click.secho(f'Start generating topic {para["topic"]}... Course ID: {topic_step.course_id}', fg='green')
+    await topic_step.run_async()
     para['course_id'] = topic_step.course_id
     click.secho(f'Start generating chapters...', fg='green')
-    Chapters(para).execute()
+    await load_step('chapter')(para).run_async()
     click.secho(f'Start generating sections...', fg='green')
-    section = Sections(para)
-    section.execute()
+    section = load_step('section')(para)
+    await section.run_async()
     click.secho(f'Start generating chapters, slides, scripts, voices, videos by chapter...', fg='green')
     
     if(short_video == True):
         chapters_num = 1
     else:
+        # The section step may have been skipped, so read the chapter list from its output.
+        section.read_meta_data_from_file()
         chapters_num = len(section.chapters_list)
         
-    for i in range(chapters_num):
-        # TODO need to implement parallel processing
-        para['chapter'] = i
-        click.secho(f'Start generating notes for chapter {i}...', fg='green')
-        Notes(para).execute()
-        click.secho(f'Start generating slides for chapter {i}...', fg='green')
-        Slides(para).execute()
-        click.secho(f'Start generating scripts for chapter {i}...', fg='green')
-        Script(para).execute()
-        click.secho(f'Start generating voice for chapter {i}...', fg='green')
-        Voice(para).execute()
-        click.secho(f'Start generating video for chapter {i}...', fg='green')
-        Video(para).execute()
-    click.secho('All steps are done.', fg='green')
+    pipeline = ChapterPipeline(para, range(chapters_num), depth=pipeline_depth, stream=stream)
+    await pipeline.run()
+    return pipeline
 
 
-@click.command()
-@click.argument('step', type=click.Choice(['chapter', 'section', 'note', 'slide', 'script', 'voice', 'video']))
-@click.option('--topic', help='The learning topic to create items for.', required=False)
-@click.option('--course_id', help='The unique ID of the course.', required=False)
-@click.option('--llm_source', type=str, help='The source of LLM.', required=False, default='openai')
-@click.option('--temperature', type=float, help='The temperature for the basic and advanced model.', required=False, default=0)
-@click.option('--creative_temperature', type=float, help='The temperature for the creative model.', required=False, default=0.5)
-@click.option('--slides_template_file', type=str, help='The template file for the slides.', required=False)
-@click.option('--slides_style', type=str, help='Only use it if template file is not provided.', required=False, default='simple')
-@click.option('--content_slide_pages', type=int, help='The number of pages for content slides.', required=False)
-@click.option('--advanced_model', is_flag=True, help='Use the advanced model for note expansion.', required=False, default=False)
-@click.option('--sections_per_chapter', type=int, help='The number of sections per chapter.', required=False, default=10)
-@click.option('--max_note_expansion_words', type=int, help='The maximum number of words for note expansion.', required=False, default=200)
-@click.option('--chapter', type=int, help='Only generate output for one chapter.', required=False, default=-1)
-@click.option('--short_video', is_flag=True, help='Generate short videos instead of full-length videos.', required=False, default=False)
-@click.option('--craft_notes', is_flag=True, help='Generate content based on uploaded file by users.', required=False, default=False)
-@click.option('--file_name', type=str, help='The name of the file used when craft_notes is True.', required=False)
-@click.option('--language', type=str, help='The language of the content.', required=False, default='en')
+def chapter_number(ctx, param, value):
+    """
+    Parse the --chapter option: a chapter number, or 'all' for the notes of every chapter.
+    """
+    if value == 'all':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise click.BadParameter(f"'{value}' is neither a chapter number nor 'all'.")
 
-def step(step, topic, course_id, llm_source, temperature, creative_temperature, slides_template_file, slides_style, content_slide_pages, advanced_model, sections_per_chapter, max_note_expansion_words, chapter, short_video, \
-         craft_notes, file_name, language):
-    if short_video:
-        click.echo("Running Crafty with the short video mode.")
-    else:
-        click.echo("Running Crafty with the long video mode.")
+
+def step_options(func):
+    """
+    Apply the options shared by the `step` and `submit` commands.
+    """
+    options = [
+        click.argument('step', type=click.Choice(['chapter', 'section', 'note', 'slide', 'script', 'voice', 'video'])),
+        click.option('--topic', help='The learning topic to create items for.', required=False),
+        click.option('--course_id', help='The unique ID of the course.', required=False),
+        click.option('--llm_source', type=str, help='The source of LLM.', required=False, default='openai'),
+        click.option('--temperature', type=float, help='The temperature for the basic and advanced model.', required=False, default=0),
+        click.option('--creative_temperature', type=float, help='The temperature for the creative model.', required=False, default=0.5),
+        click.option('--slides_template_file', type=str, help='The template file for the slides.', required=False),
+        click.option('--slides_style', type=str, help='Only use it if template file is not provided.', required=False, default='simple'),
+        click.option('--content_slide_pages', type=int, help='The number of pages for content slides.', required=False),
+        click.option('--advanced_model', is_flag=True, help='Use the advanced model for note expansion.', required=False, default=False),
+        click.option('--sections_per_chapter', type=int, help='The number of sections per chapter.', required=False, default=10),
+        click.option('--max_note_expansion_words', type=int, help='The maximum number of words for note expansion.', required=False, default=200),
+        click.option('--chapter', callback=chapter_number, help='Only generate output for one chapter, or all of them with `note --chapter all`.', required=False, default='-1'),
+        click.option('--short_video', is_flag=True, help='Generate short videos instead of full-length videos.', required=False, default=False),
+        click.option('--craft_notes', is_flag=True, help='Generate content based on uploaded file by users.', required=False, default=False),
+        click.option('--file_name', type=str, help='The name of the file used when craft_notes is True.', required=False),
+        click.option('--language', type=str, help='The language of the content.', required=False, default='en'),
+        click.option('--force', is_flag=True, help='Rebuild the step even if its outputs are up to date.', required=False, default=False),
+        click.option('--structured_output', is_flag=True, help='Declare the JSON shape of topic, chapter and section responses to the model.', required=False, default=False),
+        click.option('--llm_dedup', is_flag=True, help='De-duplicate the sections with the model instead of locally.', required=False, default=False),
+        click.option('--section_slides', is_flag=True, help='Generate the slides of each section concurrently and stitch them together.', required=False, default=False),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def step_para(topic, course_id, llm_source, temperature, creative_temperature, slides_template_file, slides_style, content_slide_pages, advanced_model, sections_per_chapter, max_note_expansion_words, chapter, short_video, \
+              craft_notes, file_name, language, force, structured_output, llm_dedup, section_slides):
+    """
+    Build the step parameters from the command line options. Returns None if the options are invalid.
+    """
     if content_slide_pages is None:
         content_slide_pages = 2 if short_video else 30
     if sections_per_chapter < 5:
         click.echo('Error: sections_per_chapter should be greater or equal to 5.', err=True)
-        return
+        return None
     if slides_template_file is None:
         slides_template_file = '-3' if short_video else '3'
     if(isinstance(file_name, str)):
@@ -172,111 +216,250 @@ def step(step, topic, course_id, llm_source, temperature, creative_temperature,
         'craft_notes': craft_notes,
         'file_name': file_name,
         'chunk_size': 2000,
-    }
-    chapter_hint = f' --chapter {para["chapter"]}' if para['chapter'] != -1 else (' --chapter 0' if short_video else '')
-    short_video_hint = ' --short_video' if short_video else ''
 
+        'force': force,
+        'structured_output': structured_output,
+        'llm_dedup': llm_dedup,
+        'section_slides': section_slides,
+    }
     if course_id is not None:
         para['course_id'] = course_id
+    return para
+
+
+def run_step(step, para):
+    """
+    Execute a single step with the given parameters.
+
+    :raises click.UsageError: If the parameters do not fit the step, so that a queued job fails.
+    """
+    topic = para['topic']
+    short_video = para['short_video']
+    if short_video:
+        click.echo("Running Crafty with the short video mode.")
+    else:
+        click.echo("Running Crafty with the long video mode.")
+    chapter_hint = f' --chapter {para["chapter"]}' if para['chapter'] != -1 else (' --chapter 0' if short_video else '')
+    if para['chapter'] == 'all':
+        if step != 'note' or short_video:
+            raise click.UsageError('--chapter all is only supported by the note step of a full-length course.')
+        chapter_hint = ' --chapter 0'
+    short_video_hint = ' --short_video' if short_video else ''
 
     if step == 'chapter':
         if short_video:
-            click.echo('Error: Chapter step is not required for short video. Please start with note step with: ')
-            click.secho(f'python Crafty/cli.py step note --short_video --topic {topic} --max_note_expansion_words 200', fg='green')
+            raise click.UsageError('Chapter step is not required for short video. Please start with note step with: '
+                                   f'python Crafty/cli.py step note --short_video --topic {topic} --max_note_expansion_words 200')
         elif topic is not None:
             para['topic'] = topic
-            topic_step = Topic(para)
+            topic_step = load_step('topic')(para)
             para['course_id'] = topic_step.course_id
             click.echo(f'Start generating topic {topic}... Course ID: {para["course_id"]}')
-            topic_step.execute()
-            chapter_step = Chapters(para)
+            topic_step.run()
+            chapter_step = load_step('chapter')(para)
             click.echo(f'Start generating chapters for Course ID: {para["course_id"]}...')
-            chapter_step.execute()
+            chapter_step.run()
             click.echo('Chapters are generated, please review the file and run next step with:')
             click.secho(f'python Crafty/cli.py step section --course_id {para["course_id"]} --sections_per_chapter 10', fg='green')
         else:
-            click.echo('Error: Please provide a topic.')
+            raise click.UsageError('Please provide a topic.')
     elif step == 'section':
         if short_video:
-            click.echo('Error: Section step is not required for short video. Please start with note step.')
+            raise click.UsageError('Section step is not required for short video. Please start with note step.')
         elif 'course_id' in para:
             click.echo(f'Generating sections for chapters with course_id {para["course_id"]}...')
-            section_step = Sections(para)
-            section_step.execute()
+            section_step = load_step('section')(para)
+            section_step.run()
             click.echo('Section are generated, please review the file and run next step with:')
             click.secho(f'python Crafty/cli.py step note --course_id {para["course_id"]} --max_note_expansion_words 200 --chapter 0', fg='green')
         else:
-            click.echo('Error: Please provide a course_id.')
+            raise click.UsageError('Please provide a course_id.')
     elif step == 'note':
         if short_video:
-            if 'topic' in para:
+            if topic is not None:
                 para['topic'] = topic
-                topic_step = Topic(para)
+                topic_step = load_step('topic')(para)
                 para['course_id'] = topic_step.course_id
                 click.echo(f'Start generating topic {topic}... Course ID: {para["course_id"]}')
-                topic_step.execute()
+                topic_step.run()
                 click.echo(f'Generating notes for short video...')
                 if para['advanced_model']:
                     para['llm'] = para['llm_advance']
-                notes_step = Notes(para)
-                notes_step.execute()
+                notes_step = load_step('note')(para)
+                notes_step.run()
                 click.echo('Notes file are generated, please review the files and run next step with:')
                 click.secho(
                     f'python Crafty/cli.py step slide --course_id {para["course_id"]} --slides_template_file 3 --content_slide_pages 30 --short_video' + chapter_hint,
                     fg='green')
             else:
-                click.echo('Error: Please provide required parameter topic for short video.')
+                raise click.UsageError('Please provide required parameter topic for short video.')
         elif 'course_id' in para and 'chapter' in para:
             click.echo(f'Generating notes for sections with course_id {para["course_id"]}...')
             if para['advanced_model']:
                 para['llm'] = para['llm_advance']
-            notes_step = Notes(para)
-            notes_step.execute()
+            notes_step = load_step('note')(para)
+            notes_step.run()
             click.echo('Notes file are generated, please review the files and run next step with:')
             click.secho(f'python Crafty/cli.py step slide --course_id {para["course_id"]} --slides_template_file 3 --content_slide_pages 30' + chapter_hint, fg='green')
         else:
-            click.echo('Error: Please provide required parameter course_id, chapter.')
+            raise click.UsageError('Please provide required parameter course_id, chapter.')
     elif step == 'slide':
         if 'course_id' in para and 'chapter' in para:
             click.echo(f'Creating slides for notes with course_id {para["course_id"]}...')
-            slides_step = Slides(para)
-            slides_step.execute()
+            slides_step = load_step('slide')(para)
+            slides_step.run()
             click.echo('Slides files are generated, please review the files and run next step with:')
             click.secho(f'python Crafty/cli.py step script --course_id {para["course_id"]}' + chapter_hint + short_video_hint, fg='green')
         else:
-            click.echo('Error: Please provide required parameter course_id, chapter.')
+            raise click.UsageError('Please provide required parameter course_id, chapter.')
     elif step == 'script':
         if 'course_id' in para and 'chapter' in para:
             click.echo(f'Creating scripts for notes with course_id {para["course_id"]}...')
-            script_step = Script(para)
-            script_step.execute()
+            script_step = load_step('script')(para)
+            script_step.run()
             click.echo('Script files are generated, please review the files and run next step with:')
             click.secho(f'python Crafty/cli.py step voice --course_id {para["course_id"]}' + chapter_hint + short_video_hint, fg='green')
         else:
-            click.echo('Error: Please provide required parameter course_id, chapter.')
+            raise click.UsageError('Please provide required parameter course_id, chapter.')
     elif step == 'voice':
         if 'course_id' in para and 'chapter' in para:
             click.echo(f'Generating voice for notes with course_id {para["course_id"]}...')
-            voice_step = Voice(para)
-            voice_step.execute()
+            voice_step = load_step('voice')(para)
+            voice_step.run()
             click.echo('Voice files are generated, please review the files and run next step with:')
             click.secho(f'python Crafty/cli.py step video --course_id {para["course_id"]}' + chapter_hint + short_video_hint, fg='green')
         else:
-            click.echo('Error: Please provide required parameter course_id, chapter.')
+            raise click.UsageError('Please provide required parameter course_id, chapter.')
     elif step == 'video':
         if 'course_id' in para and 'chapter' in para:
             click.echo(f'Generating video for notes with course_id {para["course_id"]}...')
-            video_step = Video(para)
-            video_step.execute()
+            video_step = load_step('video')(para)
+            video_step.run()
             click.echo('Video files are generated, this is the final step.')
         else:
-            click.echo('Error: Please provide required parameter course_id, chapter.')
+            raise click.UsageError('Please provide required parameter course_id, chapter.')
     else:
-        click.echo('Error: Invalid step type.')
+        raise click.UsageError('Invalid step type.')
+
+
+@click.command()
+@step_options
+def step(step, **options):
+    para = step_para(**options)
+    if para is not None:
+        run_step(step, para)
+
+
+@click.command()
+@step_options
+@click.option('--queue', 'queue_path', type=str, help='The job queue file.', required=False, default=Config.JOB_QUEUE)
+def submit(step, queue_path, **options):
+    from Crafty.pipeline.utils.jobs import JobQueue
+    para = step_para(**options)
+    if para is None:
+        return
+    job_id = JobQueue(queue_path).submit(step, para)
+    click.echo(f'Job {job_id} for step {step} is submitted to {queue_path}.')
+
+
+@click.command()
+@click.option('--queue', 'queue_path', type=str, help='The job queue file.', required=False, default=Config.JOB_QUEUE)
+@click.option('--poll_interval', type=float, help='Seconds to wait before polling an empty queue again.', required=False, default=2.0)
+@click.option('--max_jobs', type=int, help='Exit after processing this number of jobs.', required=False)
+@click.option('--exit_when_empty', is_flag=True, help='Exit when the queue is empty instead of waiting for new jobs.', required=False, default=False)
+def worker(queue_path, poll_interval, max_jobs, exit_when_empty):
+    from Crafty.pipeline.worker import Worker
+    Worker(queue_path, run_step, poll_interval=poll_interval).run(max_jobs=max_jobs, exit_when_empty=exit_when_empty)
+
+
+@click.command('compare-dedup')
+@click.option('--course_id', help='The unique ID of a course whose sections were generated.', required=True)
+@click.option('--llm_source', type=str, help='The source of LLM.', required=False, default='openai')
+@click.option('--language', type=str, help='The language of the content.', required=False, default='en')
+@click.option('--short_video', is_flag=True, help='The course was generated in the short video mode.', required=False, default=False)
+def compare_dedup(course_id, llm_source, language, short_video):
+    """
+    Compare the local and the model de-duplication of the sections of a course.
+    """
+    para = {
+        'topic': None,
+        'course_id': course_id,
+        'llm_source': llm_source,
+        'temperature': 0,
+        'creative_temperature': 0.5,
+        'sections_per_chapter': 10,
+        'short_video': short_video,
+        'language': language,
+        'craft_notes': False,
+        'file_name': None,
+    }
+    results = load_step('section')(para).compare_dedup()
+    click.echo(f"{'method':<8}{'seconds':>10}{'cost $':>9}{'sections':>10}{'agreement':>11}")
+    for method, result in results.items():
+        click.echo(f"{method:<8}{result['seconds']:>10.2f}{result['cost_usd']:>9.4f}{result['sections']:>10}{result['agreement']:>11.2f}")
+    click.echo('Agreement is the mean per chapter Jaccard index of the section names, with the model result as reference.')
+
+
+@click.command('routing-report')
+@click.option('--outputs_dir', type=str, help='The directory holding the course outputs.', required=False, default=Config.OUTPUT_DIR)
+def routing_report(outputs_dir):
+    """
+    Escalation rates of the routed model tasks, over the traces of every course.
+    """
+    import glob
+    from Crafty.pipeline.science.model_router import ModelRouter
+    tasks = ModelRouter.report(glob.glob(os.path.join(outputs_dir, '*', Config.TRACE_FILE)))
+    if not tasks:
+        click.echo('No routed calls found in the traces.')
+        return
+    click.echo(f"{'task':<16}{'calls':>7}{'escalated':>11}{'rate':>7}{'invalid':>9}  served by")
+    for task, row in sorted(tasks.items()):
+        served = ', '.join(f'{tier} {calls}' for tier, calls in row['served'].items())
+        click.echo(f"{task:<16}{row['calls']:>7}{row['escalations']:>11}{row['escalations'] / row['calls']:>7.2f}"
+                   f"{row['invalid']:>9}  {served}")
+
+
+@click.command('bench-headings')
+@click.option('--pages', type=int, help='The number of pages of the generated book.', required=False, default=1000)
+@click.option('--workers', type=int, help='The processes of the pool, the number of CPUs by default.', required=False)
+@click.option('--file', 'path', type=str, help='A PDF to read instead of a generated book.', required=False)
+def bench_headings(pages, workers, path):
+    """
+    Time the heading detection of a book read in one process and by a process pool.
+    """
+    import tempfile
+    import time
+    from Crafty.pipeline.science.doc_handler import DocHandler
+    from Crafty.pipeline.utils.headings import HeadingsUtil
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        expected = None
+        if path is None:
+            path = os.path.join(tmp_dir, 'book.pdf')
+            expected = HeadingsUtil.sample_book(path, pages)
+        else:
+            import fitz
+            with fitz.open(path) as document:
+                pages = document.page_count
+        click.echo(f"{'mode':<8}{'workers':>8}{'seconds':>9}{'pages/s':>9}{'chapters':>10}{'sections':>10}")
+        for mode, count in (('serial', 1), ('pool', workers)):
+            start = time.perf_counter()
+            toc = HeadingsUtil.find_toc(path, workers=count)
+            seconds = time.perf_counter() - start
+            outline = DocHandler.outline_from_toc(toc, pages) or []
+            sections = sum(len(chapter['sections']) for chapter in outline)
+            click.echo(f"{mode:<8}{count:>8}{seconds:>9.2f}{pages / seconds:>9.0f}{len(outline):>10}{sections:>10}")
+        if expected is not None:
+            click.echo(f"The headings {'match' if toc == expected else 'do not match'} those of the generated book.")
 
 
 cli.add_command(create)
 cli.add_command(step)
+cli.add_command(submit)
+cli.add_command(worker)
+cli.add_command(compare_dedup)
+cli.add_command(routing_report)
+cli.add_command(bench_headings)
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -8,7 +8,77 @@ class Config:
     FINAL_DIR = "/final/"
     META_AND_CHAPTERS = "meta_and_chapters.json"
     RAW_SECTIONS_IN_CHAPTER = "raw_sections_in_chapters.json"
+    RAW_SECTIONS_PARTIAL = "raw_sections_in_chapters.partial.json"
     CHAPTERS_AND_SECTIONS = "chapters_and_sections.json"
+    MANIFEST = "manifest.json"
+    TRACE_FILE = "traces.jsonl"
+    JOB_QUEUE = "outputs/jobs.sqlite3"
+    # Seconds a claimed job stays leased to its worker, renewed by the worker while the job runs. A job whose
+    # lease expired, because its worker crashed or was killed, is claimed again by another worker.
+    JOB_LEASE = 60
+    # Calls per item in structured output mode before giving up on a response which does not validate
+    STRUCTURED_OUTPUT_ATTEMPTS = 3
+    # Seconds to wait before retrying the chapters whose sections failed, doubled on every retry
+    SECTIONS_RETRY_BACKOFF = 1.0
+    # Deadline in seconds of every model call of a step, and whether a duplicate of a call still running
+    # after the p95 latency of its prompt is sent (see RequestPolicy). Steps without a budget use the default.
+    REQUEST_BUDGETS = {
+        'default': {'deadline': 300, 'hedge': False},
+        'sections': {'deadline': 120, 'hedge': True},
+        'notes': {'deadline': 180, 'hedge': True},
+        'script': {'deadline': 120, 'hedge': True},
+        'slides': {'deadline': 600, 'hedge': False},
+    }
+    # Number of recent latencies per prompt the hedging delay is computed from
+    REQUEST_LATENCY_WINDOW = 200
+    # Tokens kept free for the response when checking that a prompt fits the context window of a model
+    OUTPUT_TOKEN_RESERVE = 4096
+    # Model tiers tried in order for a task, the next one only if the call fails or its result does not
+    # validate. Tasks without a route use the tier of their step. Tune from `python Crafty/cli.py routing-report`.
+    MODEL_ROUTES = {
+        'chapters': ('basic', 'advance'),
+        'sections': ('basic', 'advance'),
+        'slides_draft': ('advance',),
+        'slides_combine': ('advance',),
+        'slides_refine': ('advance',),
+        'slides_fix': ('advance',),
+        'slides_skeleton': ('advance',),
+    }
+    # Rounds of each frame patch pass of the slides, a pass ends early once a round changes nothing. Every
+    # round sends the notes and the whole numbered deck again, so more than one adds to the prompt tokens.
+    SLIDES_PATCH_ROUNDS = 1
+    # Compilations of the slides, the frames failing one are sent to the model before the next one
+    SLIDES_COMPILE_ATTEMPTS = 2
+    # Slides worked on at once by each stage of `create --stream`, and finished slides a stage may hand on
+    # before it waits for the next stage to take them
+    STREAM_CONCURRENCY = {'script': 8, 'voice': 4, 'video': 2}
+    STREAM_QUEUE_SIZE = 4
+    # Chapters of `create` in flight at once, each one at its own step (see ChapterPipeline), and the steps
+    # run at once on each class of resource: model calls, text to speech, video encoding and streams
+    PIPELINE_DEPTH = 1
+    PIPELINE_WORKERS = {'llm': 2, 'tts': 1, 'cpu': 1, 'media': 1}
+    # Section notes requested at once by `step note --chapter all`, across the chapters of the course
+    NOTES_BATCH_CONCURRENCY = 16
+    # Number of chapters the outline (bookmarks) of an uploaded PDF must have to be used as the chapters
+    # and sections of the course instead of asking the model
+    OUTLINE_CHAPTERS = (3, 40)
+    # Pages of a PDF without an outline read by each task of the heading detection (see HeadingsUtil), points
+    # above the body text size from which a line is a heading, and the longest heading in characters
+    HEADING_PAGES_PER_TASK = 50
+    HEADING_MIN_SIZE_GAP = 1.0
+    HEADING_MAX_CHARS = 120
+    # Sections whose TF-IDF similarity to an earlier section reaches this are dropped as duplicates
+    SECTION_DEDUP_THRESHOLD = 0.7
+    # USD per million tokens: (prompt, cached prompt, completion)
+    MODEL_PRICES = {
+        'gpt-3.5-turbo': (0.5, 0.5, 1.5),
+        'gpt-4o': (5.0, 2.5, 15.0),
+    }
+    # USD per million characters of text to speech
+    TTS_PRICES = {
+        'tts-1': 15.0,
+        'tts-1-hd': 30.0,
+    }
 
 
 class Constants:
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import click
+
+from Crafty.config import Config
+from Crafty.pipeline.steps import load_step
+from Crafty.pipeline.streaming import ChapterStream
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class ChapterPipeline:
+    """
+    Chapters of a course run through their steps as a software pipeline: up to depth chapters are in
+    flight at once, each one at its own step, so that the notes of a chapter are written while the
+    slides of the one before are made and the video of the one before that is encoded.
+
+    Every step holds a worker of the resource class it mostly waits on, whose count is set in
+    Config.PIPELINE_WORKERS: model calls (llm), text to speech (tts) and video encoding (cpu). A stream
+    of scripts, voices and video (see ChapterStream) uses all three and holds a worker of its own class.
+    With a depth of 1 the chapters run one after the other, as they did before.
+    """
+
+    # Resource class each step mostly waits on.
+    RESOURCES = {'note': 'llm', 'slide': 'llm', 'script': 'llm', 'voice': 'tts', 'video': 'cpu', 'stream': 'media'}
+
+    def __init__(self, para, chapters, depth=None, stream=False):
+        """
+        :param para: Parameters of the course, the chapter is set for each one.
+        :param chapters: Numbers of the chapters to build.
+        :param depth: Chapters in flight at once, Config.PIPELINE_DEPTH by default.
+        :param stream: Stream the scripts, voices and video of each chapter.
+        """
+        self.para = para
+        self.chapters = list(chapters)
+        self.depth = depth if depth is not None else Config.PIPELINE_DEPTH
+        self.stream = stream
+        self.workers = dict(Config.PIPELINE_WORKERS)
+        # Seconds each resource class spent running steps, summed over its workers.
+        self.busy = {resource: 0.0 for resource in self.workers}
+        self.wall = 0.0
+
+    def stages(self):
+        return ['note', 'slide', 'stream'] if self.stream else ['note', 'slide', 'script', 'voice', 'video']
+
+    async def run(self):
+        workers = {resource: asyncio.Semaphore(count) for resource, count in self.workers.items()}
+        # Chapters are admitted in order, so an earlier chapter never waits for a later one to start.
+        in_flight = asyncio.Semaphore(max(1, self.depth))
+        start = time.perf_counter()
+
+        async def chapter(i):
+            async with in_flight:
+                para = {**self.para, 'chapter': i}
+                with Tracer.get().span('chapter', course_id=para['course_id'], chapter=i):
+                    for stage in self.stages():
+                        resource = self.RESOURCES[stage]
+                        async with workers[resource]:
+                            click.secho(f'Start generating {stage} for chapter {i}...', fg='green')
+                            began = time.perf_counter()
+                            try:
+                                await self.run_stage(stage, para)
+                            finally:
+                                self.busy[resource] += time.perf_counter() - began
+
+        try:
+            # A failing chapter cancels the others, as the sequential loop stopped at the first failure.
+            async with asyncio.TaskGroup() as group:
+                for i in self.chapters:
+                    group.create_task(chapter(i))
+        finally:
+            self.wall = time.perf_counter() - start
+
+    async def run_stage(self, stage, para):
+        if stage == 'stream':
+            await ChapterStream(load_step('script')(para), load_step('voice')(para), load_step('video')(para)).run()
+        else:
+            await load_step(stage)(para).run_async()
+
+    def utilization(self):
+        """
+        Share of the wall time of the pipeline each resource class was busy, per worker.
+        """
+        return {resource: self.busy[resource] / (self.workers[resource] * self.wall) if self.wall else 0.0
+                for resource in self.workers if resource in {self.RESOURCES[stage] for stage in self.stages()}}
+
+    def report(self):
+        lines = [f"{'resource':<10}{'workers':>8}{'busy s':>10}{'util %':>8}"]
+        for resource, utilization in self.utilization().items():
+            lines.append(f"{resource:<10}{self.workers[resource]:>8}{self.busy[resource]:>10.1f}{utilization * 100:>8.1f}")
+        lines.append(f'{len(self.chapters)} chapters in {self.wall:.1f}s with a pipeline depth of {self.depth}.')
+        return '\n'.join(lines)
@@ -1,3 +1,4 @@
+import copy
 import os
 import json
 import asyncio
@@ -6,16 +7,18 @@ from asyncio import Semaphore       # for rate limiting
 import xml.etree.ElementTree as ET
 
 import click
-from langchain.output_parsers import OutputFixingParser
 from langchain_core.output_parsers import XMLOutputParser, StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 
 from Crafty.config import Config, Constants
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.trace import Tracer
 from Crafty.pipeline.utils.xml import XmlUtil
 
 
 class Notes(PipelineStep):
+    # Value of the chapter parameter to write the notes of every chapter in one batch.
+    ALL_CHAPTERS = 'all'
+
     def __init__(self, para):
         super().__init__(para)
 
@@ -61,10 +64,10 @@ class Notes(PipelineStep):
             self.semaphore = Semaphore(1)  
             self.read_meta_data_from_file()
 
-    def execute(self):
+    async def execute_async(self):
         if(self.short_video == True):
             # Generate notes for short videos
-            notes_exp = self.short_generate_expansions(input_prompt=self.topic)
+            notes_exp = await self.short_generate_expansions(input_prompt=self.topic)
 
             # Convert notes_exp to XML format
             notes_exp_xml = XmlUtil.dict_to_xml('notes_expansion', notes_exp)
@@ -86,29 +89,75 @@ class Notes(PipelineStep):
             sections = self.sections_list[self.chapter]
 
             if(self.craft_notes != True):
-                notes_exp = self.robust_generate_expansions(chapter_name, sections, 5)
+                notes_exp = await self.robust_generate_expansions(chapter_name, sections, 5)
             else:
-                self.find_sections_docs()
-                notes_exp = self.craft_generate_expansions(self.llm, sections, \
+                # The similarity searches of the document index block, so they run in a thread.
+                await asyncio.to_thread(self.find_sections_docs)
+                notes_exp = await self.craft_generate_expansions(self.llm, sections, \
                                                            self.sections_qdocs, \
                                                            self.sections_list[self.chapter], \
                                                            self.zero_shot_topic, \
                                                            self.max_note_expansion_words, \
                                                            self.max_note_expansion_words)
 
-            # Convert notes_exp to XML format
-            notes_exp_xml = XmlUtil.dict_to_xml('notes_expansion', notes_exp)
-
-            # Write XML to files
-            tree = ET.ElementTree(notes_exp_xml)
-            ET.indent(tree)
+            self.write_notes(notes_exp, self.chapter)
+
+    async def run_async(self):
+        if self.chapter != self.ALL_CHAPTERS:
+            return await super().run_async()
+        if self.short_video == True:
+            raise ValueError("Short videos have a single chapter, use chapter 0 instead of all.")
+        with Tracer.get().span('step', course_id=self.course_id, step='notes', chapter=self.ALL_CHAPTERS) as span:
+            chapters = [i for i in range(len(self.chapters_list)) if self.force or not self.for_chapter(i).is_up_to_date()]
+            for i in range(len(self.chapters_list)):
+                if i not in chapters:
+                    # Skipped as a single chapter run would, including the bookkeeping of edited notes.
+                    await self.for_chapter(i).run_async()
+            span.attributes['skipped'] = not chapters
+            if chapters:
+                await self.generate_all_expansions(chapters)
+            return bool(chapters)
+
+    def for_chapter(self, chapter):
+        """
+        This step for one chapter, sharing its models, chains and documents.
+        """
+        step = copy.copy(self)
+        step.chapter = chapter
+        return step
+
+    def write_notes(self, notes_exp, notes_set_number):
+        # Convert notes_exp to XML format
+        notes_exp_xml = XmlUtil.dict_to_xml('notes_expansion', notes_exp)
+
+        # Write XML to files
+        tree = ET.ElementTree(notes_exp_xml)
+        ET.indent(tree)
+
+        note_path = self.notes_dir + f'notes_set{notes_set_number}.xml'
+        with open(note_path, "wb") as f:
+            tree.write(f, encoding="UTF-8", xml_declaration=True)
+        click.echo(f'The notes file for chapter {notes_set_number} is saved to: {note_path}')
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({'topic': self.zero_shot_topic,
+                       'max_note_expansion_words': self.max_note_expansion_words,
+                       'advanced_model': self.para['advanced_model'],
+                       'short_video': self.short_video})
+        if(self.short_video == True):
+            params['input_prompt'] = self.topic
+        else:
+            # Only this chapter's entry of the section list, so editing another chapter does not rebuild these notes.
+            params['chapter'] = self.chapters_list[self.chapter]
+            params['sections'] = self.sections_list[self.chapter]
+        return params
 
-            note_path = self.notes_dir + f'notes_set{self.chapter}.xml'
-            with open(note_path, "wb") as f:
-                tree.write(f, encoding="UTF-8", xml_declaration=True)
-            click.echo(f'The notes file for chapter {self.chapter} is saved to: {note_path}')
+    def artifact_outputs(self):
+        notes_set_number = 0 if self.short_video == True else self.chapter
+        return [self.notes_dir + f'notes_set{notes_set_number}.xml']
 
-    def short_generate_expansions(self, input_prompt):
+    async def short_generate_expansions(self, input_prompt):
         output_instructions = "Provide expansions for the given section in XML format."
         inputs = {
             "input_prompt": input_prompt,
@@ -116,37 +165,11 @@ class Notes(PipelineStep):
             "expansion_length": self.max_note_expansion_words,
         }
 
-        parser = XMLOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                Your task is to indentify a single key points in the given prompt: {input_prompt} and provide explanations for that point.
-                Format the output in XML format as follows:
-                ----------------
-                {output_instructions}
-                ----------------
-                Max words for expansion: {expansion_length}
-                """
-            )
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                用中文回答：
-                你的任务是识别给定提示中的一个关键点: {input_prompt} 并为该点提供解释。
-                请按以下格式提供输出:
-                ----------------
-                {output_instructions}
-                ----------------
-                扩展的最大字数: {expansion_length}
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | self.llm | error_parser
-        results = chain.invoke(inputs)
+        chain = self.chain('short_expansions', XMLOutputParser, self.llm)
+        results = await chain.ainvoke(inputs)
         return dict(zip([input_prompt], [results]))
 
-    def robust_generate_expansions(self, chapter_name, sections, max_attempts=5):
+    async def robust_generate_expansions(self, chapter_name, sections, max_attempts=5):
         """
         Generate notes for each section in a robust way, retrying up to a maximum number of attempts in case of failure.
 
@@ -158,10 +181,10 @@ class Notes(PipelineStep):
         attempt = 0
         while attempt < max_attempts:
             try:
-                return asyncio.run(
-                    self.generate_expansions(chapter_name, sections))
+                return await self.generate_expansions(chapter_name, sections)
             except Exception as e:
                 print(f"Attempt {attempt + 1} failed for generating expansions: {e}")
+                Tracer.get().add('retries')
                 attempt += 1
                 if attempt == max_attempts:
                     print(f"Failed to generate expansions after {max_attempts} attempts.")
@@ -177,51 +200,85 @@ class Notes(PipelineStep):
         :return: A dictionary mapping section names to generated notes.
         """
         async with self.semaphore:    
-            inputs = [{
-                "course_name": self.zero_shot_topic,
-                "chapter_name": chapter_name,
-                "section": section,
-                "expansion_length": self.max_note_expansion_words,
-                "regions": self.regions,
-                "output_instructions": XmlUtil.generate_xml_elements(section, self.regions),
-            } for section in sections]
-
-            parser = XMLOutputParser()
-            error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-            if(self.language == 'en'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    Course name: {course_name}
-                    Chapter name: {chapter_name}
-                    Your task is to provide expansions covering regions: {regions} for the given section: {section}
-                    Format the output in XML format as follows:
-                    ----------------
-                    {output_instructions}
-                    ----------------
-                    Max words for expansion: {expansion_length}
-                    """
-                )
-            elif(self.language == 'zh'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    用中文回答：
-                    课程名称: {course_name}
-                    章节名称: {chapter_name}
-                    你的任务是为给定章节: {section} 提供涵盖区域: {regions} 的扩展
-                    请按以下格式提供输出:
-                    ----------------
-                    {output_instructions}
-                    ----------------
-                    扩展的最大字数: {expansion_length}
-                    """)
-            else:
-                raise ValueError("Language is not supported.")
-        chain = prompt | self.llm | error_parser
+            inputs = [self.expansion_inputs(chapter_name, section) for section in sections]
+
+        chain = self.chain('expansions', XMLOutputParser, self.llm)
         results = await chain.abatch(inputs)
 
         final_roots = XmlUtil.nest_dict_to_xml(results)
 
         return dict(zip(sections, final_roots))
+
+    def expansion_inputs(self, chapter_name, section):
+        return {
+            "course_name": self.zero_shot_topic,
+            "chapter_name": chapter_name,
+            "section": section,
+            "expansion_length": self.max_note_expansion_words,
+            "regions": self.regions,
+            "output_instructions": XmlUtil.generate_xml_elements(section, self.regions),
+        }
+
+    async def generate_all_expansions(self, chapters, max_attempts=5):
+        """
+        Generate the notes of every section of the given chapters in one batch, bounded by
+        Config.NOTES_BATCH_CONCURRENCY and the rate limits of the model rather than by the chapters.
+        The notes of a chapter are written, and recorded in the build manifest, as soon as all its
+        sections are done. Sections whose response fails are retried on their own.
+
+        :param chapters: Numbers of the chapters.
+        :param max_attempts: The maximum number of attempts to make for each section.
+        """
+        if(self.craft_notes != True):
+            chain = self.chain('expansions', XMLOutputParser, self.llm)
+        else:
+            # The similarity searches of the document index block, so they run in a thread.
+            await asyncio.to_thread(self.find_sections_docs)
+            chain = self.chain('craft_expansions', StrOutputParser, self.llm, fixing_llm=self.llm)
+            markdown_format_string = self.markdown_format(["Outline", "Examples", "Essentiality"])
+
+        def inputs(chapter, index):
+            section = self.sections_list[chapter][index]
+            if(self.craft_notes != True):
+                return self.expansion_inputs(self.chapters_list[chapter], section)
+            return {"max_words_expansion": self.max_note_expansion_words,
+                    "text": self.sections_qdocs[chapter][index],
+                    "definition": section,
+                    "section": section,
+                    "course_name_domain": self.zero_shot_topic,
+                    "markdown_format_string": markdown_format_string}
+
+        pairs = [(chapter, index) for chapter in chapters for index in range(len(self.sections_list[chapter]))]
+        results = {}
+        remaining = {chapter: len(self.sections_list[chapter]) for chapter in chapters}
+        pending = list(range(len(pairs)))
+        for attempt in range(max_attempts):
+            failed = []
+            batch = chain.abatch_as_completed([inputs(*pairs[k]) for k in pending], return_exceptions=True,
+                                              config={'max_concurrency': Config.NOTES_BATCH_CONCURRENCY})
+            async for position, result in batch:
+                k = pending[position]
+                if isinstance(result, Exception):
+                    failed.append(k)
+                    continue
+                results[pairs[k]] = result
+                chapter = pairs[k][0]
+                remaining[chapter] -= 1
+                if remaining[chapter] == 0:
+                    self.save_chapter_expansions(chapter, [results[(chapter, index)] for index in range(len(self.sections_list[chapter]))])
+            if not failed:
+                return
+            print(f"Attempt {attempt + 1} failed for generating expansions of {len(failed)} sections.")
+            Tracer.get().add('retries', len(failed))
+            pending = failed
+        raise Exception(f"Expansions generation failed after {max_attempts} attempts for sections: {[pairs[k] for k in pending]}")
+
+    def save_chapter_expansions(self, chapter, results):
+        sections = self.sections_list[chapter]
+        if(self.craft_notes != True):
+            results = XmlUtil.nest_dict_to_xml(results)
+        self.write_notes(dict(zip(sections, results)), chapter)
+        self.for_chapter(chapter).record_artifact()
     
     def find_sections_docs(self):
         embed_book = self.main_embedding
@@ -252,13 +309,14 @@ class Notes(PipelineStep):
         with open(file_path, 'w', encoding='utf-8') as file:
             json.dump(self.sections_qdocs, file, indent=2, ensure_ascii=False)
 
-    def craft_generate_expansions(self, llm, sections, texts, defs, course_name_domain, max_words_craft_notes, max_words_expansion, max_attempts = 3, regions = ["Outline", "Examples", "Essentiality"]):
+    async def craft_generate_expansions(self, llm, sections, texts, defs, course_name_domain, max_words_craft_notes, max_words_expansion, max_attempts = 3, regions = ["Outline", "Examples", "Essentiality"]):
         attempt = 0
         while attempt < max_attempts:
             try:
-                return asyncio.run(self.craft_generate_expansions_async(llm, sections, texts, defs, course_name_domain, max_words_craft_notes, max_words_expansion, regions))
+                return await self.craft_generate_expansions_async(llm, sections, texts, defs, course_name_domain, max_words_craft_notes, max_words_expansion, regions)
             except Exception as e:
                 print(f"Attempt {attempt + 1} failed for generating expansions: {e}")
+                Tracer.get().add('retries')
                 attempt += 1
                 if attempt == max_attempts:
                     print(f"Failed to generate expansions after {max_attempts} attempts.")
@@ -267,13 +325,7 @@ class Notes(PipelineStep):
 
     async def craft_generate_expansions_async(self, llm, sections, texts, defs, course_name_domain, max_words_craft_notes, max_words_expansion, \
                                         regions = ["Outline", "Examples", "Essentiality"]):
-        def format_string(regions):
-            markdown_content = "\n".join([f'### {region}\n\nExample content for {region}.\n' for region in regions])
-            markdown_format_string = f"""
-            {markdown_content}
-            """
-            return markdown_format_string
-        markdown_format_string = format_string(regions)
+        markdown_format_string = self.markdown_format(regions)
 
         inputs = [{
             "max_words_expansion": max_words_expansion,
@@ -283,80 +335,14 @@ class Notes(PipelineStep):
             "course_name_domain": course_name_domain,
             "markdown_format_string": markdown_format_string,
         } for text, section, definition in zip(texts, sections, defs)]
-        parser = StrOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=llm)
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                For the course: {course_name_domain}, provide the expansions with a few pre-defined regions for the section: {section}.
-                {section}'s definition is: {definition}.
-                
-                Generate expansions based on the given context as below:
-                Context to extract section definition: {text}.
-                Max words for expansion: {max_words_expansion}
-                It should formated as markdown:
-                {markdown_format_string}
-
-                1. The first region is "Outline" which should be some really brief bullet points about the following content around that sections.
-                2. If the concept can be better explained by formulas, use LaTeX syntax in markdown, like:
-                    ----------------
-                    $$
-                    \frac{{a}}{{b}} = \frac{{c}}{{d}}
-                    $$
-                    ----------------
-                3. If you find you need to add tables, use markdown format, like:
-                    ----------------
-                    ### Example Table
-
-                    | Header 1   | Header 2   | Header 3   |
-                    |------------|------------|------------|
-                    | Row 1 Col 1| Row 1 Col 2| Row 1 Col 3|
-                    | Row 2 Col 1| Row 2 Col 2| Row 2 Col 3|
-                    | Row 3 Col 1| Row 3 Col 2| Row 3 Col 3|
-                    ----------------
-
-                4. Do not include "```markdown" in the response. Final whole response must be in correct markdown format.
-                5. Specify the text with intuitive markdown syntax like bold, italic, etc, bullet points, etc.
-                6. For in-line formulas, use the syntax: $E = mc^2$. Remember must use double ```$``` for display formulas.
-                """
-            )
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                用中文回答：
-                对于课程: {course_name_domain}，为部分: {section} 提供一些预定义区域的扩展。
-                {section} 的定义是: {definition}。
-                
-                根据以下上下文生成扩展:
-                提取部分定义的上下文: {text}.
-                扩展的最大字数: {max_words_expansion}
-                它应该格式化为markdown:
-                {markdown_format_string}
-
-                1. 第一个区域是“大纲”，应该是关于该部分周围内容的一些非常简要的要点。
-                2. 如果概念可以通过公式更好地解释，请在markdown中使用LaTeX语法，如：
-                    ----------------
-                    $$
-                    \frac{{a}}{{b}} = \frac{{c}}{{d}}
-                    $$
-                    ----------------
-                3. 如果您发现需要添加表格，请使用markdown格式，如：
-                    ----------------
-                    ### 例子表
-
-                    | 标题 1   | 标题 2   | 标题 3   |
-                    |------------|------------|------------|
-                    | 行 1 列 1| 行 1 列 2| 行 1 列 3|
-                    | 行 2 列 1| 行 2 列 2| 行 2 列 3|
-                    | 行 3 列 1| 行 3 列 2| 行 3 列 3|
-                    ----------------
-
-                4. 不要在响应中包含“```markdown”。最终整个响应必须以正确的markdown格式。
-                5. 使用直观的markdown语法，如粗体，斜体，项目符号等，指定文本。
-                6. 对于行内公式，请使用语法：$E = mc^2$。记住必须使用双```$```显示公式。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | llm | error_parser
+        chain = self.chain('craft_expansions', StrOutputParser, llm, fixing_llm=llm)
         results = await chain.abatch(inputs)
         return dict(zip(sections, results))
+
+    @staticmethod
+    def markdown_format(regions):
+        markdown_content = "\n".join([f'### {region}\n\nExample content for {region}.\n' for region in regions])
+        markdown_format_string = f"""
+            {markdown_content}
+            """
+        return markdown_format_string
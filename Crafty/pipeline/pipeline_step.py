@@ -1,22 +1,31 @@
+import asyncio
+import atexit
+import contextvars
 import json
 import os
+import threading
 from abc import ABC, abstractmethod
 
-from Crafty.pipeline.science.api_handler import ApiHandler
-from Crafty.pipeline.science.doc_handler import DocHandler
-from Crafty.pipeline.science.prompt_handler import PromptHandler
+import click
+
+from Crafty.config import Config, Constants
 from Crafty.pipeline.utils.hash import HashUtil
-from config import Config, Constants
+from Crafty.pipeline.utils.manifest import Manifest
+from Crafty.pipeline.utils.trace import Tracer
 
 class PipelineStep(ABC):
+    # Event loop of the synchronous entry points (run, execute) of each thread. It is kept for the life of
+    # the process, so the steps run one after the other, e.g. by a worker, share the clients, semaphores and
+    # rate limiters bound to it instead of building them again on a new loop.
+    _runners = threading.local()
+
     def __init__(self, para):
         super().__init__()
-        self.llm_basic = ApiHandler(para).models['basic']['instance']
-        self.llm_advance = ApiHandler(para).models['advance']['instance']
-        self.api = ApiHandler(para)
-        self.prompt = PromptHandler(self.api)
-        self.llm_basic_context_window = self.api.models['basic']['context_window']
-        self.llm_advance_context_window = self.api.models['advance']['context_window']
+        self.para = para
+        # The model handlers pull in langchain and openai, so they are only built
+        # on first use. Steps which never prompt a model (voice, video) skip them.
+        self._api = None
+        self._prompt = None
         self.language = para['language']
 
         if 'course_id' in para:
@@ -33,24 +42,246 @@ class PipelineStep(ABC):
         self.debug_dir = Config.OUTPUT_DIR + self.course_id + Config.DEBUG_DIR
         self.videos_dir = Config.OUTPUT_DIR + self.course_id + Config.VIDEOS_DIR
         self.final_dir = Config.OUTPUT_DIR + self.course_id + Config.FINAL_DIR
+        self.manifest = Manifest(Config.OUTPUT_DIR + self.course_id + '/' + Config.MANIFEST)
+        # Rebuild the step even if its outputs are up to date.
+        self.force = para.get('force', False)
+        # Declare the response shape of JSON prompts to the model instead of parsing free text.
+        self.structured_output = para.get('structured_output', False)
 
         # If the user wants to craft the notes
         self.craft_notes = para['craft_notes']
         self.file_name = para['file_name']
         if(self.craft_notes == True):
+            from Crafty.pipeline.science.doc_handler import DocHandler
             self.file_dir = Config.INPUT_DIR
             para['file_dir'] = self.file_dir
             para["results_dir"] = self.meta_dir
             # Create a DocHandler instance, currently only one main file is supported
             para['main_filenames'] = [self.file_name]
             para['supplementary_filenames'] = []
-            self.docs = DocHandler(para)
+            self.docs = DocHandler.shared(para)
             self.main_embedding = self.docs.main_embedding[0]
 
+    @property
+    def api(self):
+        if self._api is None:
+            from Crafty.pipeline.science.api_handler import ApiHandler
+            self._api = ApiHandler.shared(self.para)
+        return self._api
+
+    @property
+    def prompt(self):
+        if self._prompt is None:
+            from Crafty.pipeline.science.prompt_handler import PromptHandler
+            self._prompt = PromptHandler(self.api)
+        return self._prompt
+
+    @property
+    def llm_basic(self):
+        return self.api.models['basic']['instance']
+
+    @property
+    def llm_advance(self):
+        return self.api.models['advance']['instance']
+
+    @property
+    def policy(self):
+        """
+        Deadline and hedging of the model calls of this step, see Config.REQUEST_BUDGETS.
+        """
+        from Crafty.pipeline.science.request_policy import RequestPolicy
+        return RequestPolicy.for_step(type(self).__name__.lower())
+
+    def chain(self, variant, parser, llm, fixing_llm=None):
+        """
+        The cached chain for a prompt variant of this step in the course language.
+
+        :param variant: Name of the prompt in prompts/<language>/<step>.toml.
+        :param parser: Output parser class.
+        :param llm: Model prompted with the template.
+        :param fixing_llm: Model fixing unparsable responses, the basic model by default.
+        """
+        from Crafty.pipeline.science.prompt_registry import PromptRegistry
+        step = type(self).__name__.lower()
+        chain = PromptRegistry.chain(step, self.language, variant, llm, parser,
+                                     fixing_llm if fixing_llm is not None else self.llm_basic)
+        return self.policy.wrap(chain, f'{step}.{variant}')
+
+    def structured_chain(self, variant, schema, llm):
+        """
+        The cached chain for a prompt variant of this step, returning a response validated against schema.
+        Use it with invoke_validated or abatch_validated from structured_output, which only retry the
+        items whose response does not validate.
+        """
+        from Crafty.pipeline.science.prompt_registry import PromptRegistry
+        step = type(self).__name__.lower()
+        chain = PromptRegistry.structured_chain(step, self.language, variant, llm, schema)
+        return self.policy.wrap(chain, f'{step}.{variant}')
+
+    def template(self, variant):
+        """
+        The prompt template of a variant of this step in the course language.
+        """
+        from Crafty.pipeline.science.prompt_registry import PromptRegistry
+        return PromptRegistry.template(type(self).__name__.lower(), self.language, variant)
+
+    def select_tier(self, variant, inputs, tiers):
+        """
+        The first model tier whose context window fits the prompt of variant with inputs, see PromptHandler.select_model.
+        """
+        return self.prompt.select_model(self.template(variant), inputs, tuple(tiers))
+
+    def fit_inputs(self, variant, inputs, key, tier, summarize=False):
+        """
+        Inputs with inputs[key] trimmed, or summarized, so the prompt of variant fits the context window of tier.
+        """
+        return self.prompt.fit_inputs(self.template(variant), inputs, key, tier, summarize=summarize)
+
+    def route(self, task, build, default, validate=None, prompt=None):
+        """
+        Chain for a task which tries the model tiers of its route in Config.MODEL_ROUTES in order,
+        escalating to the next tier only if the call fails or its result does not validate.
+
+        :param task: Name of the task in Config.MODEL_ROUTES.
+        :param build: Function building the chain of the task for a model, e.g. lambda llm: self.chain(..., llm).
+        :param default: Tier used if the task has no route.
+        :param validate: Function returning None for a valid result, or the reason it is not.
+        :param prompt: Optional (variant, inputs) of the call. Tiers whose context window is too small for
+            the prompt are skipped instead of failing.
+        """
+        from Crafty.pipeline.science.model_router import ModelRouter
+        tiers = ModelRouter.tiers(task, default)
+        if prompt is not None:
+            tiers = tiers[tiers.index(self.select_tier(*prompt, tiers)):]
+        chains = [(tier, build(self.api.models[tier]['instance'])) for tier in tiers]
+        return ModelRouter.cascade(task, chains, validate)
+
+    @property
+    def llm_basic_context_window(self):
+        return self.api.models['basic']['context_window']
+
+    @property
+    def llm_advance_context_window(self):
+        return self.api.models['advance']['context_window']
+
+    @classmethod
+    def runner(cls):
+        """
+        The long-lived asyncio.Runner of the calling thread.
+        """
+        runner = getattr(cls._runners, 'runner', None)
+        if runner is None:
+            runner = cls._runners.runner = asyncio.Runner()
+            atexit.register(runner.close)
+        return runner
+
+    @classmethod
+    def run_sync(cls, coroutine):
+        """
+        Run a coroutine to completion on the event loop of the calling thread, from synchronous code.
+        The coroutine sees the context of the caller, e.g. its trace span.
+        """
+        return cls.runner().run(coroutine, context=contextvars.copy_context())
+
     @abstractmethod
+    async def execute_async(self):
+        """
+        Build the outputs of the step on the running event loop. Model calls are awaited, and blocking
+        work (files, subprocesses, synchronous clients) runs in a thread with asyncio.to_thread, so that
+        one loop can drive several steps and chapters at once.
+        """
+
     def execute(self):
+        """
+        Synchronous wrapper of execute_async.
+        """
+        return self.run_sync(self.execute_async())
+
+    async def run_async(self):
+        """
+        Execute the step unless its outputs are up to date with its inputs and parameters.
+        Returns True if the step was executed.
+        """
+        key = self.artifact_key()
+        with Tracer.get().span('step', course_id=self.course_id, step=type(self).__name__.lower(),
+                               chapter=getattr(self, 'chapter', None)) as span:
+            if not self.force and self.is_up_to_date():
+                click.echo(f'{key} is up to date, skipping.')
+                span.attributes['skipped'] = True
+                edited = self.manifest.edited_outputs(key, self.artifact_outputs())
+                if edited:
+                    await self.refresh_outputs(edited)
+                    self.record_artifact()
+                return False
+            await self.execute_async()
+            self.record_artifact()
+            return True
+
+    def run(self):
+        """
+        Synchronous wrapper of run_async.
+        """
+        return self.run_sync(self.run_async())
+
+    def artifact_key(self):
+        """
+        Name of the step outputs in the build manifest. Steps working on one chapter are keyed by chapter.
+        """
+        key = type(self).__name__.lower()
+        if getattr(self, 'chapter', None) is not None:
+            key += f'_{self.chapter}'
+        return key
+
+    def artifact_inputs(self):
+        """
+        Files the step outputs are built from.
+        """
+        if self.craft_notes == True:
+            return [self.file_dir + self.file_name]
+        return []
+
+    def artifact_params(self):
+        """
+        Parameters the step outputs depend on, besides the content of the input files.
+        """
+        return {'language': self.language}
+
+    def artifact_outputs(self):
+        """
+        Files produced by the step. A step without declared outputs always runs.
+        """
+        return []
+
+    def is_up_to_date(self):
+        outputs = self.artifact_outputs()
+        if not outputs:
+            return False
+        return self.manifest.is_up_to_date(self.artifact_key(), self.artifact_inputs(), self.artifact_params(), outputs)
+
+    async def refresh_outputs(self, edited):
+        """
+        Called when the step is up to date but some of its outputs were edited by hand since it was built,
+        for steps which derive further files from them.
+        """
         pass
 
+    def artifact_fingerprints(self):
+        """
+        Fingerprints of the parts of the outputs (e.g. one per slide), stored with the artifact so that
+        the next build only redoes the parts which changed.
+        """
+        return {}
+
+    def previous_fingerprints(self, name):
+        if self.force:
+            return []
+        entry = self.manifest.entry(self.artifact_key())
+        return entry.get(name, []) if entry is not None else []
+
+    def record_artifact(self):
+        self.manifest.record(self.artifact_key(), self.artifact_inputs(), self.artifact_params(), self.artifact_outputs(),
+                             **self.artifact_fingerprints())
+
     def read_meta_data_from_file(self):
         if os.path.exists(self.notes_dir + Config.CHAPTERS_AND_SECTIONS):
             with open(self.notes_dir + Config.CHAPTERS_AND_SECTIONS, 'r') as json_file:
@@ -69,4 +300,4 @@ class PipelineStep(ABC):
                     # Temporary solution for the craft_topic named as zero_shot_topic
                     self.zero_shot_topic = meta_data[Constants.CRAFT_TOPIC_KEY]
         else:
-            raise FileNotFoundError(f"Chapter file not found in {self.meta_dir}")
\ No newline at end of file
+            raise FileNotFoundError(f"Chapter file not found in {self.meta_dir}")
@@ -5,7 +5,115 @@ import openai
 # from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.tracers import ConsoleCallbackHandler
-from langchain_openai import ChatOpenAI
+from langchain_core.outputs import ChatResult
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from Crafty.pipeline.utils.single_flight import SingleFlight
+from Crafty.pipeline.utils.trace import Tracer, llm_cost
+
+# In-flight model and embedding requests of the process, shared by all models.
+model_calls = SingleFlight()
+embedding_calls = SingleFlight()
+
+
+class CoalescingChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI collapsing concurrent identical requests (same model parameters and messages) into one upstream
+    call. The callers sharing a result are reported without tokens, so the cost is only counted once.
+    """
+
+    def _request_key(self, messages, stop, kwargs):
+        return SingleFlight.key(self._get_invocation_params(stop=stop, **kwargs), [message.dict() for message in messages])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        result, shared = model_calls.do(
+            self._request_key(messages, stop, kwargs),
+            lambda: super(CoalescingChatOpenAI, self)._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+        return self._shared_result(result) if shared else result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        result, shared = await model_calls.ado(
+            self._request_key(messages, stop, kwargs),
+            lambda: super(CoalescingChatOpenAI, self)._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs))
+        return self._shared_result(result) if shared else result
+
+    @staticmethod
+    def _shared_result(result):
+        Tracer.get().add('coalesced')
+        return ChatResult(generations=result.generations, llm_output=dict(result.llm_output or {}, token_usage={}))
+
+
+class CoalescingOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAIEmbeddings collapsing concurrent embeddings of the same query into one upstream call.
+    """
+
+    def embed_query(self, text):
+        result, shared = embedding_calls.do(SingleFlight.key(self.model, text),
+                                            lambda: super(CoalescingOpenAIEmbeddings, self).embed_query(text))
+        if shared:
+            Tracer.get().add('coalesced')
+        return result
+
+    async def aembed_query(self, text):
+        result, shared = await embedding_calls.ado(SingleFlight.key(self.model, text),
+                                                   lambda: super(CoalescingOpenAIEmbeddings, self).aembed_query(text))
+        if shared:
+            Tracer.get().add('coalesced')
+        return result
+
+
+def coalescing_report():
+    models, embeddings = model_calls.stats(), embedding_calls.stats()
+    return (f"Coalesced requests: {models['followers']} of {models['leaders'] + models['followers']} model calls, "
+            f"{embeddings['followers']} of {embeddings['leaders'] + embeddings['followers']} embedding queries")
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """
+    Record every model call as an 'llm' span of the Tracer, with its tokens, estimated cost and retries.
+    """
+    # Run in the caller's context, also for async calls, so the span of the running step is the parent.
+    run_inline = True
+
+    def __init__(self):
+        self.runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self.runs[run_id] = Tracer.get().start('llm')
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self.runs[run_id] = Tracer.get().start('llm')
+
+    def on_retry(self, retry_state, *, run_id, parent_run_id=None, **kwargs):
+        if run_id in self.runs:
+            self.runs[run_id].add('retries', 1)
+
+    def on_llm_end(self, response, *, run_id, parent_run_id=None, **kwargs):
+        span = self.runs.pop(run_id, None)
+        if span is None:
+            return
+        llm_output = response.llm_output or {}
+        usage = llm_output.get('token_usage') or {}
+        model_name = llm_output.get('model_name')
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+        span.attributes.update({
+            'model': model_name,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cached_tokens': cached_tokens,
+            'cache_hit': cached_tokens > 0,
+            'cost_usd': llm_cost(model_name, prompt_tokens, completion_tokens, cached_tokens),
+        })
+        Tracer.get().finish(span)
+
+    def on_llm_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        span = self.runs.pop(run_id, None)
+        if span is not None:
+            Tracer.get().finish(span, error=error)
+
 
 class LLMApiHandler(ABC):
     """
@@ -28,7 +136,7 @@ class OpenAiHandler(LLMApiHandler):
     def load_model(self, temperature, model_name):
         try:
             # model = ChatOpenAI(temperature=temperature, streaming=True, callbacks=[StreamingStdOutCallbackHandler()], model_name=model_name)
-            model = ChatOpenAI(temperature=temperature, streaming=False, callbacks=[BaseCallbackHandler()], model_name=model_name, verbose=False)
+            model = CoalescingChatOpenAI(temperature=temperature, streaming=False, callbacks=[TraceCallbackHandler()], model_name=model_name, verbose=False)
             # model = ChatOpenAI(temperature=temperature, streaming=False, callbacks=[ConsoleCallbackHandler()], model_name=model_name, verbose=False)
             # print(f'Successfully loaded {model_name}!')
             return model
@@ -51,10 +159,24 @@ class LLMApiFactory:
             raise ValueError(f'LLM source {llm_source} is not supported.')
 
 class ApiHandler:
+    # Handlers built in this process, keyed by their model parameters. Long-running workers reuse
+    # them so the model clients and their connection pools stay warm between jobs.
+    _shared = {}
+
     def __init__(self, para):
         self.api_handler = LLMApiFactory.get_api_handler(para)
         self.models = self.load_models(para)
 
+    @classmethod
+    def shared(cls, para):
+        """
+        Return the handler for the model parameters in para, building it on first use.
+        """
+        key = (para['llm_source'], para['temperature'], para['creative_temperature'])
+        if key not in cls._shared:
+            cls._shared[key] = cls(para)
+        return cls._shared[key]
+
     def load_models(self, para):
         models = {
             'basic': {
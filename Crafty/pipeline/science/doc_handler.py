@@ -1,18 +1,21 @@
 import hashlib
 import json
+import re
 from typing import Dict, List, Any, Optional
 import os
 import logging
+import fitz
 import pandas as pd
 from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader
-from langchain_openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 
-from Crafty.pipeline.science.api_handler import ApiHandler
+from Crafty.config import Config
+from Crafty.pipeline.science.api_handler import ApiHandler, CoalescingOpenAIEmbeddings
 from Crafty.pipeline.science.prompt_handler import PromptHandler
+from Crafty.pipeline.utils.headings import HeadingsUtil
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -40,6 +43,15 @@ def split_filename(file_name_with_extension: str) -> str:
     return parts[1]
 
 class DocHandler:
+    # Handlers built in this process, keyed by the documents they index.
+    _shared = {}
+    # Numbering in front of an outline title, e.g. 'Chapter 3:', 'Part II' or '3.2'.
+    OUTLINE_NUMBERING = re.compile(r'^(?:(?:chapter|section|part|lecture|unit)\s+[\divxlc]+|\d+(?:\.\d+)*)(?:\s*[.:)\-\u2013\u2014]\s*|\s+|$)', re.IGNORECASE)
+    # Outline entries which are front or back matter, or parts grouping chapters, rather than chapters or sections.
+    OUTLINE_SKIPPED = re.compile(r'(cover|title page|copyright|dedication|(table of )?contents|preface|foreword|acknowledge?ments?|'
+                                 r'about the authors?|list of (figures|tables)|index|bibliography|references|glossary|'
+                                 r'further reading|exercises|problems|summary|notes|appendix\b.*|part\b.*)', re.IGNORECASE)
+
     def __init__(self, para: Dict[str, Any]):
         """
         Initializes the document handler with configuration parameters.
@@ -55,11 +67,25 @@ class DocHandler:
         self.nMain = len(self.main_filenames)
         self.nSupp = len(self.supplementary_filenames)
         self.results_dir = para['results_dir']
-        self.api = ApiHandler(para)
+        self.api = ApiHandler.shared(para)
         self.prompt = PromptHandler(self.api)
         self._init_file_handling()
 
-    def _ensure_list(self, input_val: Any) -> List[str]:
+    @classmethod
+    def shared(cls, para: Dict[str, Any]) -> 'DocHandler':
+        """
+        Returns the handler for the documents in para, loading and indexing them on first use only.
+        Long-running workers keep the loaded documents and embeddings warm between jobs.
+        """
+        key = (para['file_dir'], tuple(cls._ensure_list(para.get('main_filenames', []))),
+               tuple(cls._ensure_list(para.get('supplementary_filenames', []))),
+               int(para['chunk_size']), para['results_dir'])
+        if key not in cls._shared:
+            cls._shared[key] = cls(para)
+        return cls._shared[key]
+
+    @staticmethod
+    def _ensure_list(input_val: Any) -> List[str]:
         """Ensures the provided input is a list of strings."""
         if isinstance(input_val, list):
             return input_val
@@ -81,6 +107,7 @@ class DocHandler:
         self.supp_docs_pages = self._get_page_numbers(self.supp_docs)
         self.indx_page_docs = self.locate_and_save_index_pages(self.main_docs, self.main_filenames)
         self.cont_page_docs = self.locate_and_save_contents_pages(self.main_docs, self.main_filenames)
+        self.outlines = self.locate_and_save_outlines(self.main_file_dirs, self.main_filenames)
         self.main_embedding = self.create_and_store_embeddings(self.main_docs, self.main_filenames)
         self.supp_embedding = self.create_and_store_embeddings(self.supp_docs, self.supplementary_filenames)
         self.infer_course_name_domain(self.main_docs[0], 'basic')
@@ -402,6 +429,93 @@ class DocHandler:
         df.to_csv(f"{self.course_meta_dir}/{doc_name}_contents_docs.csv", index=False)
         return df
 
+    def locate_and_save_outlines(self, file_paths, doc_names):
+        """
+        Reads the chapters and sections of each PDF document from its outline (bookmarks), which most
+        textbooks carry, or else from the layout of its headings (see HeadingsUtil), so the course structure
+        does not need to be inferred by the model. Each outline is saved to a JSON file named after the document.
+
+        Args:
+            file_paths (list): The full paths to the documents.
+            doc_names (list): A list of document names, each used to generate a JSON file name.
+
+        Returns:
+            list: The outline of each document (see outline_from_toc), or None if it has no usable outline.
+        """
+        outlines = []
+        for path, doc_name in zip(file_paths, doc_names):
+            outline = None
+            if split_filename(doc_name).lower() == 'pdf':
+                try:
+                    with fitz.open(path) as document:
+                        toc, page_count = document.get_toc(simple=True), document.page_count
+                    outline = self.outline_from_toc(toc, page_count)
+                    if outline is None:
+                        # Without bookmarks, the outline is found from the font sizes and weights of the headings.
+                        outline = self.outline_from_toc(HeadingsUtil.find_toc(path), page_count)
+                except Exception as e:
+                    logger.error(f"Failed to read the outline of {path}: {e}")
+            with open(f"{self.course_meta_dir}/{doc_name}_outline.json", 'w', encoding='utf-8') as file:
+                json.dump(outline, file, indent=2, ensure_ascii=False)
+            print(f"Outline of {doc_name}: {len(outline) if outline else 'no usable'} chapters.")
+            outlines.append(outline)
+        return outlines
+
+    @classmethod
+    def outline_from_toc(cls, toc, page_count, chapter_range=None):
+        """
+        Chapters and sections of a document from its outline, as returned by fitz `get_toc()`: a list of
+        [level, title, page] entries. The chapters are the first level with a number of entries within
+        chapter_range once front and back matter and parts are left out, the sections are the entries one
+        level below each chapter. Every entry runs to the page before the next entry of the same or a
+        higher level, or to the end of the document. Numbering is removed from the titles.
+
+        Args:
+            toc (list): The [level, title, page] entries of the outline, pages numbered from 1.
+            page_count (int): The number of pages of the document.
+            chapter_range (tuple): Minimum and maximum number of chapters, Config.OUTLINE_CHAPTERS by default.
+
+        Returns:
+            list: [{'title', 'start_page', 'end_page', 'sections': [{'title', 'start_page', 'end_page'}]}]
+                  or None if the outline has no level with a usable number of chapters.
+        """
+        min_chapters, max_chapters = chapter_range or Config.OUTLINE_CHAPTERS
+        # Entries pointing outside the document (e.g. links to other files) are left out.
+        entries = [(level, title.strip(), page) for level, title, page, *_ in toc if 1 <= page <= page_count and title.strip()]
+
+        def end_page(k):
+            level = entries[k][0]
+            following = (page for next_level, _, page in entries[k + 1:] if next_level <= level)
+            return max(entries[k][2], next(following, page_count + 1) - 1)
+
+        def node(k):
+            title = cls.OUTLINE_NUMBERING.sub('', entries[k][1]).strip() or entries[k][1]
+            return {'title': title, 'start_page': entries[k][2], 'end_page': end_page(k)}
+
+        def kept(k, level):
+            return entries[k][0] == level and not cls.OUTLINE_SKIPPED.fullmatch(entries[k][1]) \
+                and not cls.OUTLINE_SKIPPED.fullmatch(node(k)['title'])
+
+        for level in sorted({level for level, _, _ in entries}):
+            chapters = [k for k in range(len(entries)) if kept(k, level)]
+            if min_chapters <= len(chapters) <= max_chapters:
+                break
+        else:
+            return None
+
+        outline = []
+        for k in chapters:
+            chapter = node(k)
+            sections = []
+            for j in range(k + 1, len(entries)):
+                if entries[j][0] <= level:
+                    break
+                if kept(j, level + 1):
+                    sections.append(node(j))
+            chapter['sections'] = sections
+            outline.append(chapter)
+        return outline
+
     def _split_doc_into_chunks(self, document):
         """
         Splits a book into chunks of specified size with no overlap.
@@ -431,10 +545,10 @@ class DocHandler:
             embedding_file_path = os.path.join(self.book_embedding_dir, document_name)
             if os.path.exists(embedding_file_path):
                 # Load the existing embeddings
-                db = Chroma(persist_directory=embedding_file_path, embedding_function=OpenAIEmbeddings())
+                db = Chroma(persist_directory=embedding_file_path, embedding_function=CoalescingOpenAIEmbeddings())
             else:
                 print(f"Creating new embedding for {document_name}.")
-                embeddings = OpenAIEmbeddings()
+                embeddings = CoalescingOpenAIEmbeddings()
                 chunks = self._split_doc_into_chunks(document)
                 db = Chroma.from_documents(chunks, embeddings, persist_directory=embedding_file_path)
             embedding_list.append(db)
@@ -454,15 +568,6 @@ class DocHandler:
         - str: The inferred course name and domain.
         """
         course_meta_file_path = os.path.join(self.course_meta_dir, "course_name_domain.txt")
-        chunk = self.prompt.split_prompt(str(doc[:pages]), model_version, return_first_chunk_only=True)[0]
-        self.textbook_content_pages = chunk
-        # self.textbook_content_pages = self.cont_page_docs[0]['contents_docs']
-
-        # Check if the course meta file exists and read from it if it does
-        if os.path.exists(course_meta_file_path):
-            with open(course_meta_file_path, 'r') as file:
-                self.course_name_domain = file.read()
-                return
         #infer course name
         llm = self.api.models[model_version]['instance']
         # parser1 = StrOutputParser()
@@ -482,6 +587,17 @@ class DocHandler:
             ```
             """
         )
+        # Keep the chunk within what the prompt and the response leave of the context window, so it is not rejected.
+        budget = self.prompt.input_budget(prompt1, {'doc': ''}, 'doc', model_version)
+        chunk = self.prompt.split_prompt(str(doc[:pages]), model_version, custom_token_limit=budget, return_first_chunk_only=True)[0]
+        self.textbook_content_pages = chunk
+        # self.textbook_content_pages = self.cont_page_docs[0]['contents_docs']
+
+        # Check if the course meta file exists and read from it if it does
+        if os.path.exists(course_meta_file_path):
+            with open(course_meta_file_path, 'r') as file:
+                self.course_name_domain = file.read()
+                return
         # chain 1: input= doc and output= course_name
         chain1 = prompt1 | llm | parser1
         try:
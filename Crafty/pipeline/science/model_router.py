@@ -0,0 +1,123 @@
+import json
+import re
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class ModelRouter:
+    """
+    Cascade of model tiers for a task. The task is sent to the first tier of its route in Config.MODEL_ROUTES,
+    and to the next tier only if the call fails or its result does not validate. Every routed call is
+    traced as a 'route' span with the tier which served it, so escalation rates can be read from the traces.
+    """
+
+    @staticmethod
+    def tiers(task, default):
+        """
+        Tiers tried in order for a task. Tasks without a route use their default tier only.
+        """
+        return tuple(Config.MODEL_ROUTES.get(task, (default,)))
+
+    @staticmethod
+    def cascade(task, chains, validate=None):
+        """
+        Runnable trying the chains in order until one returns a valid result. The result of the
+        last chain is returned even if it does not validate.
+
+        :param chains: List of (tier, chain) pairs.
+        :param validate: Function returning None for a valid result, or the reason it is not.
+        """
+        def invoke(inputs):
+            with Tracer.get().span('route', task=task) as span:
+                for index, (tier, chain) in enumerate(chains):
+                    try:
+                        result = chain.invoke(inputs)
+                    except Exception as e:
+                        if ModelRouter._escalate(span, chains, index, repr(e)):
+                            continue
+                        raise
+                    if not ModelRouter._escalate(span, chains, index, validate(result) if validate else None):
+                        return result
+
+        async def ainvoke(inputs):
+            with Tracer.get().span('route', task=task) as span:
+                for index, (tier, chain) in enumerate(chains):
+                    try:
+                        result = await chain.ainvoke(inputs)
+                    except Exception as e:
+                        if ModelRouter._escalate(span, chains, index, repr(e)):
+                            continue
+                        raise
+                    if not ModelRouter._escalate(span, chains, index, validate(result) if validate else None):
+                        return result
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=f'route_{task}')
+
+    @staticmethod
+    def _escalate(span, chains, index, reason):
+        """
+        Record the outcome of the call to chains[index]. Returns True if the next tier should be tried.
+        """
+        tier = chains[index][0]
+        last = index == len(chains) - 1
+        if reason is None or last:
+            span.attributes.update({'tier': tier, 'valid': reason is None})
+            return False
+        print(f"Escalating {span.attributes['task']} from the {tier} model: {reason}")
+        span.add('escalations', 1)
+        return True
+
+    @staticmethod
+    def list_length(key, minimum, maximum):
+        """
+        Validator of a JSON result holding a list of minimum to maximum items under key.
+        """
+        def validate(result):
+            items = result.get(key) if isinstance(result, dict) else None
+            if not isinstance(items, list):
+                return f'no {key} list'
+            if not minimum <= len(items) <= maximum:
+                return f'{len(items)} {key}, expected {minimum} to {maximum}'
+            return None
+        return validate
+
+    @staticmethod
+    def latex_frames(result):
+        """
+        Validator of LaTeX slides: at least one frame, and balanced frame and document environments.
+        """
+        begins = len(re.findall(r'\\begin\{frame\}', result))
+        ends = len(re.findall(r'\\end\{frame\}', result))
+        if begins == 0:
+            return 'no frames'
+        if begins != ends:
+            return f'{begins} frames opened and {ends} closed'
+        if result.count(r'\begin{document}') != result.count(r'\end{document}'):
+            return 'unbalanced document environment'
+        return None
+
+    @staticmethod
+    def report(trace_paths):
+        """
+        Calls and escalations per task and tier, from the 'route' spans of trace files.
+
+        :return: Dictionary mapping tasks to {'calls', 'escalations', 'invalid', 'served': {tier: calls}}.
+        """
+        tasks = {}
+        for path in trace_paths:
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    span = json.loads(line)
+                    if span['name'] != 'route':
+                        continue
+                    attributes = {a['key']: next(iter(a['value'].values())) for a in span['attributes']}
+                    row = tasks.setdefault(attributes['task'], {'calls': 0, 'escalations': 0, 'invalid': 0, 'served': {}})
+                    row['calls'] += 1
+                    row['escalations'] += int(attributes.get('escalations', 0))
+                    row['invalid'] += int(attributes.get('valid') is False)
+                    if 'tier' in attributes:
+                        row['served'][attributes['tier']] = row['served'].get(attributes['tier'], 0) + 1
+        return tasks
@@ -0,0 +1,70 @@
+from langchain.output_parsers import OutputFixingParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import JsonOutputParser, XMLOutputParser
+
+from Crafty.pipeline.utils.repair import RepairUtil
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class LocalFixingParser(OutputFixingParser):
+    """
+    OutputFixingParser which first tries to repair malformed JSON or XML locally, and only asks
+    the model to fix the output when that fails. Outcomes are counted on the current trace span
+    as local_repairs and llm_repairs.
+    """
+
+    def repair(self, completion):
+        if isinstance(self.parser, JsonOutputParser):
+            return RepairUtil.repair_json(completion)
+        if isinstance(self.parser, XMLOutputParser):
+            return RepairUtil.repair_xml(completion)
+        return None
+
+    def _parse_locally(self, completion):
+        """
+        Parse the completion, repairing it locally if needed. Returns the result and the parse error, if any.
+        """
+        try:
+            result = self.parser.parse(completion)
+            # The JSON parser returns None instead of raising on output it cannot parse.
+            if result is not None:
+                return result, None
+            error = OutputParserException(f'Could not parse output: {completion}')
+        except OutputParserException as e:
+            error = e
+        repaired = self.repair(completion)
+        if repaired is not None:
+            try:
+                result = self.parser.parse(repaired)
+            except OutputParserException:
+                result = None
+            if result is not None:
+                Tracer.get().add('local_repairs')
+                return result, None
+        return None, error
+
+    def parse(self, completion):
+        result, error = self._parse_locally(completion)
+        retries = 0
+        while error is not None:
+            if retries == self.max_retries:
+                raise error
+            retries += 1
+            Tracer.get().add('llm_repairs')
+            completion = self.retry_chain.run(instructions=self.parser.get_format_instructions(),
+                                              completion=completion, error=repr(error))
+            result, error = self._parse_locally(completion)
+        return result
+
+    async def aparse(self, completion):
+        result, error = self._parse_locally(completion)
+        retries = 0
+        while error is not None:
+            if retries == self.max_retries:
+                raise error
+            retries += 1
+            Tracer.get().add('llm_repairs')
+            completion = await self.retry_chain.arun(instructions=self.parser.get_format_instructions(),
+                                                     completion=completion, error=repr(error))
+            result, error = self._parse_locally(completion)
+        return result
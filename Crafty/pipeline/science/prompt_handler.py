@@ -1,7 +1,9 @@
 import tiktoken  # Assuming tiktoken library is available for token encoding
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
-from pipeline.science.api_handler import ApiHandler
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.trace import Tracer
 
 class PromptHandler:
     def __init__(self, api_handler):
@@ -28,6 +30,60 @@ class PromptHandler:
         num_tokens = len(encoding.encode(string))
         return num_tokens
 
+    def prompt_tokens(self, template, inputs):
+        """
+        Number of tokens of the prompt rendered from a chat template with the given inputs.
+        """
+        messages = template.format_messages(**inputs)
+        # Every message carries a few tokens of formatting besides its content.
+        return sum(self.get_tokens_number_from_string(message.content) + 4 for message in messages)
+
+    def prompt_fits(self, template, inputs, model_name, reserve=None):
+        """
+        Whether the prompt fits the context window of a model, keeping reserve tokens for the response.
+        """
+        reserve = Config.OUTPUT_TOKEN_RESERVE if reserve is None else reserve
+        return self.prompt_tokens(template, inputs) + reserve <= self.get_model_context_window(model_name)
+
+    def input_budget(self, template, inputs, key, model_name, reserve=None):
+        """
+        Number of tokens left for inputs[key] by the rest of the prompt and the response in the context window of a model.
+        """
+        reserve = Config.OUTPUT_TOKEN_RESERVE if reserve is None else reserve
+        others = self.prompt_tokens(template, {**inputs, key: ''})
+        return self.get_model_context_window(model_name) - others - reserve
+
+    def select_model(self, template, inputs, model_names, reserve=None):
+        """
+        The first of model_names whose context window fits the prompt, or the last one if none does.
+        Skipping a model which would have failed with a context length error is logged.
+        """
+        for model_name in model_names:
+            if self.prompt_fits(template, inputs, model_name, reserve):
+                return model_name
+            if model_name != model_names[-1]:
+                print(f"Prompt of {self.prompt_tokens(template, inputs)} tokens does not fit the {model_name} model, skipping it.")
+                Tracer.get().add('avoided_overflows')
+        return model_names[-1]
+
+    def fit_inputs(self, template, inputs, key, model_name, reserve=None, summarize=False):
+        """
+        Inputs whose inputs[key] is trimmed, or summarized, so the prompt fits the context window of a model
+        before it is sent. Inputs which already fit are returned as they are.
+        """
+        if self.prompt_fits(template, inputs, model_name, reserve):
+            return inputs
+        budget = self.input_budget(template, inputs, key, model_name, reserve)
+        if budget <= 0:
+            raise ValueError(f"The prompt does not fit the {model_name} model even without {key}.")
+        print(f"Prompt does not fit the {model_name} model, {'summarizing' if summarize else 'trimming'} {key} to {budget} tokens.")
+        Tracer.get().add('avoided_overflows')
+        if summarize:
+            text = self.summarize_prompt(inputs[key], 'basic', custom_token_limit=min(budget, int(self.get_model_context_window('basic') / 4)))
+        else:
+            text = self.split_prompt(inputs[key], model_name, custom_token_limit=budget, return_first_chunk_only=True)[0]
+        return {**inputs, key: text}
+
     def split_prompt(self, input_text, model_name, encoding_name="cl100k_base", custom_token_limit=None, return_first_chunk_only=False):
         """
         Prepares the input prompt to fit within a specified token limit by dividing it into chunks
@@ -0,0 +1,88 @@
+import os
+import time
+import tomllib
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from Crafty.pipeline.science.output_fixing import LocalFixingParser
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'prompts')
+
+
+class PromptRegistry:
+    """
+    Prompt templates of the pipeline steps, loaded from data files and compiled once per process.
+
+    The templates of a step in a language are stored in prompts/<language>/<step>.toml, one table per
+    variant with a `template` key. Supporting a new language only means adding its directory.
+    A variant may name another table in a `prefix` key, whose template is put in front of its own.
+    Variants sharing a prefix start with the same bytes for the same inputs, so providers with
+    prompt prefix caching serve that part of repeated calls (e.g. per slide) from their cache.
+    Chains are built once per (step, language, variant, model, parser) and reused, e.g. for every slide.
+    """
+
+    _templates = {}
+    _chains = {}
+    build_time = 0.0
+
+    @classmethod
+    def templates(cls, step, language):
+        """
+        All compiled templates of a step in a language, by variant.
+        """
+        key = (step, language)
+        if key not in cls._templates:
+            start = time.perf_counter()
+            path = os.path.join(PROMPTS_DIR, language, step + '.toml')
+            if not os.path.exists(path):
+                raise ValueError(f"Language {language} is not supported for step {step}.")
+            with open(path, 'rb') as file:
+                data = tomllib.load(file)
+            cls._templates[key] = {variant: ChatPromptTemplate.from_template(
+                                       data[entry['prefix']]['template'] + entry['template'] if 'prefix' in entry else entry['template'])
+                                   for variant, entry in data.items()}
+            cls.build_time += time.perf_counter() - start
+        return cls._templates[key]
+
+    @classmethod
+    def template(cls, step, language, variant):
+        return cls.templates(step, language)[variant]
+
+    @classmethod
+    def chain(cls, step, language, variant, llm, parser, fixing_llm):
+        """
+        The chain prompting llm with the template and parsing the response. Malformed responses are
+        repaired locally, or fixed by fixing_llm if that fails.
+
+        :param parser: Output parser class, e.g. StrOutputParser.
+        """
+        # The registry keeps the models alive through the chains, so their ids are not reused.
+        key = (step, language, variant, id(llm), parser, id(fixing_llm))
+        if key not in cls._chains:
+            template = cls.template(step, language, variant)
+            start = time.perf_counter()
+            error_parser = LocalFixingParser.from_llm(parser=parser(), llm=fixing_llm)
+            cls._chains[key] = template | llm | error_parser
+            cls.build_time += time.perf_counter() - start
+        return cls._chains[key]
+
+    @classmethod
+    def structured_chain(cls, step, language, variant, llm, schema):
+        """
+        The chain prompting llm with the template, with the response shape declared to the model as
+        a JSON schema and validated locally. Returns the response as a dict.
+
+        :param schema: Pydantic model of the response.
+        """
+        key = (step, language, variant, id(llm), schema)
+        if key not in cls._chains:
+            template = cls.template(step, language, variant)
+            start = time.perf_counter()
+            cls._chains[key] = template | llm.with_structured_output(schema) | (lambda response: response.dict())
+            cls.build_time += time.perf_counter() - start
+        return cls._chains[key]
+
+    @classmethod
+    def report(cls):
+        templates = sum(len(variants) for variants in cls._templates.values())
+        return f'Prompt registry: {templates} templates and {len(cls._chains)} chains built in {cls.build_time:.3f}s'
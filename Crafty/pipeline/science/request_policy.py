@@ -0,0 +1,158 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+import time
+from collections import deque
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.single_flight import SingleFlight
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class RequestPolicy:
+    """
+    Deadline and hedging of the model calls of a step, from its budget in Config.REQUEST_BUDGETS.
+
+    Every call is cancelled once it runs past the deadline. With hedging, a duplicate of a call which
+    is still running after the p95 latency of its task is sent, and the first result is taken. Hedging
+    only starts once enough latencies of the task were seen, and is meant for idempotent calls.
+    """
+
+    # Recent latencies by task, shared by all steps of the process.
+    _latencies = {}
+    _lock = threading.Lock()
+    # Threads of the calls made from synchronous code. A call which runs past its deadline is left to finish here.
+    _executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='crafty-request')
+
+    def __init__(self, deadline, hedge=False, hedge_quantile=0.95, min_samples=20, min_hedge_delay=1.0):
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.min_hedge_delay = min_hedge_delay
+
+    @classmethod
+    def for_step(cls, step):
+        return cls(**{**Config.REQUEST_BUDGETS['default'], **Config.REQUEST_BUDGETS.get(step, {})})
+
+    @classmethod
+    def record(cls, task, seconds):
+        with cls._lock:
+            cls._latencies.setdefault(task, deque(maxlen=Config.REQUEST_LATENCY_WINDOW)).append(seconds)
+
+    @classmethod
+    def latencies(cls, task):
+        """
+        Sorted copy of the recent latencies of a task, taken under the lock record writes them under.
+        """
+        with cls._lock:
+            return sorted(cls._latencies.get(task, ()))
+
+    @staticmethod
+    def _quantile(latencies, q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    @classmethod
+    def quantile(cls, task, q):
+        latencies = cls.latencies(task)
+        if not latencies:
+            return None
+        return cls._quantile(latencies, q)
+
+    def hedge_delay(self, task):
+        """
+        Seconds after which a duplicate of a call is sent, or None if the call is not hedged.
+        """
+        if not self.hedge:
+            return None
+        latencies = self.latencies(task)
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, self._quantile(latencies, self.hedge_quantile))
+
+    def wrap(self, chain, task):
+        """
+        Runnable running chain under the policy, for invoke, batch and their async variants.
+        """
+        def invoke(inputs):
+            return self.invoke(chain, inputs, task)
+
+        async def ainvoke(inputs):
+            return await self.ainvoke(chain, inputs, task)
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=f'policy_{task}')
+
+    async def ainvoke(self, chain, inputs, task):
+        start = time.perf_counter()
+
+        async def call(hedge=False):
+            # The duplicate must reach the model, not wait for the call it hedges.
+            SingleFlight.bypass.set(hedge)
+            sent = time.perf_counter()
+            result = await chain.ainvoke(inputs)
+            self.record(task, time.perf_counter() - sent)
+            return result
+
+        calls = [asyncio.ensure_future(call())]
+        try:
+            delay = self.hedge_delay(task)
+            done, _ = await asyncio.wait(calls, timeout=min(delay, self.deadline) if delay is not None else self.deadline)
+            if not done and delay is not None and delay < self.deadline:
+                Tracer.get().add('hedges')
+                calls.append(asyncio.ensure_future(call(hedge=True)))
+            while not done or (all(c.exception() is not None for c in done) and len(done) < len(calls)):
+                remaining = self.deadline - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(calls, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            return self._first_result(calls, done, task)
+        finally:
+            for c in calls:
+                c.cancel()
+
+    def invoke(self, chain, inputs, task):
+        start = time.perf_counter()
+
+        def call(hedge=False):
+            SingleFlight.bypass.set(hedge)
+            sent = time.perf_counter()
+            result = chain.invoke(inputs)
+            self.record(task, time.perf_counter() - sent)
+            return result
+
+        def submit(hedge=False):
+            # Run in a copy of the caller's context, so the model call is traced within the running step.
+            return self._executor.submit(contextvars.copy_context().run, call, hedge)
+
+        calls = [submit()]
+        try:
+            delay = self.hedge_delay(task)
+            done, _ = concurrent.futures.wait(calls, timeout=min(delay, self.deadline) if delay is not None else self.deadline)
+            if not done and delay is not None and delay < self.deadline:
+                Tracer.get().add('hedges')
+                calls.append(submit(hedge=True))
+            while not done or (all(c.exception() is not None for c in done) and len(done) < len(calls)):
+                remaining = self.deadline - (time.perf_counter() - start)
+                if remaining <= 0:
+                    break
+                done, _ = concurrent.futures.wait(calls, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            return self._first_result(calls, done, task)
+        finally:
+            for c in calls:
+                c.cancel()
+
+    def _first_result(self, calls, done, task):
+        """
+        The result of the first successful call, or the error of the first failed one.
+        """
+        finished = [c for c in calls if c in done]
+        for c in finished:
+            if c.exception() is None:
+                return c.result()
+        if finished:
+            raise finished[0].exception()
+        Tracer.get().add('timeouts')
+        raise TimeoutError(f'{task} did not respond within its {self.deadline}s deadline')
@@ -0,0 +1,120 @@
+from functools import lru_cache
+from typing import List
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.pydantic_v1 import BaseModel, Field, ValidationError, conlist, create_model
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class CourseTopic(BaseModel):
+    """The course a student wants to learn."""
+    context: str = Field(description='Restrictive description of the course')
+    level: str = Field(description='Level of the course')
+    subject: str = Field(description='General topic of the course')
+    zero_shot_topic: str = Field(description='Topic of the course combining context, subject and text')
+
+
+class CourseChapters(BaseModel):
+    """Textbooks of a course and its chapters in teaching order."""
+    course_name: str = Field(description='Name of the course')
+    textbooks: List[str] = Field(default_factory=list, description='Popular textbooks about the course')
+    authors: List[str] = Field(default_factory=list, description='Authors of the textbooks')
+    Chapters: conlist(str, min_items=5, max_items=10) = Field(description='Chapter names')
+
+
+class ShortCourseChapters(CourseChapters):
+    """Textbooks of a short course and its chapters in teaching order."""
+    Chapters: conlist(str, min_items=1, max_items=5) = Field(description='Chapter names')
+
+
+class CraftCourseChapters(CourseChapters):
+    """Textbook of a course and its chapters, without chapter numbers."""
+    Chapters: conlist(str, min_items=6, max_items=15) = Field(description='Chapter names')
+
+
+class ChapterSections(BaseModel):
+    """Sections of a chapter."""
+
+
+class CourseSections(BaseModel):
+    """Unique sections of every chapter, one list per chapter."""
+
+
+@lru_cache(maxsize=None)
+def chapter_sections(max_sections):
+    """
+    Schema of the sections of one chapter. Built once per bound, so chains using it are cached.
+    """
+    return create_model('ChapterSections', __base__=ChapterSections,
+                        sections=(conlist(str, min_items=5, max_items=max_sections), Field(description='Section names')))
+
+
+@lru_cache(maxsize=None)
+def course_sections(chapters):
+    """
+    Schema of the sections of every chapter, one list per chapter.
+    """
+    return create_model('CourseSections', __base__=CourseSections,
+                        sections=(conlist(List[str], min_items=chapters, max_items=chapters),
+                                  Field(description='Section names of each chapter')))
+
+
+# Errors of a response which does not match its schema, as opposed to errors of the API call.
+INVALID_OUTPUT = (ValidationError, OutputParserException)
+
+
+def invoke_validated(chain, inputs, attempts=None):
+    """
+    Invoke a structured chain, calling it again only while its response does not validate.
+    """
+    return batch_validated(chain, [inputs], attempts)[0]
+
+
+def batch_validated(chain, inputs, attempts=None):
+    """
+    Run a structured chain on every input. Only the items whose response does not validate are sent again,
+    the others are kept.
+    """
+    results = chain.batch(inputs, return_exceptions=True)
+    for _ in range((attempts or Config.STRUCTURED_OUTPUT_ATTEMPTS) - 1):
+        failed = _failed(results)
+        if not failed:
+            break
+        Tracer.get().add('retries', len(failed))
+        for i, result in zip(failed, chain.batch([inputs[i] for i in failed], return_exceptions=True)):
+            results[i] = result
+    return _raise_failed(results)
+
+
+async def ainvoke_validated(chain, inputs, attempts=None):
+    return (await abatch_validated(chain, [inputs], attempts))[0]
+
+
+async def abatch_validated(chain, inputs, attempts=None):
+    results = await chain.abatch(inputs, return_exceptions=True)
+    for _ in range((attempts or Config.STRUCTURED_OUTPUT_ATTEMPTS) - 1):
+        failed = _failed(results)
+        if not failed:
+            break
+        Tracer.get().add('retries', len(failed))
+        for i, result in zip(failed, await chain.abatch([inputs[i] for i in failed], return_exceptions=True)):
+            results[i] = result
+    return _raise_failed(results)
+
+
+def _failed(results):
+    failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+    # Errors other than invalid output (e.g. authentication) are not retried here.
+    for i in failed:
+        if not isinstance(results[i], INVALID_OUTPUT):
+            raise results[i]
+    return failed
+
+
+def _raise_failed(results):
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
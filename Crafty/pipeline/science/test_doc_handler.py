@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+
+import fitz
+
+from Crafty.pipeline.science.doc_handler import DocHandler
+
+
+TOC = [
+    [1, 'Preface', 3],
+    [1, 'Part I Mechanics', 5],
+    [2, 'Chapter 1: Kinematics', 5],
+    [3, '1.1 Position and displacement', 6],
+    [3, '1.2 Velocity', 9],
+    [3, 'Exercises', 12],
+    [2, 'Chapter 2: Dynamics', 13],
+    [3, '2.1 Newton\'s laws', 13],
+    [1, 'Part II Waves', 20],
+    [2, 'Chapter 3: Oscillations', 20],
+    [2, '4 3D Waves', 26],
+    [1, 'Index', 30],
+]
+
+
+class TestOutline(unittest.TestCase):
+
+    def test_chapters_are_the_first_level_below_the_parts(self):
+        outline = DocHandler.outline_from_toc(TOC, 32)
+        self.assertEqual(['Kinematics', 'Dynamics', 'Oscillations', '3D Waves'], [chapter['title'] for chapter in outline])
+        self.assertEqual(['Position and displacement', 'Velocity'], [section['title'] for section in outline[0]['sections']])
+        self.assertEqual([], outline[2]['sections'])
+
+    def test_entries_run_to_the_next_one(self):
+        outline = DocHandler.outline_from_toc(TOC, 32)
+        self.assertEqual((5, 12), (outline[0]['start_page'], outline[0]['end_page']))
+        self.assertEqual((9, 11), (outline[0]['sections'][1]['start_page'], outline[0]['sections'][1]['end_page']))
+        # The last chapter ends before the index.
+        self.assertEqual(29, outline[3]['end_page'])
+
+    def test_outline_without_enough_chapters_is_not_used(self):
+        self.assertIsNone(DocHandler.outline_from_toc([[1, 'Introduction', 1], [1, 'Index', 2]], 2))
+        self.assertIsNone(DocHandler.outline_from_toc([], 10))
+
+    def test_outline_is_read_from_the_pdf_bookmarks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'book.pdf')
+            with fitz.open() as document:
+                for _ in range(32):
+                    document.new_page()
+                document.set_toc(TOC)
+                document.save(path)
+            handler = DocHandler.__new__(DocHandler)
+            handler.course_meta_dir = tmp_dir
+            outlines = handler.locate_and_save_outlines([path], ['book.pdf'])
+            self.assertEqual(4, len(outlines[0]))
+            with open(os.path.join(tmp_dir, 'book.pdf_outline.json'), encoding='utf-8') as file:
+                self.assertEqual(outlines[0], json.load(file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.science.model_router import ModelRouter
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class TestModelRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def tier(self, name, chapters):
+        """
+        Fake model tier answering with the given number of chapters, or failing if it is None.
+        """
+        def respond(inputs):
+            self.calls.append(name)
+            if chapters is None:
+                raise ValueError('context length exceeded')
+            return {'Chapters': [f'Chapter {i}' for i in range(chapters)]}
+        return name, RunnableLambda(respond)
+
+    def test_escalates_only_when_invalid(self):
+        validate = ModelRouter.list_length('Chapters', 5, 10)
+        cascade = ModelRouter.cascade('chapters', [self.tier('basic', 6), self.tier('advance', 8)], validate)
+        self.assertEqual(6, len(cascade.invoke({})['Chapters']))
+        cascade = ModelRouter.cascade('chapters', [self.tier('basic', 3), self.tier('advance', 8)], validate)
+        self.assertEqual(8, len(cascade.invoke({})['Chapters']))
+        self.assertEqual(['basic', 'basic', 'advance'], self.calls)
+
+    def test_escalates_on_errors_in_batches(self):
+        cascade = ModelRouter.cascade('chapters', [self.tier('basic', None), self.tier('advance', 8)])
+        results = asyncio.run(cascade.abatch([{}, {}]))
+        self.assertEqual([8, 8], [len(result['Chapters']) for result in results])
+
+    def test_last_tier_result_is_returned_even_if_invalid(self):
+        cascade = ModelRouter.cascade('chapters', [self.tier('advance', 3)], ModelRouter.list_length('Chapters', 5, 10))
+        self.assertEqual(3, len(cascade.invoke({})['Chapters']))
+
+    def test_report_escalation_rates(self):
+        validate = ModelRouter.list_length('Chapters', 5, 10)
+        with Tracer.get().span('step', course_id='course', step='chapters'):
+            for chapters in (6, 3, 7, 2):
+                ModelRouter.cascade('chapters', [self.tier('basic', chapters), self.tier('advance', 4)], validate).invoke({})
+        tasks = ModelRouter.report([os.path.join(self.tmp_dir.name, 'course', Config.TRACE_FILE)])
+        self.assertEqual({'calls': 4, 'escalations': 2, 'invalid': 2, 'served': {'basic': 2, 'advance': 2}},
+                         tasks['chapters'])
+
+    def test_latex_frames(self):
+        self.assertIsNone(ModelRouter.latex_frames('\\begin{frame}a\\end{frame}'))
+        self.assertEqual('2 frames opened and 1 closed',
+                         ModelRouter.latex_frames('\\begin{frame}a\\end{frame}\\begin{frame}b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from langchain.prompts import ChatPromptTemplate
+
+from Crafty.config import Config
+from Crafty.pipeline.science.prompt_handler import PromptHandler
+
+
+class TestPromptBudget(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(Config, 'OUTPUT_TOKEN_RESERVE', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        api = SimpleNamespace(models={'basic': {'context_window': 40}, 'advance': {'context_window': 200}})
+        self.prompt = PromptHandler(api)
+        # One token per word, so the tests do not need the tiktoken encodings.
+        self.prompt.get_tokens_number_from_string = lambda string, encoding_name='cl100k_base': len(string.split())
+        self.template = ChatPromptTemplate.from_template('Summarize these notes: {notes}')
+
+    def test_prompt_tokens(self):
+        self.assertEqual(3 + 2 + 4, self.prompt.prompt_tokens(self.template, {'notes': 'two words'}))
+
+    def test_select_model_skips_windows_too_small(self):
+        short = {'notes': 'word ' * 10}
+        long = {'notes': 'word ' * 50}
+        self.assertEqual('basic', self.prompt.select_model(self.template, short, ('basic', 'advance')))
+        self.assertEqual('advance', self.prompt.select_model(self.template, long, ('basic', 'advance')))
+        self.assertEqual('advance', self.prompt.select_model(self.template, {'notes': 'word ' * 500}, ('basic', 'advance')))
+
+    def test_fit_inputs_trims_to_the_budget(self):
+        inputs = {'notes': 'word ' * 100}
+        fitted = self.prompt.fit_inputs(self.template, inputs, 'notes', 'basic')
+        self.assertTrue(self.prompt.prompt_fits(self.template, fitted, 'basic'))
+        self.assertEqual(40 - 7 - 10, len(fitted['notes'].split()))
+        self.assertIs(inputs, self.prompt.fit_inputs(self.template, inputs, 'notes', 'advance'))
+
+
+if __name__ == '__main__':
+    unittest.main()
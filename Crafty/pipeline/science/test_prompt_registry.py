@@ -0,0 +1,49 @@
+import os
+import unittest
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.output_parsers import StrOutputParser
+
+from Crafty.pipeline.science.prompt_registry import PROMPTS_DIR, PromptRegistry
+
+
+class TestPromptRegistry(unittest.TestCase):
+
+    def test_languages_define_the_same_variants(self):
+        languages = sorted(os.listdir(PROMPTS_DIR))
+        self.assertIn('en', languages)
+        for step_file in os.listdir(os.path.join(PROMPTS_DIR, 'en')):
+            step = step_file[:-len('.toml')]
+            variants = {language: set(PromptRegistry.templates(step, language)) for language in languages}
+            self.assertEqual(1, len({frozenset(v) for v in variants.values()}), f'{step}: {variants}')
+
+    def test_templates_are_compiled_once(self):
+        first = PromptRegistry.template('script', 'en', 'content_slide_draft')
+        self.assertIs(first, PromptRegistry.template('script', 'en', 'content_slide_draft'))
+        self.assertIn('slide_text', first.input_variables)
+
+    def test_chains_are_built_once_per_model(self):
+        llm = FakeListChatModel(responses=['A script.'])
+        other = FakeListChatModel(responses=['Another script.'])
+        chain = PromptRegistry.chain('script', 'en', 'short_first_slide', llm, StrOutputParser, llm)
+        self.assertIs(chain, PromptRegistry.chain('script', 'en', 'short_first_slide', llm, StrOutputParser, llm))
+        self.assertIsNot(chain, PromptRegistry.chain('script', 'en', 'short_first_slide', other, StrOutputParser, llm))
+        self.assertEqual('A script.', chain.invoke({'zero_shot_topic': 'Physics', 'slide_text': 'Title'}))
+
+    def test_variants_sharing_a_prefix_start_alike(self):
+        inputs = {'zero_shot_topic': 'Physics', 'chapter': 'Mechanics', 'notes_set_number': 1,
+                  'notes_set': 'Newton laws.', 'page_number': 10, 'tex_template': '', 'numbered_slides': ''}
+        for language in ('en', 'zh'):
+            draft = PromptRegistry.template('slides', language, 'full_slides_draft').format(**inputs)
+            refine = PromptRegistry.template('slides', language, 'full_slides_refine').format(**inputs)
+            prefix = PromptRegistry.template('slides', language, 'chapter_context').format(**inputs)
+            self.assertTrue(draft.startswith(prefix) and refine.startswith(prefix))
+            self.assertIn('Newton laws.', prefix)
+
+    def test_unknown_language(self):
+        with self.assertRaises(ValueError):
+            PromptRegistry.template('script', 'xx', 'short_first_slide')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.science.request_policy import RequestPolicy
+
+
+class TestRequestPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(RequestPolicy, '_latencies', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def model(self, delays):
+        """
+        Fake model whose n-th call takes delays[n] seconds.
+        """
+        def respond(inputs):
+            self.calls += 1
+            time.sleep(delays[self.calls - 1])
+            return f'call {self.calls}'
+
+        async def arespond(inputs):
+            self.calls += 1
+            await asyncio.sleep(delays[self.calls - 1])
+            return f'call {self.calls}'
+        return RunnableLambda(respond, afunc=arespond)
+
+    def test_deadline(self):
+        policy = RequestPolicy(deadline=0.1)
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            policy.invoke(self.model([1]), {}, 'notes.expansions')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        with self.assertRaises(TimeoutError):
+            asyncio.run(policy.ainvoke(self.model([0, 1]), {}, 'notes.expansions'))
+
+    def test_hedges_after_p95_latency(self):
+        policy = RequestPolicy(deadline=5, hedge=True, min_samples=5, min_hedge_delay=0.05)
+        for _ in range(5):
+            RequestPolicy.record('script.content_slide_draft', 0.05)
+        self.assertEqual(0.05, policy.hedge_delay('script.content_slide_draft'))
+        # The first call is stuck, the duplicate sent after 0.05s answers.
+        self.assertEqual('call 2', policy.invoke(self.model([1, 0]), {}, 'script.content_slide_draft'))
+        self.calls = 0
+        self.assertEqual('call 2', asyncio.run(policy.ainvoke(self.model([1, 0]), {}, 'script.content_slide_draft')))
+
+    def test_no_hedging_without_enough_latencies(self):
+        policy = RequestPolicy(deadline=5, hedge=True, min_samples=5)
+        self.assertIsNone(policy.hedge_delay('slides.full_slides_draft'))
+        self.assertEqual('call 1', policy.wrap(self.model([0.01]), 'slides.full_slides_draft').invoke({}))
+        self.assertEqual(1, self.calls)
+
+
+    def test_hedge_delay_while_latencies_are_recorded(self):
+        policy = RequestPolicy(deadline=5, hedge=True, min_samples=5, min_hedge_delay=0)
+        stop = threading.Event()
+
+        def record():
+            while not stop.is_set():
+                RequestPolicy.record('notes.expansions', 0.1)
+        writers = [threading.Thread(target=record) for _ in range(4)]
+        for writer in writers:
+            writer.start()
+        try:
+            for _ in range(2000):
+                policy.hedge_delay('notes.expansions')
+        finally:
+            stop.set()
+            for writer in writers:
+                writer.join()
+        self.assertEqual(0.1, policy.hedge_delay('notes.expansions'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+from langchain_core.pydantic_v1 import ValidationError
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.pipeline.science.structured_output import (CraftCourseChapters, abatch_validated, batch_validated,
+                                                       chapter_sections, course_sections)
+
+
+class TestSchemas(unittest.TestCase):
+
+    def test_chapter_count_is_bounded(self):
+        chapters = {'course_name': 'Calculus', 'Chapters': [f'Chapter {i}' for i in range(6)]}
+        self.assertEqual(6, len(CraftCourseChapters.parse_obj(chapters).Chapters))
+        with self.assertRaises(ValidationError):
+            CraftCourseChapters.parse_obj(dict(chapters, Chapters=chapters['Chapters'][:5]))
+
+    def test_section_schemas_are_cached_per_bound(self):
+        self.assertIs(chapter_sections(10), chapter_sections(10))
+        with self.assertRaises(ValidationError):
+            chapter_sections(6).parse_obj({'sections': list('abcdefg')})
+        with self.assertRaises(ValidationError):
+            course_sections(3).parse_obj({'sections': [['a'], ['b']]})
+
+
+class TestValidatedBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def respond(self, chapter):
+        """
+        Fake structured chain, the response for chapter 'b' only validates on the second call.
+        """
+        self.calls.append(chapter)
+        sections = ['x'] * (2 if chapter == 'b' and self.calls.count('b') == 1 else 5)
+        return chapter_sections(10).parse_obj({'sections': sections}).dict()
+
+    def test_only_failing_items_are_retried(self):
+        results = batch_validated(RunnableLambda(self.respond), ['a', 'b', 'c'])
+        self.assertEqual([5, 5, 5], [len(result['sections']) for result in results])
+        self.assertEqual(['a', 'b', 'b', 'c'], sorted(self.calls))
+
+    def test_async_batch(self):
+        results = asyncio.run(abatch_validated(RunnableLambda(self.respond), ['a', 'b']))
+        self.assertEqual(2, len(results))
+        self.assertEqual(3, len(self.calls))
+
+    def test_gives_up_after_attempts(self):
+        with self.assertRaises(ValidationError):
+            batch_validated(RunnableLambda(self.respond), ['b'], attempts=1)
+
+    def test_other_errors_are_not_retried(self):
+        def fail(_):
+            self.calls.append(_)
+            raise ConnectionError('offline')
+        with self.assertRaises(ConnectionError):
+            batch_validated(RunnableLambda(fail), ['a'])
+        self.assertEqual(1, len(self.calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,12 @@
+import asyncio
 import json
 import os
 
 import click
-from langchain.output_parsers import OutputFixingParser
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.manifest import Manifest
 from Crafty.pipeline.utils.tex import TexUtil
 
 
@@ -27,127 +27,106 @@ class Script(PipelineStep):
             self.chapter = para['chapter']
             self.read_meta_data_from_file()
 
-    def execute(self):
+    async def execute_async(self):
         if self.chapter is None or self.chapter < 0:
             raise ValueError("Chapter number is not provided or invalid.")
 
-        if(self.short_video == True):
-            self.create_scripts_short(self.chapter)
-        else:
-            self.create_scripts(self.chapter)
+        await self.generate_scripts(self.chapter)
+
+    def artifact_inputs(self):
+        return super().artifact_inputs() + [self.videos_dir + f'full_slides_for_notes_set{self.chapter}.tex']
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({'topic': self.zero_shot_topic,
+                       'chapter': self.chapters_list[self.chapter],
+                       'short_video': self.short_video})
+        return params
 
-    def create_scripts_short(self, notes_set_number=-1):
+    def artifact_outputs(self):
+        return [self.videos_dir + f'scripts_for_notes_set{self.chapter}.json']
+
+    def artifact_fingerprints(self):
+        tex_path = self.videos_dir + f'full_slides_for_notes_set{self.chapter}.tex'
+        if not os.path.exists(tex_path):
+            return {}
+        with open(tex_path, 'r') as file:
+            slide_texts = TexUtil.parse_latex_slides_raw(file.read())
+        return {'slides': self.slide_fingerprints(slide_texts)}
+
+    def slide_fingerprints(self, slide_texts):
         """
-        Generate scripts for short videos.
+        Fingerprint of everything the script of each slide is generated from: the slide, the next slide
+        (used as outline or reference), the position of the slide and the chapter.
         """
-        directory = self.notes_dir + f'notes_set{notes_set_number}.xml'
-        if os.path.exists(directory):
-            with open(directory, 'r') as xml_file:
-                notes_set = xml_file.read()
+        context = [self.language, self.zero_shot_topic, self.chapters_list[self.chapter], self.short_video]
+        last = len(slide_texts) - 1
+        return [Manifest.value_hash(context + [slide_texts[i], slide_texts[min(i + 1, last)],
+                                               i == 0, i == 1, i == last - 1, i == last])
+                for i in range(len(slide_texts))]
 
-        # Load in the simple full slides if they exist
-        if os.path.exists(self.videos_dir + f'full_slides_for_notes_set{notes_set_number}' + ".tex"):
-            with open(self.videos_dir + f'full_slides_for_notes_set{notes_set_number}' + ".tex", 'r') as file:
-                full_slides = file.read()
-        else:
-            raise FileNotFoundError(f"Full slides file not found in {self.videos_dir}")
+    def previous_scripts(self, notes_set_number):
+        """
+        Scripts of the previous build by slide fingerprint, including the scripts edited by hand since.
+        """
+        file_path = self.videos_dir + f'scripts_for_notes_set{notes_set_number}' + ".json"
+        fingerprints = self.previous_fingerprints('slides')
+        if not os.path.exists(file_path):
+            return {}
+        with open(file_path, 'r') as file:
+            scripts = json.load(file)
+        if len(scripts) != len(fingerprints):
+            return {}
+        return dict(zip(fingerprints, scripts))
+
+    async def generate_scripts(self, notes_set_number=-1, on_script=None, concurrency=1):
+        """
+        Generate the script of each slide in the full slides LaTeX file of the notes set number, reusing the
+        scripts of the slides which did not change since the last build. The scripts are saved once all are done.
 
-        slide_texts_temp = TexUtil.parse_latex_slides(full_slides)
-        click.echo(f"The content of the slides are: {slide_texts_temp}")
-        slide_texts = TexUtil.parse_latex_slides_raw(full_slides)
-        click.echo(f"Number of slides pages are: {len(slide_texts)}")
+        :param on_script: Optional coroutine function called with (index, script) as soon as the script of a
+            slide is ready, e.g. to voice it while the other slides are scripted. Slides may finish out of order.
+        :param concurrency: Number of slides scripted at once.
+        :return: The scripts of the slides, in order.
+        """
+        notes_set, slide_texts_temp, slide_texts = self.load_slides(notes_set_number)
 
-        chapter_scripts = []
-        slides = []
-
-        print("len(slide_texts): ", len(slide_texts))
-
-        for i in range(len(slide_texts)):
-            if (i == 0):
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching course {zero_shot_topic}.
-                        Please generate a brief script for the first slide page: ```{slide_text}```.
-
-                        Requirements:
-                        1. Reply a fluent sentence with no more than 20 words.
-                        2. Try to be brief and concise.
-                        3. The response only has the information related to the slide.
-                        4. No more pleasantries
-                        """)
-                elif(self.language == 'zh'):
-                    prompt = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为第一页幻灯片生成简短的脚本：```{slide_text}```。
-
-                        要求：
-                        1. 回答流利的句子，不超过20个字。
-                        2. 尽量简洁明了。
-                        3. 回答只包含与幻灯片相关的信息。
-                        4. 不要有多余的客套话。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain = prompt | self.llm | error_parser
-                scripts = chain.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                        'notes_set': notes_set,
-                                        'slide_text': slide_texts[i],
-                                        'chapter': self.chapters_list[notes_set_number]})
+        chapter_scripts = [None] * len(slide_texts)
+        fingerprints = self.slide_fingerprints(slide_texts)
+        previous_scripts = self.previous_scripts(notes_set_number)
+        semaphore = asyncio.Semaphore(concurrency)
 
+        async def script(i):
+            if fingerprints[i] in previous_scripts:
+                chapter_scripts[i] = previous_scripts[fingerprints[i]]
+                click.echo(f"Scripts reused for unchanged slide {i}")
             else:
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching course {zero_shot_topic}.
-                        Please generate a brief script for a content slide page: ```{slide_text}```.
-                        
-                        Requirements:
-                        1. Reply a fluent sentence with no more than 20 words.
-                        2. Try to be brief and concise.
-                        3. The response only has the information related to the slide.
-                        4. No more pleasantries
-                        """)
-                elif(self.language == 'zh'):
-                    prompt = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为内容幻灯片生成简短的脚本：```{slide_text}```。
-
-                        要求：
-                        1. 回答流利的句子，不超过20个字。
-                        2. 尽量简洁明了。
-                        3. 回答只包含与幻灯片相关的信息。
-                        4. 不要有多余的客套话。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain = prompt | self.llm | error_parser
-                scripts = chain.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                        'notes_set': notes_set,
-                                        'slide_text': slide_texts[i],
-                                        'chapter': self.chapters_list[notes_set_number]})
-                
-            chapter_scripts.append(scripts)
-            slides.append(slide_texts[i])
-            click.echo(f"Scripts generated for slide {i}")
+                async with semaphore:
+                    if(self.short_video == True):
+                        chapter_scripts[i] = await self.short_slide_script(i, notes_set, slide_texts, notes_set_number)
+                    else:
+                        chapter_scripts[i] = await self.slide_script(i, notes_set, slide_texts, slide_texts_temp, notes_set_number)
+                click.echo(f"Scripts generated for slide {i}")
+            if on_script is not None:
+                await on_script(i, chapter_scripts[i])
+
+        if concurrency == 1:
+            for i in range(len(slide_texts)):
+                await script(i)
+        else:
+            await asyncio.gather(*(script(i) for i in range(len(slide_texts))))
 
         file_path = self.videos_dir + f'scripts_for_notes_set{notes_set_number}' + ".json"
         with open(file_path, 'w', encoding='utf-8') as file:
             json.dump(chapter_scripts, file, indent=2, ensure_ascii=False)
         click.echo(f"Scripts for note set {notes_set_number} are saved to: {file_path}")
+        return chapter_scripts
 
-    def create_scripts(self, notes_set_number=-1):
+    def load_slides(self, notes_set_number):
         """
-        Generate scripts for each slide in the full slides LaTeX file based on the notes set number.
-        The scripts are generated by calling the LLM model with a specific prompt for each slide (depending on the position of that slide).
+        The notes set of the chapter, and the text and raw LaTeX of each of its slides.
         """
-
+        notes_set = None
         directory = self.notes_dir + f'notes_set{notes_set_number}.xml'
         if os.path.exists(directory):
             with open(directory, 'r') as xml_file:
@@ -164,407 +143,124 @@ class Script(PipelineStep):
         click.echo(f"The content of the slides are: {slide_texts_temp}")
         slide_texts = TexUtil.parse_latex_slides_raw(full_slides)
         click.echo(f"Number of slides pages are: {len(slide_texts)}")
+        return notes_set, slide_texts_temp, slide_texts
 
-        chapter_scripts = []
-        slides = []
-
-        for i in range(len(slide_texts)):
-            # Send the prompt to the API and get a response
-            # 3. If needed you can refer to the previous context of slides: ```{previous_context}``` as a reference.
-            # but this is only for getting smoother transition between slides.
-            if (i == 0):
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please generate a brief script for a presentation start with slide: ```{slide_text}``` and ouline: ```{outline}```.
-                        No more than 20 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. Try to be brief and concise.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片开始生成简短的脚本：```{slide_text}```和大纲：```{outline}```。
-                        不超过20个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_1 = prompt_1 | self.llm | error_parser
-                scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                                 'notes_set': notes_set,
-                                                 'slide_text': slide_texts[i],
-                                                 'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
-                                                 'chapter': self.chapters_list[notes_set_number]})
-
-                if(self.language == 'en'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}```.
-                        No more than 20 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片开始生成简短的脚本：```{slide_text}```和大纲：```{outline}```。
-                        不超过20个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_2 = prompt_2 | self.llm | error_parser
-                scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                          'notes_set': notes_set,
-                                          'slide_text': slide_texts[i],
-                                          'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
-                                          'chapter': self.chapters_list[notes_set_number],
-                                          'scripts_temp_1': scripts_temp_1})
+    async def short_slide_script(self, i, notes_set, slide_texts, notes_set_number):
+        """
+        Script of slide i of a short video.
+        """
+        if (i == 0):
+            chain = self.chain('short_first_slide', StrOutputParser, self.llm)
+            scripts = await chain.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                    'notes_set': notes_set,
+                                    'slide_text': slide_texts[i],
+                                    'chapter': self.chapters_list[notes_set_number]})
 
-            elif (i == 1):
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please generate a brief script for the outline page in a presentation: ```{slide_text}```.
-                        No more than 50 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. Try to be brief and concise.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片大纲生成简短的脚本：```{slide_text}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_1 = prompt_1 | self.llm | error_parser
-                scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                                 'notes_set': notes_set,
-                                                 'slide_text': slide_texts[i],
-                                                 'chapter': self.chapters_list[notes_set_number]})
+        else:
+            chain = self.chain('short_content_slide', StrOutputParser, self.llm)
+            scripts = await chain.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                    'notes_set': notes_set,
+                                    'slide_text': slide_texts[i],
+                                    'chapter': self.chapters_list[notes_set_number]})
 
-                if(self.language == 'en'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}```.
-                        No more than 50 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片大纲生成简短的脚本：```{slide_text}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_2 = prompt_2 | self.llm | error_parser
-                scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                          'notes_set': notes_set,
-                                          'slide_text': slide_texts[i],
-                                          'chapter': self.chapters_list[notes_set_number],
-                                          'scripts_temp_1': scripts_temp_1})
+        return scripts
 
-            elif i == len(slide_texts) - 1:
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please generate a brief script (1 or 2 sentences) for a presentation end with slide: ```{slide_text}```.
-                        Try to be open and inspiring students to think and ask questions.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片大纲生成简短的脚本：```{slide_text}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_1 = prompt_1 | self.llm | error_parser
-                scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
+    async def slide_script(self, i, notes_set, slide_texts, slide_texts_temp, notes_set_number):
+        """
+        Script of slide i, drafted and refined with the prompts for the position of the slide.
+        """
+        # Send the prompt to the API and get a response
+        # 3. If needed you can refer to the previous context of slides: ```{previous_context}``` as a reference.
+        # but this is only for getting smoother transition between slides.
+        if (i == 0):
+            chain_1 = self.chain('first_slide_draft', StrOutputParser, self.llm)
+            scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                             'notes_set': notes_set,
+                                             'slide_text': slide_texts[i],
+                                             'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
+                                             'chapter': self.chapters_list[notes_set_number]})
+
+            chain_2 = self.chain('first_slide_refine', StrOutputParser, self.llm)
+            scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                      'notes_set': notes_set,
+                                      'slide_text': slide_texts[i],
+                                      'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
+                                      'chapter': self.chapters_list[notes_set_number],
+                                      'scripts_temp_1': scripts_temp_1})
+
+        elif (i == 1):
+            chain_1 = self.chain('outline_slide_draft', StrOutputParser, self.llm)
+            scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                             'notes_set': notes_set,
+                                             'slide_text': slide_texts[i],
+                                             'chapter': self.chapters_list[notes_set_number]})
+
+            chain_2 = self.chain('outline_slide_refine', StrOutputParser, self.llm)
+            scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                      'notes_set': notes_set,
+                                      'slide_text': slide_texts[i],
+                                      'chapter': self.chapters_list[notes_set_number],
+                                      'scripts_temp_1': scripts_temp_1})
+
+        elif i == len(slide_texts) - 1:
+            chain_1 = self.chain('last_slide_draft', StrOutputParser, self.llm)
+            scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                             'notes_set': notes_set,
+                                             'slide_text': slide_texts[i],
+                                             'chapter': self.chapters_list[notes_set_number]})
+
+            chain_2 = self.chain('last_slide_refine', StrOutputParser, self.llm)
+            scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                      'notes_set': notes_set,
+                                      'slide_text': slide_texts[i],
+                                      'chapter': self.chapters_list[notes_set_number],
+                                      'scripts_temp_1': scripts_temp_1})
+
+        elif i == len(slide_texts) - 2:
+            chain_1 = self.chain('summary_slide_draft', StrOutputParser, self.llm)
+            scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                             'notes_set': notes_set,
+                                             'slide_text': slide_texts[i],
+                                             'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
+                                             'chapter': self.chapters_list[notes_set_number]})
+
+            chain_2 = self.chain('summary_slide_refine', StrOutputParser, self.llm)
+            scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                      'notes_set': notes_set,
+                                      'slide_text': slide_texts[i],
+                                      'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
+                                      'chapter': self.chapters_list[notes_set_number],
+                                      'scripts_temp_1': scripts_temp_1})
+
+        elif i != 0 and i != 1 and i != len(slide_texts) - 1 and i != len(slide_texts) - 2:
+            if len(slide_texts_temp[i]) < 5:
+                chain_1 = self.chain('title_slide_draft', StrOutputParser, self.llm)
+                scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
                                                  'notes_set': notes_set,
                                                  'slide_text': slide_texts[i],
+                                                 'next_slide_text': slide_texts[min(i + 1, len(slide_texts) - 1)],
                                                  'chapter': self.chapters_list[notes_set_number]})
 
-                if(self.language == 'en'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}``` in only 1 or 2 sentences..
-                        ----------------------------------------
-                        Requirtments:
-                        0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片大纲生成简短的脚本：```{slide_text}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_2 = prompt_2 | self.llm | error_parser
-                scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
+                chain_2 = self.chain('title_slide_refine', StrOutputParser, self.llm)
+                scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
                                           'notes_set': notes_set,
                                           'slide_text': slide_texts[i],
+                                          'next_slide_text': slide_texts[min(i + 1, len(slide_texts) - 1)],
                                           'chapter': self.chapters_list[notes_set_number],
                                           'scripts_temp_1': scripts_temp_1})
 
-            elif i == len(slide_texts) - 2:
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                if(self.language == 'en'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please generate a brief script for the summarizing slide: ```{slide_text}```.
-                        As a reference, the outline of this lecture is: ```{outline}```.
-                        No more than 50 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. Try to be open and inspiring students to think and ask questions.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_1 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片总结生成简短的脚本：```{slide_text}```。
-                        作为参考，这节课的大纲是：```{outline}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_1 = prompt_1 | self.llm | error_parser
-                scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
+            else:
+                chain_1 = self.chain('content_slide_draft', StrOutputParser, self.llm)
+                scripts_temp_1 = await chain_1.ainvoke({'zero_shot_topic': self.zero_shot_topic,
                                                  'notes_set': notes_set,
                                                  'slide_text': slide_texts[i],
-                                                 'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
                                                  'chapter': self.chapters_list[notes_set_number]})
 
-                if(self.language == 'en'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                        Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}```.
-                        No more than 50 words.
-                        ----------------------------------------
-                        Requirements:
-                        0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        作为一位教授，教授课程 {zero_shot_topic}。
-                        请为幻灯片总结生成简短的脚本：```{slide_text}```。
-                        作为参考，这节课的大纲是：```{outline}```。
-                        不超过50个字。
-                        ----------------------------------------
-                        要求：
-                        0. 尽量简洁明了。
-                        """)
-                else:
-                    raise ValueError("Language not supported.")
-                chain_2 = prompt_2 | self.llm | error_parser
-                scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
+                chain_2 = self.chain('content_slide_refine', StrOutputParser, self.llm)
+                scripts = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic,
                                           'notes_set': notes_set,
                                           'slide_text': slide_texts[i],
-                                          'outline': slide_texts[min(i + 1, len(slide_texts) - 1)],
                                           'chapter': self.chapters_list[notes_set_number],
                                           'scripts_temp_1': scripts_temp_1})
 
-            elif i != 0 and i != 1 and i != len(slide_texts) - 1 and i != len(slide_texts) - 2:
-                if len(slide_texts_temp[i]) < 5:
-                    parser = StrOutputParser()
-                    error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                    if(self.language == 'en'):
-                        prompt_1 = ChatPromptTemplate.from_template(
-                            """
-                            As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                            Please generate a script for the slide: ```{slide_text}```.
-                            Since the slide is a slide with only a title, please generate a brief script around the title to give an overview with 1 or 2 sentences.
-                            As a reference, the content of next slide is: ```{next_slide_text}```.
-                            ----------------------------------------
-                            Requirements:
-                            0. All the information in the slide has been covered.
-                            1. The content must be only relevant to the content: ```{slide_text}``` in this specific slide.
-                            2. Provide rich examples and explanations and possible applications for the content when needed.
-                            3. The response should be directly talking about the academic content, with no introduction or conclusion (like "Today...", or "Now...", "In a word...").
-                            """)
-                    elif(self.language == 'zh'):
-                        prompt_1 = ChatPromptTemplate.from_template(
-                            """
-                            作为一位教授，教授课程 {zero_shot_topic}.
-                            请为幻灯片生成简短的脚本：```{slide_text}```。
-                            由于幻灯片只有标题，请围绕标题生成简短的脚本，以1或2句话概述。
-                            作为参考，下一张幻灯片的内容是：```{next_slide_text}```。
-                            ----------------------------------------
-                            要求：
-                            0. 幻灯片中的所有信息都已涵盖。
-                            1. 内容必须仅与此特定幻灯片中的内容：```{slide_text}```相关。
-                            2. 在需要时提供丰富的示例、解释和可能的应用。
-                            3. 回答应直接谈论学术内容，没有引言或结论（如“今天...”，或“现在...”，“一句话...”）。
-                            """)
-                    else:
-                        raise ValueError("Language not supported.")
-                    chain_1 = prompt_1 | self.llm | error_parser
-                    scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                                     'notes_set': notes_set,
-                                                     'slide_text': slide_texts[i],
-                                                     'next_slide_text': slide_texts[min(i + 1, len(slide_texts) - 1)],
-                                                     'chapter': self.chapters_list[notes_set_number]})
-
-                    if(self.language == 'en'):
-                        prompt_2 = ChatPromptTemplate.from_template(
-                            """
-                            As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                            Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}```.
-                            Since the slide is a slide with only a title, please generate a brief script around the title to give an overview with 1 or 2 sentences.
-                            ----------------------------------------
-                            Requirements:
-                            0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                            """)
-                    elif(self.language == 'zh'):
-                        prompt_2 = ChatPromptTemplate.from_template(
-                            """
-                            作为一位教授，教授课程 {zero_shot_topic}.
-                            请为幻灯片生成简短的脚本：```{slide_text}```。
-                            由于幻灯片只有标题，请围绕标题生成简短的脚本，以1或2句话概述。
-                            ----------------------------------------
-                            要求：
-                            0. 回答应直接谈论学术内容，没有引言或结论（如“今天...”，或“现在...”，“一句话...”）。
-                            """)
-                    else:
-                        raise ValueError("Language not supported.")
-                    chain_2 = prompt_2 | self.llm | error_parser
-                    scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                              'notes_set': notes_set,
-                                              'slide_text': slide_texts[i],
-                                              'next_slide_text': slide_texts[min(i + 1, len(slide_texts) - 1)],
-                                              'chapter': self.chapters_list[notes_set_number],
-                                              'scripts_temp_1': scripts_temp_1})
-
-                else:
-                    parser = StrOutputParser()
-                    error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-                    if(self.language == 'en'):
-                        prompt_1 = ChatPromptTemplate.from_template(
-                            """
-                            As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                            Please generate a script for the slide: ```{slide_text}```.
-                            Do not talk about the title of this slide. Just focus on the content.
-                            Keep in mind that in the previous slide, the basic idea of the concept illustrated in this slide has been introduced.
-                            So do not even talk about the definition of this concept. Just focus on the content and explain the content in the slide.
-                            ----------------------------------------
-                            Requirements:
-                            0. All the information in the slide has been covered.
-                            1. The content must be only relevant to the content: ```{slide_text}``` in this specific slide.
-                            2. Provide rich examples and explanations and possible applications for the content when needed.
-                            3. The response should be directly talking about the academic content, with no introduction or conclusion (like "Today...", or "Now...", "In a word...").
-                            """)
-                    elif(self.language == 'zh'):
-                        prompt_1 = ChatPromptTemplate.from_template(
-                            """
-                            作为一位教授，教授课程 {zero_shot_topic}.
-                            请为幻灯片生成简短的脚本：```{slide_text}```。
-                            不要谈论此幻灯片的标题。只关注内容。
-                            请记住，在上一张幻灯片中，这张幻灯片中所说明的概念的基本思想已经被介绍过了。
-                            因此，甚至不要谈论这个概念的定义。只关注内容，并解释幻灯片中的内容。
-                            ----------------------------------------
-                            要求：
-                            0. 幻灯片中的所有信息都已涵盖。
-                            1. 内容必须仅与此特定幻灯片中的内容：```{slide_text}```相关。
-                            2. 在需要时提供丰富的示例、解释和可能的应用。
-                            3. 回答应直接谈论学术内容，没有引言或结论（如“今天...”，或“现在...”，“一句话...”）。
-                            """)
-                    else:
-                        raise ValueError("Language not supported.")
-                    chain_1 = prompt_1 | self.llm | error_parser
-                    scripts_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                                     'notes_set': notes_set,
-                                                     'slide_text': slide_texts[i],
-                                                     'chapter': self.chapters_list[notes_set_number]})
-
-                    if(self.language == 'en'):
-                        prompt_2 = ChatPromptTemplate.from_template(
-                            """
-                            As a professor teaching chapter: {chapter} in course {zero_shot_topic}.
-                            Please refine the script: ```{scripts_temp_1}``` for the slide: ```{slide_text}```.
-                            Keep in mind that in the previous slide, the basic idea of the concept illustrated in this slide has been introduced.
-                            So do not even talk about the definition of this concept. Just focus on the content and explain the content in the slide.
-                            ----------------------------------------
-                            Requirements:
-                            0. The response should be a fluent colloquial sentences paragraph, from the first word to the last word.
-                            1. Remove the first sentence if it is not directly talking about the academic content.
-                            """)
-                    elif(self.language == 'zh'):
-                        prompt_2 = ChatPromptTemplate.from_template(
-                            """
-                            作为一位教授，教授课程 {zero_shot_topic}.
-                            请为幻灯片生成简短的脚本：```{slide_text}```。
-                            请记住，在上一张幻灯片中，这张幻灯片中所说明的概念的基本思想已经被介绍过了。
-                            因此，甚至不要谈论这个概念的定义。只关注内容，并解释幻灯片中的内容。
-                            ----------------------------------------
-                            要求：
-                            0. 回答应直接谈论学术内容，没有引言或结论（如“今天...”，或“现在...”，“一句话...”）。
-                            1. 如果第一句话不直接谈论学术内容，请删除。
-                            """)
-                    else:
-                        raise ValueError("Language not supported.")
-                    chain_2 = prompt_2 | self.llm | error_parser
-                    scripts = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                              'notes_set': notes_set,
-                                              'slide_text': slide_texts[i],
-                                              'chapter': self.chapters_list[notes_set_number],
-                                              'scripts_temp_1': scripts_temp_1})
-
-            chapter_scripts.append(scripts)
-            slides.append(slide_texts[i])
-            click.echo(f"Scripts generated for slide {i}")
-
-        file_path = self.videos_dir + f'scripts_for_notes_set{notes_set_number}' + ".json"
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(chapter_scripts, file, indent=2, ensure_ascii=False)
-        click.echo(f"Scripts for note set {notes_set_number} are saved to: {file_path}")
+        return scripts
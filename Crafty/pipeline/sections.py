@@ -1,14 +1,17 @@
 import json
 import os
 import asyncio
+import time
 
 import click
-from langchain.output_parsers import OutputFixingParser
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 
 from Crafty.config import Config, Constants
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.science.model_router import ModelRouter
+from Crafty.pipeline.science.structured_output import chapter_sections, course_sections, invoke_validated
+from Crafty.pipeline.utils.dedup import DedupUtil
+from Crafty.pipeline.utils.trace import Tracer
 
 
 class Sections(PipelineStep):
@@ -20,10 +23,12 @@ class Sections(PipelineStep):
         # self.chapters_list = [self.zero_shot_topic]
 
         self.sections_per_chapter = para['sections_per_chapter']
+        # De-duplicate the sections with the model instead of locally.
+        self.llm_dedup = para.get('llm_dedup', False)
         # Sections will use an advanced model.
         self.llm = self.llm_advance
 
-    def execute(self):
+    async def execute_async(self):
         if os.path.exists(self.meta_dir + Config.META_AND_CHAPTERS):
             with open(self.meta_dir + Config.META_AND_CHAPTERS, 'r') as file:
                 meta_data = json.load(file)
@@ -36,102 +41,15 @@ class Sections(PipelineStep):
         else:
             raise FileNotFoundError(f"Chapter file not found in {self.meta_dir}")
 
-        raw_sections_in_chapters = self.robust_generate_sections(self.zero_shot_topic, self.chapters_list)
-
-        parser = JsonOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.short_video == True):
-            if(self.language == 'en'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    Based on {raw_sections_in_chapters}, the sections in a list of lists. The length of the list should be the same as the number of chapters.
-                    Chapter list: ```{chapters_list}```.
-                    Use the following json format:
-                    ----------------
-                    {{
-                    "sections": [
-                        [<section_1>, <section_2>, ..., <section_n>],
-                        [<section_1>, <section_2>, ..., <section_m>],
-                        ...
-                        [<section_1>, <section_2>, ..., <section_p>],
-                    ]
-                    }}
-                    ----------------
-                    """
-                )
-            elif(self.language == 'zh'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    用中文回答：
-                    根据 {raw_sections_in_chapters}，将章节放在一个列表中。列表的长度应该与章节的数量相同。
-                    确保每个章节都是唯一的：如果一个章节与另一章节在另一章节中具有相似的含义，
-                    请仅保留第一个章节（具有较低的章节索引），并删除其他章节。
-                    章节名称不应以数字开头。
-                    章节列表: ```{chapters_list}```.
-                    使用以下json格式:
-                    ----------------
-                    {{
-                    "sections": [
-                        [<section_1>, <section_2>, ..., <section_n>],
-                        [<section_1>, <section_2>, ..., <section_m>],
-                        ...
-                        [<section_1>, <section_2>, ..., <section_p>],
-                    ]
-                    }}
-                    ----------------
-                    """
-                )
-            else:
-                raise ValueError("Language not supported.")
+        raw_sections_in_chapters = self.outline_sections()
+        missing = [chapter for chapter in self.chapters_list if chapter not in raw_sections_in_chapters]
+        if missing:
+            raw_sections_in_chapters.update(await self.robust_generate_sections(self.zero_shot_topic, missing))
+        raw_sections_in_chapters = {chapter: raw_sections_in_chapters[chapter] for chapter in self.chapters_list}
+        if self.llm_dedup:
+            sections_list = await asyncio.to_thread(self.llm_unique_sections, raw_sections_in_chapters)
         else:
-            if(self.language == 'en'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    Based on {raw_sections_in_chapters}, the sections in a list of lists. The length of the list should be the same as the number of chapters.
-                    Make sure every section is unique: If one section has a similar meaning with another section in another chapter,
-                    only keep the first one (with lower chapter index) and remove the other sections.
-                    Section name should not start with number.
-                    Chapter list: ```{chapters_list}```.
-                    Use the following json format:
-                    ----------------
-                    {{
-                    "sections": [
-                        [<section_1>, <section_2>, ..., <section_n>],
-                        [<section_1>, <section_2>, ..., <section_m>],
-                        ...
-                        [<section_1>, <section_2>, ..., <section_p>],
-                    ]
-                    }}
-                    ----------------
-                    """
-                )
-            elif(self.language == 'zh'):
-                prompt = ChatPromptTemplate.from_template(
-                    """
-                    用中文回答：
-                    根据 {raw_sections_in_chapters}，将章节放在一个列表中。列表的长度应该与章节的数量相同。
-                    确保每个章节都是唯一的：如果一个章节与另一章节在另一章节中具有相似的含义，
-                    请仅保留第一个章节（具有较低的章节索引），并删除其他章节。
-                    章节名称不应以数字开头。
-                    章节列表: ```{chapters_list}```.
-                    使用以下json格式:
-                    ----------------
-                    {{
-                    "sections": [
-                        [<section_1>, <section_2>, ..., <section_n>],
-                        [<section_1>, <section_2>, ..., <section_m>],
-                        ...
-                        [<section_1>, <section_2>, ..., <section_p>],
-                    ]
-                    }}
-                    ----------------
-                    """
-                )
-            else:
-                raise ValueError("Language not supported.")
-        chain = prompt | self.llm | error_parser
-        response = chain.invoke({'chapters_list': self.chapters_list, 'raw_sections_in_chapters': raw_sections_in_chapters})
-        sections_list = response["sections"]
+            sections_list = self.local_unique_sections(raw_sections_in_chapters)
 
         with open(self.debug_dir + Config.RAW_SECTIONS_IN_CHAPTER, 'w', encoding='utf-8') as file:
             json.dump(raw_sections_in_chapters, file, indent=2, ensure_ascii=False)
@@ -140,95 +58,166 @@ class Sections(PipelineStep):
                 Constants.CHAPTER_LIST_KEY: self.chapters_list,
                 Constants.SECTION_LIST_KEY: sections_list
         }, json_file, indent=4, ensure_ascii=False)
+        if os.path.exists(self.debug_dir + Config.RAW_SECTIONS_PARTIAL):
+            os.remove(self.debug_dir + Config.RAW_SECTIONS_PARTIAL)
         click.echo(f'The section list is saved with chapter to {self.notes_dir + Config.CHAPTERS_AND_SECTIONS}')
 
-    def robust_generate_sections(self, zero_shot_topic, chapter_list, max_attempts=5):
+    def artifact_inputs(self):
+        return super().artifact_inputs() + [self.meta_dir + Config.META_AND_CHAPTERS]
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({'sections_per_chapter': self.sections_per_chapter, 'short_video': self.short_video,
+                       'llm_dedup': self.llm_dedup})
+        return params
+
+    def artifact_outputs(self):
+        return [self.notes_dir + Config.CHAPTERS_AND_SECTIONS]
+
+    def outline_sections(self):
+        """
+        The sections of the chapters read from the outline of the uploaded textbook (see DocHandler).
+        Chapters without sections in the outline, or renamed since the chapter step, are left to the model.
+        """
+        if self.craft_notes != True or not self.docs.outlines[0]:
+            return {}
+        sections = {chapter['title']: {'sections': [section['title'] for section in chapter['sections']]}
+                    for chapter in self.docs.outlines[0] if chapter['sections'] and chapter['title'] in self.chapters_list}
+        if sections:
+            click.echo(f'The sections of {len(sections)} chapters are read from the outline of {self.file_name}.')
+        return sections
+
+    def local_unique_sections(self, raw_sections_in_chapters):
         """
-        Generate sections for each chapter in a robust way, retrying up to a maximum number of attempts in case of failure.
+        The section list of every chapter, without the sections repeating one of an earlier chapter.
+        Short videos have a single chapter, so their sections are only reshaped.
+        """
+        sections = [raw_sections_in_chapters[chapter].get('sections', []) for chapter in self.chapters_list]
+        if self.short_video == True:
+            return sections
+        return DedupUtil.dedup_sections(sections, Config.SECTION_DEDUP_THRESHOLD)
+
+    def llm_unique_sections(self, raw_sections_in_chapters):
+        """
+        The section list of every chapter, de-duplicated and reshaped by the model in one call over the whole course.
+        """
+        variant = 'short_unique_sections' if self.short_video == True else 'unique_sections'
+        inputs = {'chapters_list': self.chapters_list, 'raw_sections_in_chapters': raw_sections_in_chapters}
+        if self.structured_output:
+            chain = self.structured_chain(variant, course_sections(len(self.chapters_list)), self.llm)
+            response = invoke_validated(chain, inputs)
+        else:
+            chain = self.chain(variant, JsonOutputParser, self.llm)
+            response = chain.invoke(inputs)
+        return response["sections"]
+
+    def compare_dedup(self):
+        """
+        Run the local and the model de-duplication on the raw sections saved by the last run of this step,
+        and compare their latency, cost and results. The model result is the reference.
+        """
+        with open(self.meta_dir + Config.META_AND_CHAPTERS, 'r') as file:
+            self.chapters_list = json.load(file)[Constants.CHAPTERS_KEY]
+        with open(self.debug_dir + Config.RAW_SECTIONS_IN_CHAPTER, 'r') as file:
+            raw_sections_in_chapters = json.load(file)
+
+        results = {}
+        for method, dedup in (('llm', self.llm_unique_sections), ('local', self.local_unique_sections)):
+            spent = Tracer.get().summary().get('section', {}).get('cost_usd', 0.0)
+            with Tracer.get().span('dedup', course_id=self.course_id, step='section', method=method):
+                start = time.perf_counter()
+                sections_list = dedup(raw_sections_in_chapters)
+                seconds = time.perf_counter() - start
+            # The model calls of the de-duplication are added to the totals of the section step.
+            cost = Tracer.get().summary().get('section', {}).get('cost_usd', 0.0) - spent
+            results[method] = {'seconds': seconds, 'cost_usd': cost, 'sections_list': sections_list,
+                               'sections': sum(len(sections) for sections in sections_list)}
+        for result in results.values():
+            result['agreement'] = DedupUtil.agreement(result['sections_list'], results['llm']['sections_list'])
+        return results
+
+    async def robust_generate_sections(self, zero_shot_topic, chapter_list, max_attempts=5):
+        """
+        Generate sections for each chapter in a robust way. A chapter whose response fails is retried on its
+        own with exponential backoff, up to a maximum number of attempts, while the other chapters are kept.
+        Completed chapters are saved as they arrive, so a failed run resumes with the missing chapters only.
 
         :param zero_shot_topic: The zero-shot topic of the course.
         :param chapter_list: A list of chapters for which to generate sections.
-        :param max_attempts: The maximum number of attempts to make when generating sections.
+        :param max_attempts: The maximum number of attempts to make for each chapter.
         :return: A dictionary mapping chapter names to generated sections.
         """
-        attempt = 0
-        while attempt < max_attempts:
-            try:
-                return asyncio.run(self.generate_sections(zero_shot_topic, chapter_list))
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed for generating sections: {e}")
-                attempt += 1
-                if attempt == max_attempts:
-                    print(f"Failed to generate sections after {max_attempts} attempts.")
-                    # Return None or raise an exception depending on how you want to handle complete failure.
-                    raise Exception(f"sections generation failed after {max_attempts} attempts.")
-
-    async def generate_sections(self, zero_shot_topic, chapter_list):
+        attempts = {chapter: 0 for chapter in chapter_list}
+        try:
+            return await self.generate_sections(zero_shot_topic, chapter_list, attempts, max_attempts)
+        finally:
+            click.echo('Attempts per chapter for generating sections:')
+            for chapter, count in attempts.items():
+                click.echo(f'  {count}  {chapter}' + (' (saved by a previous run)' if count == 0 else ''))
+
+    async def generate_sections(self, zero_shot_topic, chapter_list, attempts, max_attempts):
         """
         Asynchronously generate sections for each chapter using the given language model.
 
         :param zero_shot_topic: The zero-shot topic of the course.
         :param chapter_list: A list of chapters for which to generate sections.
+        :param attempts: Dictionary mapping chapter names to the number of calls made for them, updated in place.
+        :param max_attempts: The maximum number of attempts to make for each chapter.
         :return: A dictionary mapping chapter names to generated sections.
         """
-        inputs = [{
-            "zero_shot_topic": zero_shot_topic,
-            "chapter_name": chapter,
-            "sections_per_chapter": self.sections_per_chapter,
-        } for chapter in chapter_list]
-
-        parser = JsonOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                As as a professor teaching course: {zero_shot_topic}.
-                Please work through the following steps:
-                Come up with the sections in the chapter: {chapter_name}.
-                Number of sections within the chapter should be no more than: {sections_per_chapter} and no less than 5.
-                The output format should be:
-                ----------------
-                ```json
-                {{
-                "sections": [
-                    <section_1>,
-                    <section_2>,
-                    ...
-                    <section_n>,
-                ]
-                }}
-                ```
-                ----------------
-                """
-            )
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                需求: \n\n\n
-                用中文回答：
-                作为一位教授教授课程：{zero_shot_topic}。
-                请按照以下步骤进行：
-                想出章节：{chapter_name} 中的章节。
-                章节中的章节数量不应超过：{sections_per_chapter} 且不少于 5。
-                输出格式应为：
-                ----------------
-                ```json
-                {{
-                "sections": [
-                    <section_1>,
-                    <section_2>,
-                    ...
-                    <section_n>,
-                ]
-                }}
-                ```
-                ----------------
-                """
-            )
+        if self.structured_output:
+            build = lambda llm: self.structured_chain('sections', chapter_sections(self.sections_per_chapter), llm)
         else:
-            raise ValueError("Language not supported.")
-        chain = prompt | self.llm | error_parser
-        results = await chain.abatch(inputs)
-
-        return dict(zip(chapter_list, results))
+            build = lambda llm: self.chain('sections', JsonOutputParser, llm)
+        # The section count asked for by the prompt
+        chain = self.route('sections', build, 'advance', ModelRouter.list_length('sections', 5, self.sections_per_chapter))
+
+        key = {'zero_shot_topic': zero_shot_topic, 'sections_per_chapter': self.sections_per_chapter, 'language': self.language}
+        completed = self.load_partial_sections(key)
+        pending = [chapter for chapter in chapter_list if chapter not in completed]
+        retry = 0
+        while pending:
+            inputs = [{
+                "zero_shot_topic": zero_shot_topic,
+                "chapter_name": chapter,
+                "sections_per_chapter": self.sections_per_chapter,
+            } for chapter in pending]
+            failed = []
+            async for index, result in chain.abatch_as_completed(inputs, return_exceptions=True):
+                chapter = pending[index]
+                attempts[chapter] += 1
+                if isinstance(result, Exception) or not isinstance(result, dict) or not result.get('sections'):
+                    print(f"Attempt {attempts[chapter]} failed for generating sections of {chapter}: {result!r}")
+                    failed.append(chapter)
+                    continue
+                completed[chapter] = result
+                self.save_partial_sections(key, completed)
+            exhausted = [chapter for chapter in failed if attempts[chapter] >= max_attempts]
+            if exhausted:
+                raise Exception(f"sections generation failed after {max_attempts} attempts for chapters: {exhausted}")
+            if failed:
+                Tracer.get().add('retries', len(failed))
+                await asyncio.sleep(Config.SECTIONS_RETRY_BACKOFF * 2 ** retry)
+                retry += 1
+            pending = [chapter for chapter in chapter_list if chapter in failed]
+
+        return {chapter: completed[chapter] for chapter in chapter_list}
+
+    def load_partial_sections(self, key):
+        """
+        The sections of the chapters completed by a previous run with the same topic and parameters.
+        """
+        path = self.debug_dir + Config.RAW_SECTIONS_PARTIAL
+        if self.force or not os.path.exists(path):
+            return {}
+        with open(path, 'r') as file:
+            partial = json.load(file)
+        return partial['chapters'] if partial.get('key') == key else {}
+
+    def save_partial_sections(self, key, completed):
+        path = self.debug_dir + Config.RAW_SECTIONS_PARTIAL
+        os.makedirs(self.debug_dir, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'key': key, 'chapters': completed}, file, indent=2, ensure_ascii=False)
+        os.replace(temp_path, path)
@@ -1,18 +1,21 @@
 import json
 import os
 import re
-import subprocess
 
 import click
+import fitz
 import openai
 
-from langchain.output_parsers import OutputFixingParser
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 
+from Crafty.config import Config
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.science.model_router import ModelRouter
 from Crafty.pipeline.utils.network import NetworkUtil
 from Crafty.pipeline.utils.tex import TexUtil
+from Crafty.pipeline.utils.tex_lint import TexLintUtil
+from Crafty.pipeline.utils.trace import Tracer
+from Crafty.pipeline.utils.xml import XmlUtil
 
 import asyncio
 # rate limiting pkg
@@ -32,6 +35,7 @@ class Slides(PipelineStep):
 
         self.slides_template_file = para['slides_template_file']
         self.slides_style = para['slides_style']
+        self.section_slides = para.get('section_slides', False)
         if(self.short_video == True):
             self.content_slide_pages = 2
             # self.chapter = 0
@@ -41,31 +45,60 @@ class Slides(PipelineStep):
             self.chapter = para['chapter']
             self.read_meta_data_from_file()
 
-    def execute(self):
+    async def execute_async(self):
         if self.chapter is None or self.chapter < 0:
             raise ValueError("Chapter number is not provided or invalid.")
 
         # Create the full slides for the chapter
         if(self.short_video == True):
-            full_slides = self.create_full_slides_short(notes_set_number=self.chapter)
+            full_slides = await self.create_full_slides_short(notes_set_number=self.chapter)
             click.echo(f'Slides generation finished, next step is generate images.')
             # # Generate images for the slides with only titles
-            asyncio.run(self.tex_image_generation(full_slides, notes_set_number=self.chapter))
+            await self.tex_image_generation(full_slides, notes_set_number=self.chapter)
             click.echo(f'Images generation finished, next step is putting images into the Tex file.')
             # # Insert images into TEX file of the slides
             self.insert_images_into_latex(notes_set_number=self.chapter)
         else:
-            full_slides = self.create_full_slides(notes_set_number=self.chapter)
+            if self.section_slides:
+                full_slides = await self.create_full_slides_by_section(notes_set_number=self.chapter)
+            else:
+                full_slides = await self.create_full_slides(notes_set_number=self.chapter)
             click.echo(f'Slides generation finished, next step is generate images.')
             # # Generate images for the slides with only titles
-            asyncio.run(self.tex_image_generation(full_slides, notes_set_number=self.chapter))
+            await self.tex_image_generation(full_slides, notes_set_number=self.chapter)
             click.echo(f'Images generation finished, next step is putting images into the Tex file.')
             # # Insert images into TEX file of the slides
             self.insert_images_into_latex(notes_set_number=self.chapter)
         # Compile the slides to PDF
-        self.compile_tex_file_to_pdf(notes_set_number=self.chapter)
-
-    def create_full_slides_short(self, notes_set_number=-1):
+        await self.compile_tex_file_to_pdf(notes_set_number=self.chapter)
+
+    def artifact_inputs(self):
+        inputs = super().artifact_inputs() + [self.notes_dir + f'notes_set{self.chapter}.xml']
+        if self.slides_template_file is not None:
+            inputs.append(TexUtil.template_path(self.slides_template_file))
+        return inputs
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({'topic': self.zero_shot_topic,
+                       'chapter': self.chapters_list[self.chapter],
+                       'slides_template_file': self.slides_template_file,
+                       'slides_style': self.slides_style,
+                       'content_slide_pages': self.content_slide_pages,
+                       'short_video': self.short_video,
+                       'section_slides': self.section_slides})
+        return params
+
+    def artifact_outputs(self):
+        tex_path = self.videos_dir + f'full_slides_for_notes_set{self.chapter}.tex'
+        return [tex_path, tex_path.replace('.tex', '.pdf')]
+
+    async def refresh_outputs(self, edited):
+        # The slides were edited by hand, the PDF has to follow them.
+        if self.artifact_outputs()[0] in edited:
+            await self.compile_tex_file_to_pdf(notes_set_number=self.chapter, repair=False)
+
+    async def create_full_slides_short(self, notes_set_number=-1):
         """
         Generate short slides.
         """
@@ -78,76 +111,17 @@ class Slides(PipelineStep):
         else:
             raise FileNotFoundError(f"Notes set file not found: {notes_xml}")
         
-        parser = StrOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                As a short video YouTuber illustrating concept: ```{zero_shot_topic}```.
-                Based on the provided material: ```{notes_set}```.
-                Please follow the following steps and requirements to generate only {page_number} pages of slides.
-                Structure:
-                1. First page is the tile with the concept to illustrate
-                2. Second page is the explanation of this concept, just a few concise bullet points
-                Based on the template in latex format ```{tex_template}``` (But keep in mind that this is only a template, so do not need to include the information in it in your response unless it also shows in the provided material.)
-                Important: only response in pure correct latex format. Do not include "```" at the beginning and the end.
-                """)
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                用中文回答：
-                作为一个短视频YouTuber，说明概念：```{zero_shot_topic}```。
-                基于提供的材料：```{notes_set}```。
-                请按照以下步骤和要求生成仅有 {page_number} 页幻灯片。
-                结构：
-                1. 第一页是要说明的概念的标题
-                2. 第二页是这个概念的解释，只有几个简明的要点
-                基于latex格式的模板 ```{tex_template}```（但请记住，这只是一个模板，因此除非提供的材料中也显示在其中，否则不需要在响应中包含其中的信息。）
-                重要提示：只回复纯粹正确的latex格式。不要在开头和结尾处包含 "```"。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | self.llm_basic | error_parser
-        full_slides = chain.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                    'notes_set': notes_set,
-                                    'page_number': self.content_slide_pages,
-                                    'tex_template': slides_template})
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                For course ```{zero_shot_topic}``` and chapter ```{chapter}```.
-                Generate a description text for the slides for this lecture within 100 words.
-                Start with "This lecture ..." and make sure the generated content is closely tied to the content of the slide.
-                Lecture slides:
-                ```{full_slides}```
-                """)
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                用中文回答：
-                对于课程 ```{zero_shot_topic}``` 和章节 ```{chapter}```。
-                为本讲座的幻灯片生成一个100字以内的描述文本。
-                以 "本讲座 ..." 开头，并确保生成的内容与幻灯片的内容紧密相关。
-                讲座幻灯片：
-                ```{full_slides}```
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | self.llm_basic | error_parser
-        video_description = chain.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                          'chapter': self.chapters_list[notes_set_number],
-                                          'full_slides': full_slides})
-        with open(self.debug_dir + f"video_description_chapter_{notes_set_number}.json", 'w', encoding='utf-8') as file:
-            json.dump(video_description, file, indent=2, ensure_ascii=False)
-
-        # Save the response in a .tex file instead of a .txt file
-        tex_path = self.videos_dir + f'full_slides_for_notes_set{notes_set_number}' + ".tex"
-        with open(tex_path, 'w', encoding='utf-8') as file:
-            file.write(full_slides)
-        click.echo(f'Tex file for chapter {notes_set_number} saved to: {tex_path}')
-        return full_slides
-
-    def create_full_slides(self, notes_set_number=-1):
+        inputs = {'zero_shot_topic': self.zero_shot_topic,
+                  'notes_set': notes_set,
+                  'page_number': self.content_slide_pages,
+                  'tex_template': slides_template}
+        # Long notes sets go to the advanced model when they would not fit the context window of the basic one.
+        tier = self.select_tier('short_slides', inputs, ('basic', 'advance'))
+        chain = self.chain('short_slides', StrOutputParser, self.api.models[tier]['instance'])
+        full_slides = await chain.ainvoke(self.fit_inputs('short_slides', inputs, 'notes_set', tier))
+        return await self.save_full_slides(full_slides, notes_set_number)
+
+    async def create_full_slides(self, notes_set_number=-1):
         """
         Generate full slides for a given course and chapter based on the provided notes set.
         The slides are generated in LaTeX format and saved to a tex file.
@@ -162,225 +136,168 @@ class Slides(PipelineStep):
         else:
             raise FileNotFoundError(f"Notes set file not found: {notes_xml}")
 
-        # Send the prompt to the API and get a response
-        parser = StrOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.language == 'en'):
-            prompt_1 = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                As a professor teaching course: ```{zero_shot_topic}```.
-                Based on the provided material: ```{notes_set}```.
-                Please follow the following steps and requirements to generate no more than {page_number} pages of slides for chapter ```{chapter}``` of this course.
-                Based on the template in latex format ```{tex_template}``` (But keep in mind that this is only a template, so do not need to include the information in it in your response unless it also shows in the provided material.):
-                Step 1: Use "Chapter {notes_set_number}: {chapter}" as first page. Specify the chapter number.
-                Step 2: Based on the provided material of notes set and chapter topic of this lecture, come out an outline for this lecture and put it as second page.
-                        Number of topics should be no more than 5. Topics will correspond to "section" in latex format. Topic names should be short and concise.
-                Step 3: Going though the topics of the chapter, generate the slides accordingly.
-                        For each topic, generate slides as follows:
-                            -> Page 1 to the end of this section:
-                            -> Devide this topic into several key concepts.
-                            -> Illustrate each one in a separate page frame (instead of subsection).
-                            Try to divide the whole illustration into several bullet points and sub-bullet points.
-                            -> Then do the same for the next topic (section).
-                Step 4: Generate the last 2 pages: one is the summary of this lecture, another one is the "Thank you" page in the end.
-                Requirement 1. Do not include any information not included in the provided material of notes set.
-                Requirement 2. Focus on illustration of the concepts and do not use figures or tables etc.
-                Requirement 3. Try to cover as much information in the provided material as you can.
-                """)
-        elif(self.language == 'zh'):
-            prompt_1 = ChatPromptTemplate.from_template(
-                r"""
-                注意：对于中文支持
-                为了中文支持，请将模版中```\usepackage[utf8]{{inputenc}}```替换为```\\usepackage{{ctex}}```。
-                这样就可以确保文档中的中文内容能够正确显示和排版。
-
-                作为教授，教授课程：```{zero_shot_topic}```。
-                基于提供的材料：```{notes_set}```。
-                请按照以下步骤和要求为本课程的第 {chapter} 章生成不超过 {page_number} 页的幻灯片。
-                基于latex格式的模板 ```{tex_template}```（但请记住，这只是一个模板，因此除非提供的材料中也显示在其中，否则不需要在响应中包含其中的信息。）：
-                第1步：将“第 {notes_set_number} 章：{chapter}”作为第一页。指定章节编号。
-                第2步：根据提供的笔记集材料和本讲座的章节主题，为本讲座制定一个大纲并将其放在第二页。
-                        主题数量不应超过5个。主题将对应于latex格式中的“section”。主题名称应简短而简洁。
-                第3步：浏览章节的主题，相应地生成幻灯片。
-                        对于每个主题，生成幻灯片如下：
-                            -> 从本节的第1页到最后一页：
-                            -> 将此主题分为几个关键概念。
-                            -> 在单独的页面框架中（而不是子节）中说明每个概念。
-                            尝试将整个说明分为几个项目符号和子项目符号。
-                            -> 然后对下一个主题（部分）执行相同操作。
-                第4步：生成最后的2页：一是本讲座的摘要，另一是最后的“谢谢”页面。
-                要求1. 不要包含未包含在笔记集提供的材料中的任何信息。
-                要求2. 专注于概念的说明，不要使用图表等。
-                要求3. 尽可能涵盖提供的材料中的所有信息。""")
-        else:
-            raise ValueError("Language is not supported.")
-        chain_1 = prompt_1 | self.llm_advance | error_parser
-        full_slides_temp_1 = chain_1.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                             'notes_set': notes_set,
-                                             'page_number': self.content_slide_pages,
-                                             'tex_template': slides_template,
-                                             'chapter': self.chapters_list[notes_set_number],
-                                             'notes_set_number': notes_set_number})
-
-        if(self.language == 'en'):
-            prompt_2 = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                ```{full_slides_temp_1}``` is the slides in latex format generated for course: ```{zero_shot_topic}```.
-                As a professor teaching this course, based on the provided material: ```{notes_set}``` and chapter name: ```{chapter}```.
-                Please combine and refine the generated tex file above from step 1 to 4. Make sure your final output follows the following requirements:
-                Requirement 0: Do not delete or add any pages from the generated slides.
-                Requirement 1. Only response in latex format. This file should be able to be directly compiled, so do not include anything like "```" in response.
-                Requirement 2. Do not include any information not included in the provided material of notes set.
-                Requirement 3. Focus on illustration of the concepts and do not use figures or tables etc.
-                Requirement 4. Try to cover as much information in the provided material as you can.
-                """)
-        elif(self.language == 'zh'):
-            prompt_2 = ChatPromptTemplate.from_template(
-                r"""
-                需求: \n\n\n
-                注意：对于中文支持
-                为了中文支持，请将模版中```\usepackage[utf8]{{inputenc}}```替换为```\\usepackage{{ctex}}```。
-                这样就可以确保文档中的中文内容能够正确显示和排版。
-
-                ```{full_slides_temp_1}``` 是为课程：```{zero_shot_topic}```生成的latex格式幻灯片。
-                作为教授教授这门课程，基于提供的材料：```{notes_set}```和章节名称：```{chapter}```。
-                请将上述步骤1到4生成的tex文件组合并完善。确保您的最终输出符合以下要求：
-                要求0：不要从生成的幻灯片中删除或添加任何页面。
-                要求1. 只回复latex格式。此文件应能够直接编译，因此在响应中不要包含任何类似“```”的内容。
-                要求2. 不要包含未包含在笔记集提供的材料中的任何信息。
-                要求3. 专注于概念的说明，不要使用图表等。
-                要求4. 尽可能涵盖提供的材料中的所有信息。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain_2 = prompt_2 | self.llm_advance | error_parser
-        full_slides_temp_2 = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                             'notes_set': notes_set,
-                                             'page_number': self.content_slide_pages,
-                                             'tex_template': slides_template,
-                                             'chapter': self.chapters_list[notes_set_number],
-                                             'notes_set_number': notes_set_number,
-                                             'full_slides_temp_1': full_slides_temp_1})
-
-        if(self.language == 'en'):
-            prompt_3 = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                ```{full_slides_temp_2}``` are the slides in latex format generated for course: ```{zero_shot_topic}```.
-                As a professor teaching this course, based on the provided material: ```{notes_set}``` and chapter name: ```{chapter}```.
-                Please refine the generated tex file. Make sure your final output follows the following requirements:
-                Requirement 0: Do not delete or add any pages from the generated slides.
-                Requirement 1. Only response in latex format. This file should be able to be directly compiled, so do not include anything like "```" in response.
-                Requirement 2. Going through each page of the generated slides, make sure each concept is well explained. Add more examples if needed.
-                Requirement 3. Make sure the slides as a whole is self-consistent, that means the reader can get all the information from the slides without any missing parts.
-                Requirement 4. Recheck the tex format to make sure it is correct as a whole.
-                Requirement 5. Build hyperlinks between the outline slide and the corresponding topic slides.
-                """)
-        elif(self.language == 'zh'):
-            prompt_3 = ChatPromptTemplate.from_template(
-                r"""
-                需求: \n\n\n
-                注意：对于中文支持
-                为了中文支持，请将模版中```\usepackage[utf8]{{inputenc}}```替换为```\\usepackage{{ctex}}```。
-                这样就可以确保文档中的中文内容能够正确显示和排版。
-
-                ```{full_slides_temp_2}``` 是为课程：```{zero_shot_topic}```生成的latex格式幻灯片。
-                作为教授教授这门课程，基于提供的材料：```{notes_set}```和章节名称：```{chapter}```。
-                请完善生成的tex文件。确保您的最终输出符合以下要求：
-                要求0：不要从生成的幻灯片中删除或添加任何页面。
-                要求1. 只回复latex格式。此文件应能够直接编译，因此在响应中不要包含任何类似“```”的内容。
-                要求2. 仔细检查生成的幻灯片的每一页，确保每个概念都得到很好的解释。如果需要，添加更多示例。
-                要求3. 确保幻灯片作为一个整体是自洽的，这意味着读者可以从幻灯片中获得所有信息，而没有任何遗漏的部分。
-                要求4. 重新检查tex格式，确保它作为一个整体是正确的。
-                要求5. 在大纲幻灯片和相应主题幻灯片之间建立超链接。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain_3 = prompt_3 | self.llm_advance | error_parser
-        full_slides_temp_3 = chain_3.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                             'notes_set': notes_set,
-                                             'page_number': self.content_slide_pages,
-                                             'tex_template': slides_template,
-                                             'chapter': self.chapters_list[notes_set_number],
-                                             'notes_set_number': notes_set_number,
-                                             'full_slides_temp_2': full_slides_temp_2})
-
-        if(self.language == 'en'):
-            prompt_4 = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                For latex ```{full_slides_temp_3}``` please check latex grammar and spelling errors. Fix them if any.
-
-                Then for each topic (latex section) in the slides, do the following:
-                    -> Page 1: Insert a single blank page with the topic name on top only.
-                        instead of ```\begin{{frame}}{{}}
-                                        \centering
-                                        <topic name>
-                                    \end{{frame}}```
-                        use ```\begin{{frame}}{{<topic name>}}
-                            \end{{frame}}``` as the blank page.
-                    -> Page 2 to the end: original pages.
-                And do not include anything like "```" in response.
-                Reply with the final slides in latex format purely.
-                """)
-        elif(self.language == 'zh'):
-            prompt_4 = ChatPromptTemplate.from_template(
-                r"""
-                需求: \n\n\n
-                注意：对于中文支持
-                为了中文支持，请将模版中```\usepackage[utf8]{{inputenc}}```替换为```\\usepackage{{ctex}}```。
-                这样就可以确保文档中的中文内容能够正确显示和排版。
-
-                对于latex ```{full_slides_temp_3}```，请检查latex语法和拼写错误。如果有，请修复。
-
-                然后对幻灯片中的每个主题（latex部分）执行以下操作：
-                    -> 第1页：插入一个仅有主题名称的空白页。
-                        而不是 ```\begin{{frame}}{{}}
-                                        \centering
-                                        <topic name>
-                                    \end{{frame}}```
-                        使用 ```\begin{{frame}}{{<topic name>}}
-                            \end{{frame}}``` 作为空白页。
-                    -> 第2页到最后一页：原始页面。
-                并且在响应中不要包含任何类似“```”的内容。
-                以纯粹的latex格式回复最终幻灯片。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain_4 = prompt_4 | self.llm_advance | error_parser
-        full_slides = chain_4.invoke({'zero_shot_topic': self.zero_shot_topic,
-                                      'notes_set': notes_set,
-                                      'page_number': self.content_slide_pages + 2,
-                                      'tex_template': slides_template,
-                                      'chapter': self.chapters_list[notes_set_number],
-                                      'notes_set_number': notes_set_number,
-                                      'full_slides_temp_3': full_slides_temp_3})
-
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                For course ```{zero_shot_topic}``` and chapter ```{chapter}```.
-                Generate a description text for the slides for this lecture within 100 words.
-                Start with "This lecture ..." and make sure the generated content is closely tied to the content of the slide.
-                Lecture slides:
-                ```{full_slides}```
-                """)
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                用中文回答：
-                对于课程 ```{zero_shot_topic}``` 和章节 ```{chapter}```。
-                为本讲座的幻灯片生成一个100字以内的描述文本。
-                以 "本讲座 ..." 开头，并确保生成的内容与幻灯片的内容紧密相关。
-                讲座幻灯片：
-                ```{full_slides}```
-                """)
+        # Send the prompt to the API and get a response. Model tiers whose context window cannot hold
+        # the notes set are skipped rather than tried.
+        inputs = {'zero_shot_topic': self.zero_shot_topic,
+                  'notes_set': notes_set,
+                  'page_number': self.content_slide_pages,
+                  'tex_template': slides_template,
+                  'chapter': self.chapters_list[notes_set_number],
+                  'notes_set_number': notes_set_number}
+        chain_1 = self.route('slides_draft', lambda llm: self.chain('full_slides_draft', StrOutputParser, llm), 'advance', ModelRouter.latex_frames,
+                             prompt=('full_slides_draft', inputs))
+        full_slides_temp_1 = await chain_1.ainvoke(inputs)
+
+        # The later passes only send back the frames they change, which are patched in locally.
+        full_slides = await self.patch_slides('slides_combine', 'full_slides_combine', full_slides_temp_1, inputs)
+        full_slides = await self.patch_slides('slides_refine', 'full_slides_refine', full_slides, inputs)
+        full_slides = await self.lint_slides(full_slides)
+
+        return await self.save_full_slides(full_slides, notes_set_number)
+
+    async def patch_slides(self, task, variant, full_slides, inputs):
+        """
+        Refinement pass of the slides in which the model returns patches of the frames it changes,
+        numbered by TexUtil.number_frames, instead of the whole deck. The pass is repeated up to
+        Config.SLIDES_PATCH_ROUNDS times and ends early once a round proposes no change.
+        The completion tokens saved compared to sending back the whole deck are logged. A response
+        which is not a valid patch, once every model tier has been tried, keeps the slides as they are.
+        """
+        frames = len(TexUtil.frame_spans(full_slides))
+        for _ in range(Config.SLIDES_PATCH_ROUNDS):
+            round_inputs = {**inputs, 'numbered_slides': TexUtil.number_frames(full_slides)}
+            validate = self.patch_validator(range(frames + 1))
+            chain = self.route(task, lambda llm: self.chain(variant, StrOutputParser, llm), 'advance',
+                               validate, prompt=(variant, round_inputs))
+            response = await chain.ainvoke(round_inputs)
+            invalid = validate(response)
+            if invalid:
+                print(f"{variant}: the response is not a valid patch ({invalid}), the slides are kept as they are.")
+                Tracer.get().add('invalid_patches')
+                break
+            patches = TexUtil.parse_frame_patches(response)
+            saved = self.prompt.get_tokens_number_from_string(full_slides) - self.prompt.get_tokens_number_from_string(response)
+            print(f"{variant}: {len(patches)} of {frames} frames patched, about {saved} completion tokens saved.")
+            Tracer.get().add('patch_saved_tokens', saved)
+            if not patches:
+                break
+            full_slides = TexUtil.apply_frame_patches(full_slides, patches)
+            frames = len(TexUtil.frame_spans(full_slides))
+        return full_slides
+
+    @staticmethod
+    def patch_validator(numbers):
+        """
+        Validator of a response holding frame patches, for frames among numbers only.
+        """
+        def validate(result):
+            try:
+                patches = TexUtil.parse_frame_patches(result)
+            except ValueError as e:
+                return str(e)
+            unknown = [number for number in patches if number not in numbers]
+            if unknown:
+                return f'patches for frames {unknown}'
+            return next((f'frame {number}: {reason}' for number, latex in patches.items()
+                         if number > 0 and (reason := ModelRouter.latex_frames(latex))), None)
+        return validate
+
+    async def lint_slides(self, full_slides):
+        """
+        Polish the slides locally: insert the title frame of each section, and make the deterministic
+        LaTeX repairs of TexLintUtil. Only the frames with problems left are sent to the model.
+        """
+        full_slides = TexUtil.insert_section_frames(full_slides)
+        full_slides, fixes = TexLintUtil.repair(full_slides)
+        issues = TexLintUtil.lint(full_slides)
+        print(f"LaTeX lint: {len(fixes)} local repairs, {len(issues)} problems left.")
+        Tracer.get().add('local_repairs', len(fixes))
+        if issues:
+            full_slides = await self.fix_frames(full_slides, issues)
+        return full_slides
+
+    async def fix_frames(self, full_slides, issues):
+        """
+        Send the frames with problems to the model, and patch in the frames it returns.
+
+        :param issues: List of (frame number, message) pairs, from TexLintUtil.lint or TexLintUtil.log_errors.
+        """
+        numbers = sorted({number for number, _ in issues})
+        print(f"Sending frames {numbers} of {len(TexUtil.frame_spans(full_slides))} to the model to fix them.")
+        Tracer.get().add('llm_repairs')
+        inputs = {'numbered_frames': TexUtil.frames_excerpt(full_slides, numbers),
+                  'errors': '\n'.join(f'frame {number}: {message}' for number, message in issues)}
+        validate = self.patch_validator(numbers)
+        chain = self.route('slides_fix', lambda llm: self.chain('fix_frames', StrOutputParser, llm), 'advance', validate)
+        response = await chain.ainvoke(inputs)
+        invalid = validate(response)
+        if invalid:
+            # The frames are left as they are, for the compilation to report what is still wrong.
+            print(f"fix_frames: the response is not a valid patch ({invalid}), the frames are kept as they are.")
+            Tracer.get().add('invalid_patches')
+            return full_slides
+        patches = TexUtil.parse_frame_patches(response)
+        full_slides = TexUtil.apply_frame_patches(full_slides, {n: latex for n, latex in patches.items() if n in numbers})
+        return TexLintUtil.repair(full_slides)[0]
+
+    async def create_full_slides_by_section(self, notes_set_number=-1):
+        """
+        Generate the full slides of a chapter section by section. The frames of every section are drafted
+        and refined from the notes of that section only, concurrently with the other sections and
+        with the skeleton holding the title, outline, summary and "Thank you" frames. The deck is then
+        stitched together locally, so its latency follows the largest section instead of the whole deck.
+        """
+        slides_template = self._load_slides_template()
+
+        notes_xml = self.notes_dir + f'notes_set{notes_set_number}.xml'
+        if os.path.exists(notes_xml):
+            with open(notes_xml, 'r', encoding='utf-8') as xml_file:
+                notes_set = xml_file.read()
         else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | self.llm_basic | error_parser
-        video_description = chain.invoke({'zero_shot_topic': self.zero_shot_topic,
+            raise FileNotFoundError(f"Notes set file not found: {notes_xml}")
+        section_notes = XmlUtil.split_notes(notes_set, self.sections_list[notes_set_number])
+
+        skeleton, groups = await self.generate_slides_by_section(notes_set, section_notes, slides_template, notes_set_number)
+        full_slides = await self.lint_slides(TexUtil.stitch_sections(skeleton, groups))
+        return await self.save_full_slides(full_slides, notes_set_number)
+
+    async def generate_slides_by_section(self, notes_set, section_notes, slides_template, notes_set_number):
+        """
+        The slides skeleton and the frame group of every section, generated concurrently.
+        """
+        chapter = self.chapters_list[notes_set_number]
+        # The content pages are shared out between the sections, the skeleton adds the title, outline and closing pages.
+        page_number = max(2, self.content_slide_pages // max(1, len(section_notes)))
+
+        def has_placeholder(result):
+            return ModelRouter.latex_frames(result) or (None if TexUtil.SECTIONS_PLACEHOLDER in result else 'no placeholder for the sections')
+
+        async def skeleton():
+            chain = self.route('slides_skeleton', lambda llm: self.chain('section_slides_skeleton', StrOutputParser, llm), 'advance', has_placeholder)
+            return await chain.ainvoke({'zero_shot_topic': self.zero_shot_topic,
+                                        'notes_set': notes_set,
+                                        'tex_template': slides_template,
+                                        'chapter': chapter,
+                                        'notes_set_number': notes_set_number,
+                                        'sections': [section for section, _ in section_notes],
+                                        'placeholder': TexUtil.SECTIONS_PLACEHOLDER})
+
+        async def section_group(section, notes):
+            inputs = {'zero_shot_topic': self.zero_shot_topic, 'chapter': chapter, 'notes_set': notes, 'section': section}
+            chain = self.route('slides_draft', lambda llm: self.chain('section_slides_draft', StrOutputParser, llm), 'advance', ModelRouter.latex_frames)
+            section_slides = await chain.ainvoke({**inputs, 'page_number': page_number})
+            chain = self.route('slides_refine', lambda llm: self.chain('section_slides_refine', StrOutputParser, llm), 'advance', ModelRouter.latex_frames)
+            return await chain.ainvoke({**inputs, 'section_slides': section_slides})
+
+        results = await asyncio.gather(skeleton(), *(section_group(section, notes) for section, notes in section_notes))
+        return results[0], list(results[1:])
+
+    async def save_full_slides(self, full_slides, notes_set_number):
+        """
+        Write the description of the slides for the video and the slides to their tex file.
+        """
+        chain = self.chain('video_description', StrOutputParser, self.llm_basic)
+        video_description = await chain.ainvoke({'zero_shot_topic': self.zero_shot_topic,
                                           'chapter': self.chapters_list[notes_set_number],
                                           'full_slides': full_slides})
         with open(self.debug_dir + f"video_description_chapter_{notes_set_number}.json", 'w', encoding='utf-8') as file:
@@ -424,30 +341,11 @@ class Slides(PipelineStep):
         Generate an image using DALL-E based on a given prompt and save it to a local folder.
         The image is saved with a specific file name based on the notes set number and index.
         """
-        parser = StrOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_advance)
-        if(self.language == 'en'):
-            prompt_1 = ChatPromptTemplate.from_template(
-                """
-                For concept: ```{input}``` in course: {zero_shot_topic}, chapter: {chapter}.
-                Write a new visual prompt for DALL-E while avoiding any mention of books, signs, titles, text, and words etc.
-                Do not include any technical terms, just a simple description.
-                Give a graphic description representation of the concept.
-                """)
-        elif(self.language == 'zh'):
-            prompt_1 = ChatPromptTemplate.from_template(
-                """
-                对于课程：{zero_shot_topic}，章节：{chapter}中的概念：```{input}```。
-                为DALL-E编写一个新的视觉提示，同时避免提及书籍、标志、标题、文本和文字等。
-                不要包含任何技术术语，只需简单的描述。
-                给出概念的图形描述。
-                """)
-        else:
-            raise ValueError("Language is not supported.")
-        chain_1 = prompt_1 | self.llm_advance | error_parser
-        prompt = chain_1.invoke({'input': prompt, 'zero_shot_topic': self.zero_shot_topic, 'chapter': self.chapters_list[notes_set_number]})
+        chain_1 = self.chain('dalle_prompt', StrOutputParser, self.llm_advance, fixing_llm=self.llm_advance)
+        prompt = await chain_1.ainvoke({'input': prompt, 'zero_shot_topic': self.zero_shot_topic, 'chapter': self.chapters_list[notes_set_number]})
 
-        client = openai.OpenAI()
+        # The image call is cancelled at the deadline of the step instead of waiting for the default timeout.
+        client = openai.OpenAI(timeout=self.policy.deadline)
         try:
             print("slides")
             async with rate_limiter.limit(model=model,
@@ -455,7 +353,8 @@ class Slides(PipelineStep):
                     size=size,
                     quality=quality,
                     n=1,):
-                response = client.images.generate(
+                # The client blocks, so it runs in a thread instead of on the loop.
+                response = await asyncio.to_thread(client.images.generate,
                     model=model,
                     prompt=prompt,
                     size=size,
@@ -465,41 +364,19 @@ class Slides(PipelineStep):
         except openai.BadRequestError as e:
             if retry_on_invalid_request:
                 print(f"OpenAI API request was invalid, retrying with default prompt: {e}")
-                parser = StrOutputParser()
-                error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_advance)
-                if(self.language == 'en'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        For course: {zero_shot_topic}, chapter: {chapter}.
-                        Write a new visual prompt for DALL-E while avoiding any mention of books, signs, titles, text, and words etc.
-                        Do not include any technical terms, just a simple description.
-                        Give a graphic description representation of the concept.
-                        Since OpenAI API request was invalid for the previous prompt, try to keep the description safe and harmonious.
-                        """)
-                elif(self.language == 'zh'):
-                    prompt_2 = ChatPromptTemplate.from_template(
-                        """
-                        对于课程：{zero_shot_topic}，章节：{chapter}。
-                        为DALL-E编写一个新的视觉提示，同时避免提及书籍、标志、标题、文本和文字等。
-                        不要包含任何技术术语，只需简单的描述。
-                        给出概念的图形描述。
-                        由于上一个提示的OpenAI API请求无效，请尽量保持描述的安全和和谐。
-                        """)
-                else:
-                    raise ValueError("Language is not supported.")
-                chain_2 = prompt_2 | self.llm_advance | error_parser
-                prompt = chain_2.invoke({'zero_shot_topic': self.zero_shot_topic, 'chapter': self.chapters_list[notes_set_number]})
-
-                self.generate_dalle_image(prompt=prompt, model=model, size=size, quality=quality, notes_set_number=notes_set_number, index=index, retry_on_invalid_request=False)
+                chain_2 = self.chain('dalle_safe_prompt', StrOutputParser, self.llm_advance, fixing_llm=self.llm_advance)
+                prompt = await chain_2.ainvoke({'zero_shot_topic': self.zero_shot_topic, 'chapter': self.chapters_list[notes_set_number]})
+
+                await self.generate_dalle_image(prompt=prompt, model=model, size=size, quality=quality, notes_set_number=notes_set_number, index=index, retry_on_invalid_request=False)
             else:
                 print(f"Retried with default prompt but encountered an error: {e}")
             return
-        except openai.Timeout as e:
+        except openai.APITimeoutError as e:
             print(f"OpenAI API request timed out: {e}")
             return
         # If no exceptions, save the image.
         image_url = response.data[0].url
-        NetworkUtil.save_image_from_url(image_url, self.debug_dir, f"chapter_{notes_set_number}_dalle_image_{index}.png")
+        await asyncio.to_thread(NetworkUtil.save_image_from_url, image_url, self.debug_dir, f"chapter_{notes_set_number}_dalle_image_{index}.png")
 
     def insert_images_into_latex(self, notes_set_number):
         """
@@ -543,12 +420,61 @@ class Slides(PipelineStep):
             file.writelines(modified_content)
         click.echo(f'Tex file {latex_file_path} updated for images insertion.')
 
-    def compile_tex_file_to_pdf(self, notes_set_number):
+    async def compile_tex_file_to_pdf(self, notes_set_number, repair=True):
+        """
+        Compile the slides with xelatex. If the compilation fails, the frames the errors of the log point to
+        are sent to the model to fix them before compiling again, up to Config.SLIDES_COMPILE_ATTEMPTS times.
+        In nonstopmode xelatex still writes the PDF after recoverable errors, e.g. a missing image, and such
+        a PDF is kept.
+
+        :param repair: False to only compile, e.g. slides edited by hand.
+        :raises RuntimeError: If the slides still do not compile to a PDF with pages.
+        """
         tex_name = f"full_slides_for_notes_set{notes_set_number}.tex"
         latex_file_path = os.path.join(os.path.abspath(self.videos_dir), tex_name)
-        # Your command to run xelatex
-        command = ['/Library/TeX/texbin/xelatex', latex_file_path]
-        # Run subprocess with cwd set to the directory of the .tex file
-        with open(self.debug_dir + tex_name + '.log', 'w', encoding='utf-8') as log:
-            subprocess.run(command, cwd=os.path.dirname(latex_file_path), stdout=log)
-            click.echo(f'PDF file for note set {notes_set_number} saved to: {self.videos_dir}{tex_name.replace(".tex", ".pdf")}')
\ No newline at end of file
+        pdf_path = latex_file_path.replace('.tex', '.pdf')
+        log_path = self.debug_dir + tex_name + '.log'
+        # Your command to run xelatex, which must not wait for input on errors
+        command = ['/Library/TeX/texbin/xelatex', '-interaction=nonstopmode', latex_file_path]
+        attempts = Config.SLIDES_COMPILE_ATTEMPTS if repair else 1
+        for attempt in range(attempts):
+            # A PDF of an earlier compilation must not pass for the output of this one.
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+            # Run subprocess with cwd set to the directory of the .tex file
+            with open(log_path, 'w', encoding='utf-8') as log:
+                process = await asyncio.create_subprocess_exec(*command, cwd=os.path.dirname(latex_file_path), stdout=log)
+                returncode = await process.wait()
+            if returncode == 0:
+                click.echo(f'PDF file for note set {notes_set_number} saved to: {self.videos_dir}{tex_name.replace(".tex", ".pdf")}')
+                return
+            with open(log_path, 'r', encoding='utf-8', errors='replace') as log:
+                log_text = log.read()
+            with open(latex_file_path, 'r', encoding='utf-8') as file:
+                full_slides = file.read()
+            errors = TexLintUtil.log_errors(log_text, full_slides)
+            click.echo(f'xelatex failed on frames {sorted({number for number, _ in errors})} of note set {notes_set_number}, see {log_path}')
+            if attempt + 1 == attempts or not errors:
+                break
+            full_slides = await self.fix_frames(full_slides, errors)
+            with open(latex_file_path, 'w', encoding='utf-8') as file:
+                file.write(full_slides)
+        if not self.pdf_page_count(pdf_path):
+            raise RuntimeError(f'The slides of note set {notes_set_number} do not compile, see {log_path}')
+        for number, message in errors:
+            click.echo(f'Frame {number}: {message}')
+        Tracer.get().add('slides_compile_errors', len(errors))
+        click.echo(f'PDF file for note set {notes_set_number} saved with xelatex errors to: {self.videos_dir}{tex_name.replace(".tex", ".pdf")}')
+
+    @staticmethod
+    def pdf_page_count(path):
+        """
+        Number of pages of a PDF, 0 if it is missing or cannot be read.
+        """
+        if not os.path.exists(path):
+            return 0
+        try:
+            with fitz.open(path) as document:
+                return document.page_count
+        except RuntimeError:
+            return 0
@@ -0,0 +1,25 @@
+import importlib
+
+# Step name -> (module, class). The modules are only imported on demand, so a
+# command that runs a single step does not pay for the dependencies of the others
+# (langchain, moviepy, fitz, pydub, Chroma, ...).
+STEPS = {
+    'topic': ('Crafty.pipeline.topic', 'Topic'),
+    'chapter': ('Crafty.pipeline.chapters', 'Chapters'),
+    'section': ('Crafty.pipeline.sections', 'Sections'),
+    'note': ('Crafty.pipeline.notes', 'Notes'),
+    'slide': ('Crafty.pipeline.slides', 'Slides'),
+    'script': ('Crafty.pipeline.script', 'Script'),
+    'voice': ('Crafty.pipeline.voice', 'Voice'),
+    'video': ('Crafty.pipeline.video', 'Video'),
+}
+
+
+def load_step(name):
+    """
+    Import and return the PipelineStep class registered under the given step name.
+    """
+    if name not in STEPS:
+        raise ValueError(f"Unknown step: {name}")
+    module_name, class_name = STEPS[name]
+    return getattr(importlib.import_module(module_name), class_name)
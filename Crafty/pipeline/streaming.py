@@ -0,0 +1,107 @@
+import asyncio
+import os
+import re
+
+import click
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class ChapterStream:
+    """
+    Script, voice and video of a chapter run as one stream instead of three steps one after the other.
+    The slides are scripted concurrently, each finished script is queued for text to speech, and each
+    finished voice is encoded with the image of its page into its video segment. The segments are
+    concatenated once the last one is done, so the latency of the chapter follows its slowest slide
+    plus the concatenation rather than the sum of the three steps.
+
+    The queues between the stages hold Config.STREAM_QUEUE_SIZE items, so a stage which falls behind
+    slows down the one feeding it. Config.STREAM_CONCURRENCY sets the number of slides each stage works
+    on at once. The outputs, and the per slide reuse of the outputs of the last build, are those of the
+    Script, Voice and Video steps, which are recorded in the build manifest once the stream is done.
+    """
+
+    def __init__(self, script, voice, video):
+        self.script = script
+        self.voice = voice
+        self.video = video
+        self.chapter = script.chapter
+
+    @property
+    def steps(self):
+        return (self.script, self.voice, self.video)
+
+    async def run(self):
+        """
+        Stream the chapter unless the outputs of the three steps are up to date.
+        Returns True if the chapter was streamed.
+        """
+        if not any(step.force for step in self.steps) and all(step.is_up_to_date() for step in self.steps):
+            for step in self.steps:
+                await step.run_async()
+            return False
+
+        count = None
+        scripts = asyncio.Queue(Config.STREAM_QUEUE_SIZE)
+        voices = asyncio.Queue(Config.STREAM_QUEUE_SIZE)
+        concurrency = Config.STREAM_CONCURRENCY
+
+        async def script_stage():
+            nonlocal count
+            with self.span('script'):
+                chapter_scripts = await self.script.generate_scripts(
+                    self.chapter, on_script=lambda i, script: scripts.put((i, script)), concurrency=concurrency['script'])
+            count = len(chapter_scripts)
+            for _ in range(concurrency['voice']):
+                await scripts.put(None)
+
+        async def voice_worker():
+            while (item := await scripts.get()) is not None:
+                i, script = item
+                await self.voice.stream_voice(i, script, self.chapter)
+                await voices.put(i)
+
+        async def voice_stage():
+            with self.span('voice'):
+                await asyncio.gather(*(voice_worker() for _ in range(concurrency['voice'])))
+            for _ in range(concurrency['video']):
+                await voices.put(None)
+
+        async def video_worker(images, segments):
+            while (i := await voices.get()) is not None:
+                segments[i] = await asyncio.to_thread(self.video.encode_segment, i, self.chapter, images)
+
+        async def video_stage():
+            with self.span('video'):
+                # The pages are rendered while the first slides are scripted and voiced.
+                images = await asyncio.to_thread(self.video.pdf2image, notes_set_number=self.chapter)
+                segments = {}
+                await asyncio.gather(*(video_worker(images, segments) for _ in range(concurrency['video'])))
+                self.remove_stale_files(count)
+                paths = [segments[i] for i in range(count) if segments.get(i) is not None]
+                await asyncio.to_thread(self.video.combine_segments, paths, self.chapter)
+
+        # A failing stage cancels the others instead of leaving them waiting on their queues.
+        async with asyncio.TaskGroup() as group:
+            group.create_task(script_stage())
+            group.create_task(voice_stage())
+            group.create_task(video_stage())
+
+        for step in self.steps:
+            step.record_artifact()
+        return True
+
+    def span(self, step):
+        return Tracer.get().span('step', course_id=self.script.course_id, step=step, chapter=self.chapter, streamed=True)
+
+    def remove_stale_files(self, count):
+        """
+        Delete the voices and segments of the slides beyond the last one, left by a build with more slides.
+        """
+        pattern = re.compile(rf'voice_(\d+)_chapter_{self.chapter}\.(mp3|mp4)')
+        for name in os.listdir(self.voice.videos_dir):
+            match = pattern.fullmatch(name)
+            if match and int(match.group(1)) >= count:
+                os.remove(os.path.join(self.voice.videos_dir, name))
+                click.echo(f'Removed {name} of a slide which no longer exists.')
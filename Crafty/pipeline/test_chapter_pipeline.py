@@ -0,0 +1,71 @@
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from Crafty.config import Config
+from Crafty.pipeline.chapter_pipeline import ChapterPipeline
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class TimedPipeline(ChapterPipeline):
+    """
+    Pipeline whose steps sleep instead of building anything, and record the steps running at once.
+    """
+
+    SECONDS = {'note': 0.04, 'slide': 0.04, 'script': 0.04, 'voice': 0.04, 'video': 0.04}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = set()
+        self.overlaps = []
+
+    async def run_stage(self, stage, para):
+        self.running.add((stage, para['chapter']))
+        self.overlaps.append(set(self.running))
+        await asyncio.sleep(self.SECONDS[stage])
+        self.running.discard((stage, para['chapter']))
+
+
+class TestChapterPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for patcher in (mock.patch.object(Config, 'PIPELINE_WORKERS', {'llm': 1, 'tts': 1, 'cpu': 1, 'media': 1}),
+                        mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/'),
+                        mock.patch.object(Tracer, '_instance', Tracer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_pipeline(self, depth):
+        pipeline = TimedPipeline({'course_id': 'abc'}, range(4), depth=depth)
+        asyncio.run(pipeline.run())
+        return pipeline
+
+    def test_depth_one_runs_chapters_one_after_the_other(self):
+        pipeline = self.run_pipeline(1)
+        self.assertEqual(1, max(len(running) for running in pipeline.overlaps))
+
+    def test_chapters_overlap_on_different_resources(self):
+        sequential = self.run_pipeline(1)
+        pipelined = self.run_pipeline(3)
+        self.assertLess(pipelined.wall, sequential.wall * 0.8)
+        for running in pipelined.overlaps:
+            # A resource with one worker never runs two steps at once.
+            resources = [ChapterPipeline.RESOURCES[stage] for stage, _ in running]
+            self.assertEqual(len(resources), len(set(resources)))
+        # The model is busy with a later chapter while the first one is voiced.
+        self.assertTrue(any(('voice', 0) in running and {('note', 1), ('slide', 1), ('script', 1)} & running
+                            for running in pipelined.overlaps))
+        self.assertGreater(pipelined.utilization()['llm'], sequential.utilization()['llm'])
+
+    def test_report_lists_the_resources_used(self):
+        report = self.run_pipeline(2).report()
+        for resource in ('llm', 'tts', 'cpu'):
+            self.assertIn(resource, report)
+        self.assertNotIn('media', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
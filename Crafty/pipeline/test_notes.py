@@ -0,0 +1,97 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.notes import Notes
+from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class OfflineNotes(Notes):
+    """
+    Notes step of a course with three chapters, answering from a function instead of a model.
+    """
+
+    def __init__(self, para, respond):
+        PipelineStep.__init__(self, para)
+        os.makedirs(self.notes_dir, exist_ok=True)
+        self.short_video = False
+        self.zero_shot_topic = 'Calculus'
+        self.chapters_list = ['Limits', 'Derivatives', 'Integrals']
+        self.sections_list = [['Limit', 'Continuity'], ['Derivative', 'Chain rule', 'Extrema'], ['Integral']]
+        self.topic = None
+        self.regions = ['Overview', 'Examples', 'Essentiality']
+        self.max_note_expansion_words = 50
+        self.chapter = para['chapter']
+        self.llm = None
+        self.semaphore = asyncio.Semaphore(1)
+        self.respond = respond
+
+    def chain(self, variant, parser, llm, fixing_llm=None):
+        return RunnableLambda(self.respond)
+
+
+class TestAllChapterNotes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for patcher in (mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/'),
+                        mock.patch.object(Config, 'NOTES_BATCH_CONCURRENCY', 4),
+                        mock.patch.object(Tracer, '_instance', Tracer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.para = {'course_id': 'abc', 'language': 'en', 'craft_notes': False, 'file_name': None,
+                     'advanced_model': False, 'chapter': Notes.ALL_CHAPTERS}
+        self.calls = []
+
+    def step(self, failures=None, chapter=Notes.ALL_CHAPTERS):
+        """
+        Step whose response for each section fails the given number of times before succeeding.
+        """
+        failures = failures or {}
+
+        def respond(inputs):
+            section = inputs['section']
+            self.calls.append(section)
+            if self.calls.count(section) <= failures.get(section, 0):
+                raise ValueError('Invalid xml output')
+            return {'root': [{'Overview': f'{section} overview'}]}
+        return OfflineNotes({**self.para, 'chapter': chapter}, respond)
+
+    def notes(self, step, chapter):
+        with open(step.notes_dir + f'notes_set{chapter}.xml', encoding='utf-8') as file:
+            return file.read()
+
+    def test_every_chapter_is_written_from_one_batch(self):
+        step = self.step()
+        self.assertTrue(asyncio.run(step.run_async()))
+        self.assertEqual(6, len(self.calls))
+        for chapter, sections in enumerate(step.sections_list):
+            notes = self.notes(step, chapter)
+            for section in sections:
+                self.assertIn(f'{section} overview', notes)
+            # Each chapter is recorded as if it had been built on its own.
+            self.assertTrue(step.for_chapter(chapter).is_up_to_date())
+
+    def test_only_failed_sections_are_retried(self):
+        step = self.step({'Chain rule': 2})
+        asyncio.run(step.run_async())
+        self.assertEqual(3, self.calls.count('Chain rule'))
+        self.assertEqual(1, self.calls.count('Limit'))
+        self.assertIn('Chain rule overview', self.notes(step, 1))
+
+    def test_up_to_date_chapters_are_skipped(self):
+        asyncio.run(self.step(chapter=1).run_async())
+        self.calls.clear()
+        asyncio.run(self.step().run_async())
+        self.assertEqual(['Continuity', 'Integral', 'Limit'], sorted(self.calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
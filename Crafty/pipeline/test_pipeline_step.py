@@ -0,0 +1,63 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from Crafty.config import Config
+from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class LoopStep(PipelineStep):
+    """
+    Step recording the event loop it runs on.
+    """
+
+    def __init__(self, para, loops):
+        super().__init__(para)
+        self.loops = loops
+
+    async def execute_async(self):
+        await asyncio.sleep(0.01)
+        self.loops.append(asyncio.get_running_loop())
+
+
+class TestPipelineStep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.para = {'course_id': 'abc', 'language': 'en', 'craft_notes': False, 'file_name': None}
+        self.loops = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_sync_runs_share_one_loop(self):
+        self.assertTrue(LoopStep(self.para, self.loops).run())
+        LoopStep(self.para, self.loops).execute()
+        self.assertEqual(2, len(self.loops))
+        self.assertIs(self.loops[0], self.loops[1])
+
+    def test_steps_overlap_on_one_loop(self):
+        async def run_both():
+            return await asyncio.gather(LoopStep(self.para, self.loops).run_async(),
+                                        LoopStep(self.para, self.loops).run_async())
+        self.assertEqual([True, True], asyncio.run(run_both()))
+        self.assertIs(self.loops[0], self.loops[1])
+
+    def test_sync_run_is_traced_within_the_caller_span(self):
+        tracer = Tracer()
+        with mock.patch.object(Tracer, '_instance', tracer):
+            with tracer.span('chapter', course_id='abc', chapter=0) as chapter:
+                LoopStep(self.para, self.loops).run()
+        with open(Config.OUTPUT_DIR + 'abc/' + Config.TRACE_FILE, encoding='utf-8') as file:
+            step = next(span for span in map(json.loads, file) if span['name'] == 'step')
+        self.assertEqual(chapter.span_id, step['parentSpanId'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from langchain_core.runnables import RunnableLambda
+
+from Crafty.config import Config
+from Crafty.pipeline.sections import Sections
+
+
+class OfflineSections(Sections):
+    """
+    Sections step answering from a function instead of a model.
+    """
+
+    def __init__(self, debug_dir, respond):
+        self.structured_output = False
+        self.sections_per_chapter = 5
+        self.language = 'en'
+        self.force = False
+        self.debug_dir = debug_dir
+        self.llm = None
+        self.respond = respond
+
+    def chain(self, variant, parser, llm, fixing_llm=None):
+        return RunnableLambda(self.respond)
+
+    def route(self, task, build, default, validate=None):
+        return build(None)
+
+
+class TestGenerateSections(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'SECTIONS_RETRY_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def step(self, failures):
+        """
+        Step whose response for each chapter fails the given number of times before succeeding.
+        """
+        def respond(inputs):
+            chapter = inputs['chapter_name']
+            self.calls.append(chapter)
+            if self.calls.count(chapter) <= failures.get(chapter, 0):
+                raise ValueError('Invalid json output')
+            return {'sections': [f'{chapter} section']}
+        return OfflineSections(self.tmp_dir.name + '/', respond)
+
+    def test_only_failed_chapters_are_retried(self):
+        sections = asyncio.run(self.step({'b': 2}).robust_generate_sections('Calculus', ['a', 'b', 'c']))
+        self.assertEqual(['a', 'b', 'c'], list(sections))
+        self.assertEqual(['a', 'b', 'b', 'b', 'c'], sorted(self.calls))
+
+    def test_completed_chapters_are_kept_after_a_failure(self):
+        with self.assertRaises(Exception):
+            asyncio.run(self.step({'b': 5}).robust_generate_sections('Calculus', ['a', 'b', 'c'], max_attempts=2))
+        self.assertTrue(os.path.exists(self.tmp_dir.name + '/' + Config.RAW_SECTIONS_PARTIAL))
+        self.calls.clear()
+        sections = asyncio.run(self.step({}).robust_generate_sections('Calculus', ['a', 'b', 'c']))
+        self.assertEqual(['b'], self.calls)
+        self.assertEqual({'sections': ['a section']}, sections['a'])
+
+    def test_saved_chapters_of_another_topic_are_ignored(self):
+        self.step({}).save_partial_sections({'zero_shot_topic': 'Algebra'}, {'a': {'sections': ['x']}})
+        asyncio.run(self.step({}).robust_generate_sections('Calculus', ['a']))
+        self.assertEqual(['a'], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
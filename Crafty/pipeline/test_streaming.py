@@ -0,0 +1,95 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from Crafty.config import Config
+from Crafty.pipeline.streaming import ChapterStream
+
+
+class FakeStep:
+    """
+    Script, voice and video step recording when each slide goes through it.
+    """
+
+    def __init__(self, events, videos_dir, fail=None):
+        self.events = events
+        self.videos_dir = videos_dir
+        self.fail = fail
+        self.chapter = 0
+        self.course_id = 'abc'
+        self.force = False
+        self.recorded = False
+
+    def is_up_to_date(self):
+        return False
+
+    def record_artifact(self):
+        self.recorded = True
+
+    async def generate_scripts(self, notes_set_number, on_script=None, concurrency=1):
+        async def script(i):
+            # The later slides take longer, so they finish out of order with the voices of the first ones.
+            await asyncio.sleep(0.01 * i)
+            self.events.append(('script', i, time.perf_counter()))
+            await on_script(i, f'script {i}')
+        await asyncio.gather(*(script(i) for i in range(5)))
+        return [f'script {i}' for i in range(5)]
+
+    async def stream_voice(self, i, script, notes_set_number):
+        if i == self.fail:
+            raise ValueError(f'voice {i} failed')
+        await asyncio.sleep(0.005)
+        self.events.append(('voice', i, time.perf_counter()))
+
+    def pdf2image(self, notes_set_number):
+        return ['page'] * 5
+
+    def encode_segment(self, index, notes_set_number, images):
+        self.events.append(('video', index, time.perf_counter()))
+        return f'segment {index}'
+
+    def combine_segments(self, segment_paths, notes_set_number):
+        self.events.append(('combine', segment_paths, time.perf_counter()))
+
+
+class TestChapterStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'STREAM_QUEUE_SIZE', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def stream(self, fail=None):
+        step = FakeStep(self.events, self.tmp_dir.name + '/', fail)
+        return step, ChapterStream(step, step, step)
+
+    def test_slides_flow_through_the_stages_as_they_finish(self):
+        step, stream = self.stream()
+        self.assertTrue(asyncio.run(stream.run()))
+        times = {(stage, i): at for stage, i, at in self.events if stage != 'combine'}
+        last_script = max(at for (stage, _), at in times.items() if stage == 'script')
+        # The first slide was voiced and encoded before the last one was scripted.
+        self.assertLess(times[('video', 0)], last_script)
+        for i in range(5):
+            self.assertLess(times[('script', i)], times[('voice', i)])
+            self.assertLess(times[('voice', i)], times[('video', i)])
+        self.assertEqual(('combine', [f'segment {i}' for i in range(5)]), self.events[-1][:2])
+        self.assertTrue(step.recorded)
+
+    def test_a_failing_stage_stops_the_stream(self):
+        step, stream = self.stream(fail=2)
+        with self.assertRaises(ExceptionGroup):
+            asyncio.run(asyncio.wait_for(stream.run(), timeout=5))
+        self.assertNotIn('combine', [event[0] for event in self.events])
+        self.assertFalse(step.recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
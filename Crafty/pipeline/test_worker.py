@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from Crafty.cli import run_step
+from Crafty.config import Config
+from Crafty.pipeline.utils.jobs import JobQueue
+from Crafty.pipeline.utils.trace import Tracer
+from Crafty.pipeline.worker import Worker
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for patcher in (mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/'),
+                        mock.patch.object(Tracer, '_instance', Tracer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.tmp_dir.name, 'jobs.sqlite3')
+
+    def test_invalid_jobs_fail(self):
+        worker = Worker(self.path, run_step)
+        para = {'topic': None, 'short_video': False, 'chapter': -1}
+        # No course_id, and --chapter all on a step other than note.
+        invalid = [worker.queue.submit('section', para),
+                   worker.queue.submit('slide', {**para, 'course_id': 'abc', 'chapter': 'all'})]
+        worker.run(exit_when_empty=True)
+        queue = JobQueue(self.path)
+        self.assertIn('course_id', queue.get(invalid[0])['error'])
+        for job_id in invalid:
+            self.assertEqual(JobQueue.FAILED, queue.get(job_id)['status'])
+        self.assertIn('--chapter all', queue.get(invalid[1])['error'])
+        queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
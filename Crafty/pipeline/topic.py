@@ -2,12 +2,11 @@ import json
 import os
 
 import click
-from langchain.output_parsers import OutputFixingParser
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 
 from Crafty.config import Config
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.science.structured_output import CourseTopic, ainvoke_validated
 
 class Topic(PipelineStep):
     def __init__(self, para):
@@ -22,77 +21,30 @@ class Topic(PipelineStep):
         self.llm = self.llm_basic
         self.short_video = para['short_video']
 
-    def execute(self):
+    async def execute_async(self):
         if(self.craft_notes != True):
-            response = self.prompt_topic()
+            response = await self.prompt_topic()
         else:
             response = self.craft_topic()
         with open(self.meta_dir + Config.META_AND_CHAPTERS, 'w', encoding='utf-8') as file:
             json.dump(response, file, indent=2, ensure_ascii=False)
         click.echo(f'The meta data is saved in {self.meta_dir + Config.META_AND_CHAPTERS}')
 
-    def prompt_topic(self):
-        parser = JsonOutputParser()
-        error_parser = OutputFixingParser.from_llm(parser=parser, llm=self.llm_basic)
-        if(self.language == 'en'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                Requirements: \n\n\n
-                Based on the information of the course information about the course that a student wants to learn: ```{course_info}```.
-                "Context" is a restrictive description of the course,
-                and "subject" is the general topic of the course,
-                and "text" is the detailed description about the content that this user wants to learn.
-                Please answer: what is the zero_shot_topic of this course should be by combining "context", "subject", and "text".
-                For example, input can be like this:
-                ```
-                context: "Bayesian"
-                level: "Beginner"
-                subject: "Machine learning"
-                text: "Bayesian machine learning techniques"
-                ```
-                The response should be formated as json:
-                ```json
-                {{
-                "context": <what is the context of this course>,
-                "level": <what is the level of this course>,
-                "subject": <what is the subject of this course>,
-                "zero_shot_topic": <what is the zero_shot_topic of this course>
-                }}
-                ```
-                """
-            )
-        elif(self.language == 'zh'):
-            prompt = ChatPromptTemplate.from_template(
-                """
-                需求: \n\n\n
-                用中文回答：
-                根据学生想要学习的课程信息，这门课程的信息是：```{course_info}```。
-                "Context" 是对课程的限制性描述，
-                "subject" 是课程的主题，
-                "text" 是关于这个用户想要学习的内容的详细描述。
-                请回答：这门课程的zero_shot_topic应该是什么，通过结合"context"、"subject"和"text"。
-                例如，输入可以是这样的：
-                ```
-                context: "Bayesian"
-                level: "Beginner"
-                subject: "Machine learning"
-                text: "Bayesian machine learning techniques"
-                ```
-                回复应该格式化为json：
-                ```json
-                {{
-                "context": <这门课程的上下文是什么>,
-                "level": <这门课程的级别是什么>,
-                "subject": <这门课程的主题是什么>,
-                "zero_shot_topic": <这门课程的zero_shot_topic是什么>
-                }}
-                ```
-                """
-            )
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({'topic': self.course_info, 'short_video': self.short_video, 'craft_notes': self.craft_notes})
+        return params
+
+    def artifact_outputs(self):
+        return [self.meta_dir + Config.META_AND_CHAPTERS]
+
+    async def prompt_topic(self):
+        if self.structured_output:
+            chain = self.structured_chain('topic', CourseTopic, self.llm)
+            response = await ainvoke_validated(chain, {'course_info': self.course_info})
         else:
-            raise ValueError("Language is not supported.")
-        chain = prompt | self.llm | error_parser
-        response = chain.invoke({'course_info': self.course_info})
+            chain = self.chain('topic', JsonOutputParser, self.llm)
+            response = await chain.ainvoke({'course_info': self.course_info})
         response['short_video'] = self.short_video
         return response
 
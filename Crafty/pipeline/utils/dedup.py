@@ -0,0 +1,82 @@
+import re
+import unicodedata
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+
+class DedupUtil:
+    """
+    Local de-duplication of the sections generated for every chapter of a course.
+    """
+
+    # Leading numbering such as "1.", "2.3 ", "IV.", "b)", "(a)", "Section 4:" or "第一节". A letter or roman
+    # numeral needs a delimiter, so the first word of "C Programming" or "A Brief History" is kept.
+    NUMBERING = re.compile(r'^\s*(?:(?i:section|chapter)\s+(?:\d+(?:\.\d+)*|[IVXLC]+)[.):]?\s+'
+                           r'|\d+(?:\.\d+)*[.):]?\s+|(?:[IVXLC]+|[A-Za-z])[.):]\s+)'
+                           r'|^\s*\(\w+\)\s*|^\s*第[\d一二三四五六七八九十百]+[章节]\s*')
+
+    @staticmethod
+    def strip_numbering(section):
+        return DedupUtil.NUMBERING.sub('', section).strip()
+
+    @staticmethod
+    def normalize(section):
+        """
+        Case, width, punctuation and numbering insensitive form of a section name.
+        """
+        text = unicodedata.normalize('NFKC', DedupUtil.strip_numbering(section)).lower()
+        text = re.sub(r'[^\w\s]', ' ', text)
+        return ' '.join(text.split())
+
+    @staticmethod
+    def similarity(sections):
+        """
+        Cosine similarity of the TF-IDF vectors of character n-grams within words, which matches
+        inflections ("Derivative" / "Derivatives") and works without word segmentation for Chinese.
+        """
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 4))
+        return cosine_similarity(vectorizer.fit_transform([DedupUtil.normalize(s) for s in sections]))
+
+    @staticmethod
+    def dedup_sections(sections_by_chapter, threshold):
+        """
+        Drop sections which repeat a section of an earlier chapter, or an earlier section of the same chapter.
+        A section is a repeat if its normalized name is the same, or if the similarity of the names is at
+        least threshold. Every chapter keeps at least its first section.
+
+        :param sections_by_chapter: List of the section names of each chapter, in chapter order.
+        :return: List of the unique section names of each chapter, without their numbering.
+        """
+        flat = [(chapter, s) for chapter, sections in enumerate(sections_by_chapter)
+                for s in sections if DedupUtil.normalize(s)]
+        if not flat:
+            return [[] for _ in sections_by_chapter]
+        similarity = DedupUtil.similarity([DedupUtil.strip_numbering(s) for _, s in flat])
+        unique = [[] for _ in sections_by_chapter]
+        kept = []
+        seen = set()
+        for i, (chapter, section) in enumerate(flat):
+            key = DedupUtil.normalize(section)
+            if key in seen or (kept and similarity[i, kept].max() >= threshold):
+                continue
+            unique[chapter].append(DedupUtil.strip_numbering(section))
+            kept.append(i)
+            seen.add(key)
+        for chapter, section in flat:
+            # A chapter whose sections all repeat earlier ones keeps its first section.
+            if not unique[chapter]:
+                unique[chapter].append(DedupUtil.strip_numbering(section))
+        return unique
+
+    @staticmethod
+    def agreement(sections_by_chapter, reference_by_chapter):
+        """
+        Mean Jaccard index, per chapter, of the normalized section names of two de-duplications.
+        """
+        scores = []
+        for sections, reference in zip(sections_by_chapter, reference_by_chapter):
+            a = {DedupUtil.normalize(s) for s in sections}
+            b = {DedupUtil.normalize(s) for s in reference}
+            scores.append(len(a & b) / len(a | b) if a | b else 1.0)
+        return sum(scores) / len(scores) if scores else 1.0
@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from Crafty.config import Config
+
+
+class HeadingsUtil:
+    """
+    Headings of a PDF without an outline, found from the layout of its text: lines set in a larger or
+    bolder font than the body text are headings, and each distinct font style is a heading level, the
+    largest first. The result has the [level, title, page] layout of fitz `get_toc()`, so it can be
+    turned into chapters and sections like an outline (see DocHandler.outline_from_toc).
+
+    Pages are read in chunks of Config.HEADING_PAGES_PER_TASK by a process pool, only the short blocks
+    of each page are sent back, and the levels are clustered over the whole document.
+    """
+
+    # Numbering in front of a heading, e.g. '3', '2.1' or 'Chapter 4'.
+    NUMBERING = re.compile(r'^(?:(?:chapter|section|part)\s+)?\d+(?:\.\d+)*\b', re.IGNORECASE)
+    # Blocks with more lines than this are paragraphs rather than headings.
+    MAX_HEADING_LINES = 3
+
+    @staticmethod
+    def read_lines(path, start, stop):
+        """
+        Font statistics and short blocks of pages start to stop of a PDF, a task of the process pool.
+
+        :return: Characters set in each font size, and (page, text, size, bold) of every block of at most
+                 MAX_HEADING_LINES lines, pages numbered from 1.
+        """
+        sizes = Counter()
+        blocks = []
+        with fitz.open(path) as document:
+            for number in range(start, stop):
+                page = document[number]
+                for block in page.get_text('dict', flags=fitz.TEXT_PRESERVE_WHITESPACE)['blocks']:
+                    if block.get('type') != 0:
+                        continue
+                    styles = []
+                    texts = []
+                    for line in block['lines']:
+                        spans = [span for span in line['spans'] if span['text'].strip()]
+                        for span in spans:
+                            sizes[round(span['size'] * 2) / 2] += len(span['text'].strip())
+                        if spans:
+                            texts.append(''.join(span['text'] for span in spans).strip())
+                            styles.append((round(max(span['size'] for span in spans) * 2) / 2,
+                                           all(span['flags'] & fitz.TEXT_FONT_BOLD or 'bold' in span['font'].lower()
+                                               for span in spans)))
+                    # A heading wrapped over a few lines keeps one style.
+                    if texts and len(texts) <= HeadingsUtil.MAX_HEADING_LINES and len(set(styles)) == 1:
+                        blocks.append((number + 1, ' '.join(texts), *styles[0]))
+        return sizes, blocks
+
+    @staticmethod
+    def toc(chunks, page_count):
+        """
+        Outline entries of a document from the results of read_lines over its pages, in page order.
+
+        :return: List of [level, title, page] entries, level 1 being the largest heading style.
+        """
+        sizes = Counter()
+        for chunk_sizes, _ in chunks:
+            sizes.update(chunk_sizes)
+        if not sizes:
+            return []
+        body = sizes.most_common(1)[0][0]
+        blocks = [block for _, chunk_blocks in chunks for block in chunk_blocks]
+
+        # Running heads and feet repeat on many pages, with or without the page number.
+        pages_of = {}
+        for page, text, _, _ in blocks:
+            pages_of.setdefault(HeadingsUtil.without_page_number(text), set()).add(page)
+        repeated = {text for text, pages in pages_of.items() if len(pages) > max(3, page_count // 10)}
+
+        headings = []
+        for page, text, size, bold in blocks:
+            if len(text) > Config.HEADING_MAX_CHARS or not re.search(r'[^\W\d_]', text):
+                continue
+            if HeadingsUtil.without_page_number(text) in repeated:
+                continue
+            larger = size >= body + Config.HEADING_MIN_SIZE_GAP
+            # Headings set in the body size stand out by their weight and numbering.
+            if larger or (bold and size >= body and HeadingsUtil.NUMBERING.match(text)):
+                headings.append((page, text, (size, bold)))
+
+        # The largest style is level 1, a bold style before the regular one of the same size.
+        styles = sorted({style for _, _, style in headings}, key=lambda style: (-style[0], not style[1]))
+        levels = {style: level for level, style in enumerate(styles, start=1)}
+        return [[levels[style], text, page] for page, text, style in headings]
+
+    @staticmethod
+    def without_page_number(text):
+        return re.sub(r'^\d+\s+|\s+\d+$', '', text).strip().lower()
+
+    @staticmethod
+    def find_toc(path, workers=None):
+        """
+        Outline entries of a PDF from its headings, see toc.
+
+        :param workers: Processes reading the pages, the number of CPUs by default. With 1 the pages are
+                        read in this process.
+        """
+        with fitz.open(path) as document:
+            page_count = document.page_count
+        step = Config.HEADING_PAGES_PER_TASK
+        starts = list(range(0, page_count, step))
+        stops = [min(start + step, page_count) for start in starts]
+        workers = min(workers or os.cpu_count() or 1, len(starts))
+        if workers <= 1:
+            chunks = [HeadingsUtil.read_lines(path, start, stop) for start, stop in zip(starts, stops)]
+        else:
+            # The document handler may run in a thread of the event loop, and forking a process with
+            # threads can deadlock, so the workers are spawned.
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                chunks = list(pool.map(HeadingsUtil.read_lines, [path] * len(starts), starts, stops))
+        return HeadingsUtil.toc(chunks, page_count)
+
+    @staticmethod
+    def sample_book(path, pages, chapter_pages=50, section_pages=10):
+        """
+        Write a book without an outline for the tests and the benchmark: a title page, then chapters of
+        chapter_pages pages with a section every section_pages pages, a running head and page numbers.
+
+        :return: The [level, title, page] entries of its chapters and sections.
+        """
+        toc = []
+        with fitz.open() as document:
+            for number in range(1, pages + 1):
+                page = document.new_page()
+                page.insert_text((72, 40), 'A Sample Book', fontsize=9)
+                page.insert_text((300, 810), str(number), fontsize=9)
+                y = 90
+                if number == 1:
+                    page.insert_text((72, 200), 'A Sample Book', fontsize=28, fontname='hebo')
+                    continue
+                if (number - 2) % chapter_pages == 0:
+                    chapter = (number - 2) // chapter_pages + 1
+                    title = f'Chapter {chapter} Topic {chapter}'
+                    page.insert_text((72, y), title, fontsize=20, fontname='hebo')
+                    toc.append([1, title, number])
+                    y += 40
+                if (number - 2) % section_pages == 0:
+                    section = (number - 2) % chapter_pages // section_pages + 1
+                    title = f'{(number - 2) // chapter_pages + 1}.{section} Subject {section}'
+                    page.insert_text((72, y), title, fontsize=14, fontname='hebo')
+                    toc.append([2, title, number])
+                    y += 30
+                paragraph = '\n'.join(f'Line {line} of the body text on page {number}, long enough to be a paragraph.'
+                                      for line in range(30))
+                page.insert_text((72, y), paragraph, fontsize=10)
+            document.save(path)
+        return toc
@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import time
+
+from Crafty.config import Config
+
+class JobQueue:
+    """
+    A local step job queue stored in SQLite.
+
+    Several worker processes on the same machine can share one queue file: jobs are claimed inside an
+    immediate transaction, so each job is handed to exactly one worker. A claimed job is leased to its
+    worker for Config.JOB_LEASE seconds and the worker renews the lease while it runs the job, so the
+    jobs of a worker which crashed or was killed are claimed again once their lease expires.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Autocommit mode, transactions are opened explicitly where they are needed.
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                step TEXT NOT NULL,
+                para TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                submitted_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT,
+                lease_until REAL
+            )
+        """)
+        # Queues created before leases were added.
+        columns = {row['name'] for row in self.conn.execute('PRAGMA table_info(jobs)')}
+        if 'lease_until' not in columns:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN lease_until REAL')
+
+    def submit(self, step, para):
+        """
+        Add a job to the queue and return its id.
+        """
+        cursor = self.conn.execute('INSERT INTO jobs (step, para, status, submitted_at) VALUES (?, ?, ?, ?)',
+                                   (step, json.dumps(para, ensure_ascii=False), self.PENDING, time.time()))
+        return cursor.lastrowid
+
+    def claim(self, worker, lease=None):
+        """
+        Take the oldest pending job, or running job whose lease expired, for the given worker.
+        Returns None if there is no such job.
+
+        :param lease: Seconds the job is leased to the worker, Config.JOB_LEASE by default.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            started_at = time.time()
+            row = self.conn.execute('SELECT * FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY id LIMIT 1',
+                                    (self.PENDING, self.RUNNING, started_at)).fetchone()
+            if row is None:
+                self.conn.execute('COMMIT')
+                return None
+            lease_until = started_at + (Config.JOB_LEASE if lease is None else lease)
+            self.conn.execute('UPDATE jobs SET status = ?, worker = ?, started_at = ?, lease_until = ? WHERE id = ?',
+                              (self.RUNNING, worker, started_at, lease_until, row['id']))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        job = self._to_job(row)
+        # The worker which held an expired lease, if any.
+        job['reclaimed_from'] = row['worker'] if row['status'] == self.RUNNING else None
+        job['status'] = self.RUNNING
+        job['worker'] = worker
+        job['started_at'] = started_at
+        job['lease_until'] = lease_until
+        return job
+
+    def renew(self, job_id, worker, lease=None):
+        """
+        Extend the lease of a running job. Returns False if the job is no longer leased to the worker.
+        """
+        cursor = self.conn.execute('UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?',
+                                   (time.time() + (Config.JOB_LEASE if lease is None else lease), job_id, worker, self.RUNNING))
+        return cursor.rowcount > 0
+
+    def complete(self, job_id):
+        self.conn.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?', (self.DONE, time.time(), job_id))
+
+    def fail(self, job_id, error):
+        self.conn.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+                          (self.FAILED, time.time(), str(error), job_id))
+
+    def requeue(self, worker):
+        """
+        Put the jobs left running by the given worker back into the queue, e.g. after it was interrupted.
+        """
+        self.conn.execute('UPDATE jobs SET status = ?, worker = NULL, started_at = NULL, lease_until = NULL WHERE status = ? AND worker = ?',
+                          (self.PENDING, self.RUNNING, worker))
+
+    def get(self, job_id):
+        row = self.conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_job(row) if row is not None else None
+
+    def counts(self):
+        """
+        Return the number of jobs in each status.
+        """
+        rows = self.conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _to_job(row):
+        job = dict(row)
+        job['para'] = json.loads(job['para'])
+        return job
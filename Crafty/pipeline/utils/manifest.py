@@ -0,0 +1,152 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+
+class Manifest:
+    """
+    Build manifest of a course, stored as JSON next to its outputs.
+
+    For every artifact (one step, possibly for one chapter) it records the content hashes of the input
+    files and the parameters the artifact was built from, and the hashes of the files it produced.
+    An artifact is up to date when its outputs exist and its inputs and parameters did not change since.
+    Outputs edited by hand do not invalidate the artifact itself, only the artifacts reading them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def file_hash(path):
+        """
+        SHA-256 of the file content, or None if the file does not exist.
+        """
+        if not os.path.exists(path):
+            return None
+        sha256_hash = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha256_hash.update(block)
+        return sha256_hash.hexdigest()
+
+    @staticmethod
+    def value_hash(value):
+        """
+        SHA-256 of a JSON serializable value, independent of the order of dict keys.
+        """
+        serialized = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def entry(self, key):
+        return self.load().get(key)
+
+    def is_up_to_date(self, key, inputs, params, outputs):
+        """
+        Check if the artifact was built from the current inputs and parameters, and its outputs still exist.
+
+        :param key: Name of the artifact.
+        :param inputs: Paths of the files the artifact is built from.
+        :param params: JSON serializable parameters the artifact is built with.
+        :param outputs: Paths of the files the artifact consists of.
+        """
+        entry = self.entry(key)
+        if entry is None:
+            return False
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        if entry['params'] != self.value_hash(params):
+            return False
+        return entry['inputs'] == {path: self.file_hash(path) for path in inputs}
+
+    def edited_outputs(self, key, outputs):
+        """
+        Return the outputs whose content changed since the artifact was recorded, e.g. edited by the user.
+        """
+        entry = self.entry(key)
+        if entry is None:
+            return []
+        recorded = entry.get('outputs', {})
+        return [path for path in outputs if path in recorded and recorded[path] != self.file_hash(path)]
+
+    def record(self, key, inputs, params, outputs, **extra):
+        """
+        Record a freshly built artifact. Extra keyword arguments are stored in the entry as they are.
+        """
+        entry = {
+            'inputs': {path: self.file_hash(path) for path in inputs},
+            'params': self.value_hash(params),
+            'outputs': {path: self.file_hash(path) for path in outputs},
+            'built_at': time.time(),
+        }
+        entry.update(extra)
+        self.update(key, entry)
+
+    @staticmethod
+    def reuse_files(previous, current, path):
+        """
+        Reuse per-item files (e.g. one per slide) across builds. Item i has the file path(i) built for the
+        fingerprint current[i]; files built for a fingerprint which is still current are kept or moved to
+        their new index, the others are deleted as stale.
+
+        :param previous: Fingerprints the existing files were built for, by index.
+        :param current: Fingerprints of the items now, by index.
+        :param path: Function mapping an index to the path of its file.
+        :return: Indices of the items whose file has to be built.
+        """
+        wanted = set(current)
+        moved = {}
+        for j, fingerprint in enumerate(previous):
+            if not os.path.exists(path(j)) or (j < len(current) and current[j] == fingerprint):
+                continue
+            if fingerprint in wanted and fingerprint not in moved:
+                moved[fingerprint] = path(j) + '.reuse'
+                os.replace(path(j), moved[fingerprint])
+            else:
+                os.remove(path(j))
+
+        missing = []
+        for i, fingerprint in enumerate(current):
+            if i < len(previous) and previous[i] == fingerprint and os.path.exists(path(i)):
+                continue
+            if fingerprint in moved:
+                shutil.copyfile(moved[fingerprint], path(i))
+            else:
+                missing.append(i)
+        for temp_path in moved.values():
+            os.remove(temp_path)
+        return missing
+
+    def update(self, key, entry):
+        """
+        Replace the entry of an artifact. The manifest is rewritten atomically under a file lock,
+        so processes building different artifacts of the same course do not lose each other's entries.
+        """
+        with self._locked():
+            data = self.load()
+            data[key] = entry
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(data, file, indent=2, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+
+    @contextmanager
+    def _locked(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
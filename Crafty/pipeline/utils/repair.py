@@ -0,0 +1,179 @@
+import json
+import re
+import xml.etree.ElementTree as ET
+
+
+class RepairUtil:
+    """
+    Local repairs of malformed model output, tried before asking a model to fix it.
+    Every repair returns the repaired text, or None if the output could not be repaired.
+    """
+
+    FENCE = re.compile(r"```[\w-]*\s*\n?(.*?)(?:```|$)", re.DOTALL)
+    SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+
+    @staticmethod
+    def strip_fences(text):
+        """
+        Return the content of the first ``` fenced block, or the text itself if there is none.
+        An unclosed fence (truncated output) runs to the end of the text.
+        """
+        match = RepairUtil.FENCE.search(text)
+        return (match.group(1) if match else text).strip()
+
+    @staticmethod
+    def repair_json(text):
+        """
+        Repair fences, prose around the JSON value, trailing commas, Python literals, smart quotes,
+        unescaped quotes and newlines in strings, and output truncated before its closing brackets.
+        """
+        text = RepairUtil.strip_fences(text).translate(RepairUtil.SMART_QUOTES)
+        starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+        if not starts:
+            return None
+        text = text[min(starts):]
+        for candidate in (text, RepairUtil._close_json(RepairUtil._clean_json(text))):
+            try:
+                return json.dumps(json.loads(candidate), ensure_ascii=False)
+            except (json.JSONDecodeError, TypeError):
+                continue
+        return None
+
+    @staticmethod
+    def _clean_json(text):
+        """
+        Rewrite the text character by character, escaping what breaks strings and fixing literals outside them.
+        """
+        out = []
+        in_string = False
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if in_string:
+                if char == '\\' and i + 1 < len(text):
+                    out.append(text[i:i + 2])
+                    i += 2
+                    continue
+                if char == '"':
+                    # A quote only ends the string if the JSON structure continues after it.
+                    rest = text[i + 1:].lstrip()
+                    if not rest or rest[0] in ',:}]':
+                        in_string = False
+                        out.append(char)
+                    else:
+                        out.append('\\"')
+                elif char == '\n':
+                    out.append('\\n')
+                elif char == '\t':
+                    out.append('\\t')
+                else:
+                    out.append(char)
+            elif char == '"':
+                in_string = True
+                out.append(char)
+            elif char == ',':
+                # Drop trailing commas
+                rest = text[i + 1:].lstrip()
+                if rest and rest[0] not in '}]':
+                    out.append(char)
+            else:
+                literal = re.match(r'(True|False|None)\b', text[i:])
+                if literal:
+                    out.append({'True': 'true', 'False': 'false', 'None': 'null'}[literal.group(1)])
+                    i += len(literal.group(1))
+                    continue
+                out.append(char)
+            i += 1
+        return ''.join(out)
+
+    @staticmethod
+    def _close_json(text):
+        """
+        Close the strings, objects and arrays left open by truncated output or by a mismatched
+        closing bracket, and drop anything after the closing bracket of the top level value.
+        """
+        out = []
+        stack = []
+        in_string = False
+        escaped = False
+        for char in text:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                stack.append('}' if char == '{' else ']')
+            elif char in '}]':
+                if char not in stack:
+                    # A closing bracket which was never opened is dropped
+                    continue
+                while stack[-1] != char:
+                    out.append(stack.pop())
+                stack.pop()
+                if not stack:
+                    return ''.join(out) + char
+            out.append(char)
+        text = ''.join(out)
+        if in_string:
+            text += '"'
+        text = text.rstrip()
+        if stack and stack[-1] == '}':
+            # A key cut off before its value is dropped
+            text = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$', r'\1', text)
+        text = re.sub(r',\s*$', '', text)
+        return text + ''.join(reversed(stack))
+
+    @staticmethod
+    def repair_xml(text):
+        """
+        Repair fences, prose before the first tag, bare ampersands and angle brackets, unbalanced
+        tags and output truncated inside a tag or before its closing tags.
+        """
+        text = RepairUtil.strip_fences(text)
+        start = text.find('<')
+        if start < 0:
+            return None
+        text = text[start:]
+        # Drop a tag cut off at the end
+        text = re.sub(r'<[^>]*$', '', text)
+        text = re.sub(r'&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)', '&amp;', text)
+
+        out = []
+        stack = []
+        position = 0
+        for match in re.finditer(r'<(/?)([A-Za-z_][\w.-]*)([^<>]*?)(/?)>|<', text):
+            out.append(text[position:match.start()])
+            position = match.end()
+            if match.group(0) == '<':
+                out.append('&lt;')
+                continue
+            closing, name, _, self_closing = match.groups()
+            if self_closing:
+                out.append(match.group(0))
+            elif not closing:
+                stack.append(name)
+                out.append(match.group(0))
+            elif name in stack:
+                # Close the tags left open inside this one
+                while stack[-1] != name:
+                    out.append(f'</{stack.pop()}>')
+                stack.pop()
+                out.append(match.group(0))
+                if not stack:
+                    # Anything after the root element is dropped
+                    break
+            # A closing tag which was never opened is dropped
+        else:
+            out.append(text[position:])
+        out.extend(f'</{name}>' for name in reversed(stack))
+        repaired = ''.join(out).strip()
+        try:
+            ET.fromstring(repaired)
+        except ET.ParseError:
+            return None
+        return repaired
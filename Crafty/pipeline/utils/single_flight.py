@@ -0,0 +1,107 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import hashlib
+import json
+import threading
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key into one: the first caller (the leader) makes the call,
+    and the callers arriving while it runs (the followers) wait for its result instead of repeating it.
+    Results are not kept once the call ends, so this complements caching during cold-start bursts.
+    Works across threads and event loops.
+    """
+
+    # Set in a context whose calls must not be coalesced, e.g. the duplicate of a hedged request.
+    bypass = contextvars.ContextVar('crafty_single_flight_bypass', default=False)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hash of the JSON serialization of the request parts.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {'leaders': self.leaders, 'followers': self.followers, 'in_flight': len(self._calls)}
+
+    def _join(self, key):
+        """
+        Return the future of the call for key, and whether the caller leads it.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if isinstance(error, (asyncio.CancelledError, concurrent.futures.CancelledError)):
+            # The followers were not cancelled themselves, they call again.
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        """
+        Call fn, or wait for the running call with the same key. Returns the result and whether it was shared.
+        """
+        if self.bypass.get():
+            return fn(), False
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return future.result(), True
+            except concurrent.futures.CancelledError:
+                continue
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result, False
+
+    async def ado(self, key, fn):
+        """
+        Await fn(), or the running call with the same key. Returns the result and whether it was shared.
+        """
+        if self.bypass.get():
+            return await fn(), False
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # Shielded, so cancelling a follower does not cancel the call of the others.
+                return await asyncio.shield(asyncio.wrap_future(future)), True
+            except asyncio.CancelledError:
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result, False
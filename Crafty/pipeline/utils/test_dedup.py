@@ -0,0 +1,43 @@
+import unittest
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.dedup import DedupUtil
+
+
+class TestDedupSections(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual('limits at infinity', DedupUtil.normalize('2.1 Limits at  Infinity!'))
+        self.assertEqual('极限', DedupUtil.normalize('第一节 极限'))
+
+    def test_drops_repeats_of_earlier_chapters(self):
+        sections = [['1. Introduction to Limits', 'Limits at Infinity', 'Continuity', 'The Derivative'],
+                    ['2.1 Derivatives', 'Rules of Differentiation', 'Chain Rule', 'limits at infinity'],
+                    ['Integrals', 'Chain rule!']]
+        self.assertEqual([['Introduction to Limits', 'Limits at Infinity', 'Continuity', 'The Derivative'],
+                          ['Rules of Differentiation', 'Chain Rule'],
+                          ['Integrals']],
+                         DedupUtil.dedup_sections(sections, Config.SECTION_DEDUP_THRESHOLD))
+
+    def test_first_words_are_not_numbering(self):
+        for title in ('Civil Rights Movement', 'A Brief History of Rome', 'C Programming Basics', 'Vi Editor Basics',
+                      'X Rays and Imaging', 'I Ching'):
+            self.assertEqual(title, DedupUtil.strip_numbering(title))
+        for numbered in ('IV. Rome', 'b) Rome', 'Section 4: Rome', 'Chapter II Rome', '3 Rome', '(a) Rome'):
+            self.assertEqual('Rome', DedupUtil.strip_numbering(numbered))
+
+    def test_numbering_is_stripped_from_section_names(self):
+        sections = [['Civil Rights Movement', '2.1 Voting'], ['X Rays and Imaging']]
+        self.assertEqual([['Civil Rights Movement', 'Voting'], ['X Rays and Imaging']],
+                         DedupUtil.dedup_sections(sections, 0.7))
+
+    def test_every_chapter_keeps_a_section(self):
+        self.assertEqual([['Limits'], ['limits']], DedupUtil.dedup_sections([['Limits'], ['limits']], 0.7))
+
+    def test_agreement(self):
+        self.assertEqual(1.0, DedupUtil.agreement([['Limits', 'Continuity']], [['limits', '1. Continuity']]))
+        self.assertEqual(0.75, DedupUtil.agreement([['a', 'b'], ['c']], [['a'], ['c']]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.headings import HeadingsUtil
+
+
+class TestHeadingsUtil(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, 'book.pdf')
+
+    def test_headings_of_a_book_are_found_from_their_fonts(self):
+        expected = HeadingsUtil.sample_book(self.path, 62, chapter_pages=20, section_pages=5)
+        # The running head and the page numbers are not headings.
+        self.assertEqual(expected, HeadingsUtil.find_toc(self.path, workers=1))
+
+    def test_process_pool_finds_the_same_headings(self):
+        HeadingsUtil.sample_book(self.path, 62, chapter_pages=20, section_pages=5)
+        with mock.patch.object(Config, 'HEADING_PAGES_PER_TASK', 20):
+            self.assertEqual(HeadingsUtil.find_toc(self.path, workers=1), HeadingsUtil.find_toc(self.path, workers=2))
+
+    def test_bold_numbered_lines_of_the_body_size_are_headings(self):
+        sizes = Counter({10.0: 5000, 16.0: 40})
+        blocks = [(1, 'Introduction', 16.0, True), (2, '1.1 Scope', 10.0, True), (2, 'Note', 10.0, True),
+                  (3, 'A remark in the text', 10.0, False)]
+        self.assertEqual([[1, 'Introduction', 1], [2, '1.1 Scope', 2]], HeadingsUtil.toc([(sizes, blocks)], 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
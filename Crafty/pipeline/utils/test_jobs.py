@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from Crafty.pipeline.utils.jobs import JobQueue
+
+
+def claim_all(path, worker, results):
+    queue = JobQueue(path)
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            break
+        results.put(job['id'])
+        queue.complete(job['id'])
+    queue.close()
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'jobs.sqlite3')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_claim_in_submission_order(self):
+        queue = JobQueue(self.path)
+        first = queue.submit('note', {'course_id': 'abc', 'chapter': 0})
+        second = queue.submit('slide', {'course_id': 'abc', 'chapter': 0})
+        job = queue.claim('worker-1')
+        self.assertEqual(first, job['id'])
+        self.assertEqual({'course_id': 'abc', 'chapter': 0}, job['para'])
+        self.assertEqual(second, queue.claim('worker-1')['id'])
+        self.assertIsNone(queue.claim('worker-1'))
+
+    def test_requeue_interrupted_jobs(self):
+        queue = JobQueue(self.path)
+        job_id = queue.submit('voice', {'chapter': 1})
+        queue.claim('worker-1')
+        queue.requeue('worker-1')
+        self.assertEqual(job_id, queue.claim('worker-2')['id'])
+
+    def test_jobs_of_a_dead_worker_are_claimed_again(self):
+        queue = JobQueue(self.path)
+        job_id = queue.submit('voice', {'chapter': 1})
+        queue.claim('worker-1', lease=0.05)
+        self.assertIsNone(queue.claim('worker-2'))
+        time.sleep(0.1)
+        job = queue.claim('worker-2')
+        self.assertEqual((job_id, 'worker-1'), (job['id'], job['reclaimed_from']))
+        self.assertFalse(queue.renew(job_id, 'worker-1'))
+
+    def test_renewed_lease_is_kept(self):
+        queue = JobQueue(self.path)
+        job_id = queue.submit('voice', {'chapter': 1})
+        queue.claim('worker-1', lease=0.05)
+        self.assertTrue(queue.renew(job_id, 'worker-1', lease=60))
+        time.sleep(0.1)
+        self.assertIsNone(queue.claim('worker-2'))
+
+    def test_workers_never_share_a_job(self):
+        queue = JobQueue(self.path)
+        job_ids = [queue.submit('video', {'chapter': i}) for i in range(40)]
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=claim_all, args=(self.path, f'worker-{i}', results)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        claimed = [results.get() for _ in job_ids]
+        self.assertEqual(sorted(job_ids), sorted(claimed))
+        self.assertEqual({JobQueue.DONE: 40}, queue.counts())
+
+
+if __name__ == '__main__':
+    unittest.main()
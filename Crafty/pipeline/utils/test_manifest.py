@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from Crafty.pipeline.utils.manifest import Manifest
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.manifest = Manifest(os.path.join(self.tmp_dir.name, 'manifest.json'))
+        self.input = self.write('notes.xml', '<notes/>')
+        self.output = self.write('slides.tex', '\\begin{document}')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_up_to_date_until_input_changes(self):
+        params = {'language': 'en', 'pages': 3}
+        self.assertFalse(self.manifest.is_up_to_date('slides_0', [self.input], params, [self.output]))
+        self.manifest.record('slides_0', [self.input], params, [self.output])
+        self.assertTrue(self.manifest.is_up_to_date('slides_0', [self.input], {'pages': 3, 'language': 'en'}, [self.output]))
+        self.write('notes.xml', '<notes><section/></notes>')
+        self.assertFalse(self.manifest.is_up_to_date('slides_0', [self.input], params, [self.output]))
+
+    def test_params_and_missing_outputs_invalidate(self):
+        self.manifest.record('slides_0', [self.input], {'pages': 3}, [self.output])
+        self.assertFalse(self.manifest.is_up_to_date('slides_0', [self.input], {'pages': 4}, [self.output]))
+        os.remove(self.output)
+        self.assertFalse(self.manifest.is_up_to_date('slides_0', [self.input], {'pages': 3}, [self.output]))
+
+    def test_edited_outputs_keep_artifact_up_to_date(self):
+        self.manifest.record('slides_0', [self.input], {}, [self.output])
+        self.write('slides.tex', '\\begin{document} edited')
+        self.assertTrue(self.manifest.is_up_to_date('slides_0', [self.input], {}, [self.output]))
+        self.assertEqual([self.output], self.manifest.edited_outputs('slides_0', [self.output]))
+
+    def test_reuse_files_moves_unchanged_items_and_drops_stale(self):
+        path = lambda i: os.path.join(self.tmp_dir.name, f'voice_{i}.mp3')
+        for i, content in enumerate(['a', 'b', 'c']):
+            self.write(f'voice_{i}.mp3', content)
+        # A slide was inserted before 'b' and the last one removed.
+        missing = Manifest.reuse_files(['a', 'b', 'c'], ['a', 'new', 'b'], path)
+        self.assertEqual([1], missing)
+        self.assertFalse(os.path.exists(path(1)))
+        with open(path(2)) as file:
+            self.assertEqual('b', file.read())
+        self.assertEqual(['voice_0.mp3', 'voice_2.mp3'],
+                         sorted(f for f in os.listdir(self.tmp_dir.name) if f.startswith('voice_')))
+
+
+if __name__ == '__main__':
+    unittest.main()
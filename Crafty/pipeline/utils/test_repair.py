@@ -0,0 +1,50 @@
+import json
+import unittest
+import xml.etree.ElementTree as ET
+
+from Crafty.pipeline.utils.repair import RepairUtil
+
+
+class TestRepairJson(unittest.TestCase):
+
+    def assertRepaired(self, text, expected):
+        repaired = RepairUtil.repair_json(text)
+        self.assertIsNotNone(repaired, text)
+        self.assertEqual(expected, json.loads(repaired))
+
+    def test_fences_prose_and_trailing_commas(self):
+        self.assertRepaired('Here are the chapters:\n```json\n{"Chapters": ["a", "b",],}\n```',
+                            {'Chapters': ['a', 'b']})
+        self.assertRepaired('{"Chapters": ["a", "b",}', {'Chapters': ['a', 'b']})
+
+    def test_literals_and_quotes(self):
+        self.assertRepaired('{“short”: True, "note": None}', {'short': True, 'note': None})
+        self.assertRepaired('{"title": "The "best" method\nof all"}', {'title': 'The "best" method\nof all'})
+
+    def test_truncated_output(self):
+        self.assertRepaired('{"Chapters": ["Limits", "Deriv', {'Chapters': ['Limits', 'Deriv']})
+        self.assertRepaired('{"Topic": "Calculus", "Sections": {"Limits": ["a"], "Deri',
+                            {'Topic': 'Calculus', 'Sections': {'Limits': ['a']}})
+
+    def test_unrepairable(self):
+        self.assertIsNone(RepairUtil.repair_json('No JSON here.'))
+
+
+class TestRepairXml(unittest.TestCase):
+
+    def test_unescaped_text_and_junk_after_root(self):
+        repaired = RepairUtil.repair_xml('```xml\n<notes><a>x < y & z</a></notes>\nHope this helps!```')
+        self.assertEqual('x < y & z', ET.fromstring(repaired).find('a').text)
+
+    def test_truncated_output(self):
+        repaired = RepairUtil.repair_xml('<notes><section><a>Limits</a><b>Deri')
+        root = ET.fromstring(repaired)
+        self.assertEqual('Limits', root.find('section/a').text)
+        self.assertEqual('Deri', root.find('section/b').text)
+
+    def test_unrepairable(self):
+        self.assertIsNone(RepairUtil.repair_xml('No XML here.'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from Crafty.pipeline.utils.single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+
+    def slow_call(self):
+        self.calls += 1
+        time.sleep(0.1)
+        return 'result'
+
+    async def aslow_call(self):
+        self.calls += 1
+        await asyncio.sleep(0.1)
+        return 'result'
+
+    def test_concurrent_threads_share_one_call(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.flight.do('topic', self.slow_call)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.calls)
+        self.assertEqual(['result'] * 5, [result for result, _ in results])
+        self.assertEqual(4, sum(shared for _, shared in results))
+        self.assertEqual({'leaders': 1, 'followers': 4, 'in_flight': 0}, self.flight.stats())
+
+    def test_concurrent_tasks_share_one_call(self):
+        async def calls():
+            return await asyncio.gather(*(self.flight.ado('topic', self.aslow_call) for _ in range(5)),
+                                        self.flight.ado('other topic', self.aslow_call))
+        results = asyncio.run(calls())
+        self.assertEqual(2, self.calls)
+        self.assertEqual(['result'] * 6, [result for result, _ in results])
+
+    def test_sequential_calls_are_not_shared(self):
+        self.flight.do('topic', self.slow_call)
+        self.flight.do('topic', self.slow_call)
+        self.assertEqual(2, self.calls)
+
+    def test_followers_call_again_when_the_leader_is_cancelled(self):
+        async def calls():
+            leader = asyncio.ensure_future(self.flight.ado('topic', self.aslow_call))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(self.flight.ado('topic', self.aslow_call))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower
+        self.assertEqual(('result', False), asyncio.run(calls()))
+        self.assertEqual(2, self.calls)
+
+    def test_errors_are_shared(self):
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise ValueError('rate limited')
+
+        async def calls():
+            return await asyncio.gather(*(self.flight.ado('topic', fail) for _ in range(2)), return_exceptions=True)
+        self.assertEqual([ValueError, ValueError], [type(result) for result in asyncio.run(calls())])
+
+    def test_bypass(self):
+        async def calls():
+            async def hedge():
+                SingleFlight.bypass.set(True)
+                return await self.flight.ado('topic', self.aslow_call)
+            return await asyncio.gather(self.flight.ado('topic', self.aslow_call), hedge())
+        asyncio.run(calls())
+        self.assertEqual(2, self.calls)
+
+    def test_key(self):
+        self.assertEqual(SingleFlight.key({'model': 'gpt-4o', 'temperature': 0}, ['a']),
+                         SingleFlight.key({'temperature': 0, 'model': 'gpt-4o'}, ['a']))
+        self.assertNotEqual(SingleFlight.key({'model': 'gpt-4o'}, ['a']), SingleFlight.key({'model': 'gpt-4o'}, ['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from Crafty.pipeline.utils.tex import TexUtil
+
+SKELETON = r"""\documentclass{beamer}
+\begin{document}
+\begin{frame}{Chapter 1: Limits}\end{frame}
+\begin{frame}{Outline}\end{frame}
+%SECTIONS%
+\begin{frame}{Summary}\end{frame}
+\begin{frame}{Thank you}\end{frame}
+\end{document}"""
+
+
+class TestStitchSections(unittest.TestCase):
+
+    def test_groups_go_at_the_placeholder_in_order(self):
+        slides = TexUtil.stitch_sections(SKELETON, [r'\section{A}\begin{frame}{A}\end{frame}',
+                                                    r'\section{B}\begin{frame}{B}\end{frame}'])
+        self.assertNotIn(TexUtil.SECTIONS_PLACEHOLDER, slides)
+        titles = [TexUtil.parse_latex_slides_raw(slides)[i].strip('_') for i in range(6)]
+        self.assertEqual(['Chapter 1_ Limits', 'Outline', 'A', 'B', 'Summary', 'Thank you'], titles)
+
+    def test_wrapping_of_a_group_is_removed(self):
+        group = "```latex\n\\documentclass{beamer}\n\\begin{document}\n\\begin{frame}{A}\\end{frame}\n\\end{document}\n```"
+        self.assertEqual(r'\begin{frame}{A}\end{frame}', TexUtil.frame_group(group))
+
+    def test_without_placeholder_groups_go_before_the_summary(self):
+        slides = TexUtil.stitch_sections(SKELETON.replace('%SECTIONS%\n', ''), [r'\begin{frame}{A}\end{frame}'])
+        self.assertLess(slides.index('{A}'), slides.index('{Summary}'))
+        self.assertGreater(slides.index('{A}'), slides.index('{Outline}'))
+
+
+class TestFramePatches(unittest.TestCase):
+
+    def setUp(self):
+        self.slides = TexUtil.stitch_sections(SKELETON, [r'\section{A}' '\n' r'\begin{frame}{A}\end{frame}'])
+
+    def test_numbering_keeps_the_slides(self):
+        numbered = TexUtil.number_frames(self.slides)
+        self.assertEqual(self.slides, '\n'.join(line for line in numbered.split('\n') if not line.startswith('% frame')))
+        self.assertIn('% frame 3\n' r'\begin{frame}{A}', numbered)
+
+    def test_patches_replace_their_frames_only(self):
+        response = '%%% FRAME 3\n' r'\begin{frame}{A}\end{frame}' '\n' r'\begin{frame}{A, continued}\end{frame}' '\n%%% END\n'
+        slides = TexUtil.apply_frame_patches(self.slides, TexUtil.parse_frame_patches(response))
+        self.assertEqual(6, len(TexUtil.frame_spans(slides)))
+        self.assertIn(r'\section{A}' '\n' r'\begin{frame}{A}\end{frame}' '\n' r'\begin{frame}{A, continued}', slides)
+        self.assertTrue(slides.startswith(r'\documentclass{beamer}'))
+        self.assertTrue(slides.endswith(r'\end{document}'))
+
+    def test_no_changes(self):
+        self.assertEqual({}, TexUtil.parse_frame_patches('%%% NO CHANGES'))
+        with self.assertRaises(ValueError):
+            TexUtil.parse_frame_patches(self.slides)
+
+    def test_excerpt_holds_the_given_frames_only(self):
+        self.assertEqual('% frame 3\n' r'\begin{frame}{A}\end{frame}', TexUtil.frames_excerpt(self.slides, [3]))
+
+    def test_section_title_frames(self):
+        slides = TexUtil.insert_section_frames(self.slides.replace(r'{A}\end', r'{A}Limits\end'))
+        self.assertIn(r'\section{A}' '\n' r'\begin{frame}{A}' '\n' r'\end{frame}' '\n' r'\begin{frame}{A}Limits', slides)
+        self.assertEqual(slides, TexUtil.insert_section_frames(slides))
+
+    def test_unknown_frame(self):
+        with self.assertRaises(ValueError):
+            TexUtil.apply_frame_patches(self.slides, {9: r'\begin{frame}\end{frame}'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from Crafty.pipeline.utils.tex_lint import TexLintUtil
+
+SLIDES = r"""\documentclass{beamer}
+\begin{document}
+\begin{frame}{Costs}
+50% of the cost_total is $5 per unit, math $x_1 + y^2$
+\end{frame}
+\begin{frame}{Table}
+\begin{tabular}{cc}
+a & b \\
+\end{tabular}
+\url{http://example.com/a_b#c} % a comment with _ and &
+\end{frame}
+\end{document}
+"""
+
+
+class TestTexLint(unittest.TestCase):
+
+    def test_text_specials_are_escaped(self):
+        slides, fixes = TexLintUtil.repair(SLIDES)
+        self.assertIn(r'50\% of the cost\_total is \$5 per unit, math $x_1 + y^2$', slides)
+        self.assertIn('a & b', slides)
+        self.assertIn(r'\url{http://example.com/a_b#c} % a comment with _ and &', slides)
+        self.assertEqual([], TexLintUtil.lint(slides))
+        self.assertEqual((slides, []), TexLintUtil.repair(slides))
+
+    def test_code_is_not_escaped(self):
+        code = ("\\begin{lstlisting}[language=Python]\ndef my_func(x): # comment\n    return {a_b & c: 5}\n"
+                "\\end{lstlisting}\nRun \\verb|a_b & $HOME| with cost_total")
+        slides, fixes = TexLintUtil.repair(SLIDES.replace('\\begin{frame}{Costs}', '\\begin{frame}[fragile]{Code}\n' + code))
+        self.assertIn(code.replace('cost_total', 'cost\\_total'), slides)
+        self.assertEqual([], TexLintUtil.lint(slides))
+
+    def test_options_are_not_escaped(self):
+        slides, fixes = TexLintUtil.repair(SLIDES.replace('\\begin{frame}{Table}', '\\begin{frame}[label=intro_topic]{Table}')
+                                           .replace('\\url', '\\hyperlink{intro_topic}{Back} \\url'))
+        self.assertIn('\\begin{frame}[label=intro_topic]{Table}', slides)
+        self.assertIn('\\hyperlink{intro_topic}{Back}', slides)
+
+    def test_structure_is_repaired(self):
+        broken = "Here are the slides:\n```latex\n" + SLIDES.replace('\\end{frame}\n\\begin{frame}{Table}', '\\begin{frame}{Table}') \
+            .replace('\\end{tabular}', '\\end{tabular}\n\\textbf{bold\n\\end{itemize}').replace('\\end{document}\n', '') + "```\n"
+        slides, fixes = TexLintUtil.repair(broken)
+        self.assertTrue(slides.startswith('\\documentclass'))
+        self.assertEqual(2, slides.count('\\end{frame}'))
+        self.assertIn('\\textbf{bold}', slides)
+        self.assertNotIn('itemize', slides)
+        self.assertTrue(slides.rstrip().endswith('\\end{document}'))
+        self.assertEqual([], TexLintUtil.lint(slides))
+
+    def test_unbalanced_math_is_left_to_the_model(self):
+        slides, _ = TexLintUtil.repair(SLIDES.replace('is $5', 'is 5').replace('y^2$', 'y^2'))
+        self.assertEqual([(1, 'unbalanced $ math delimiters')], TexLintUtil.lint(slides))
+
+    def test_log_errors_map_to_frames(self):
+        log = "! Undefined control sequence.\nl.9 a & b \\\\\n! LaTeX Error: Something else."
+        self.assertEqual([(2, 'Undefined control sequence.'), (0, 'LaTeX Error: Something else.')],
+                         TexLintUtil.log_errors(log, SLIDES))
+
+
+if __name__ == '__main__':
+    unittest.main()
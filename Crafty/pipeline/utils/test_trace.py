@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.messages import AIMessage
+
+from Crafty.config import Config
+from Crafty.pipeline.science.api_handler import TraceCallbackHandler
+from Crafty.pipeline.utils.trace import Tracer, llm_cost
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(Config, 'OUTPUT_DIR', self.tmp_dir.name + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tracer = Tracer()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_spans(self, course_id):
+        with open(os.path.join(self.tmp_dir.name, course_id, Config.TRACE_FILE)) as file:
+            return [json.loads(line) for line in file]
+
+    def test_spans_nest_across_async_tasks(self):
+        async def call(i):
+            with self.tracer.span('llm', index=i):
+                await asyncio.sleep(0)
+
+        async def calls():
+            await asyncio.gather(*(call(i) for i in range(3)))
+
+        with self.tracer.span('step', course_id='abc', step='notes', chapter=2) as step:
+            asyncio.run(calls())
+
+        spans = self.read_spans('abc')
+        self.assertEqual(['llm', 'llm', 'llm', 'step'], [span['name'] for span in spans])
+        for span in spans[:3]:
+            self.assertEqual(step.span_id, span['parentSpanId'])
+            attributes = {attribute['key']: attribute['value'] for attribute in span['attributes']}
+            self.assertEqual({'stringValue': 'notes'}, attributes['step'])
+            self.assertEqual({'intValue': '2'}, attributes['chapter'])
+
+    def test_model_calls_roll_up_to_their_step(self):
+        handler = TraceCallbackHandler()
+        with mock.patch.object(Tracer, '_instance', self.tracer):
+            with self.tracer.span('step', course_id='abc', step='slides'):
+                run_id = uuid.uuid4()
+                handler.on_chat_model_start({}, [[]], run_id=run_id)
+                self.tracer.add('retries')
+                handler.on_llm_end(LLMResult(
+                    generations=[[ChatGeneration(message=AIMessage(content='ok'))]],
+                    llm_output={'model_name': 'gpt-4o',
+                                'token_usage': {'prompt_tokens': 1000, 'completion_tokens': 100,
+                                                'prompt_tokens_details': {'cached_tokens': 400}}}), run_id=run_id)
+
+        row = self.tracer.summary()['slides']
+        self.assertEqual(1, row['runs'])
+        self.assertEqual(1, row['calls'])
+        self.assertEqual(1000, row['prompt_tokens'])
+        self.assertEqual(400, row['cached_tokens'])
+        self.assertAlmostEqual(0.4, row['cache_hit_rate'])
+        self.assertEqual(1, row['retries'])
+        self.assertAlmostEqual(llm_cost('gpt-4o', 1000, 100, 400), row['cost_usd'])
+        self.assertIn('slides', self.tracer.summary_table())
+
+    def test_totals_are_kept_instead_of_spans(self):
+        for _ in range(3):
+            with self.tracer.span('step', course_id='abc', step='notes'):
+                with self.tracer.span('llm') as call:
+                    call.add('cost_usd', 0.5)
+        row = self.tracer.summary()['notes']
+        self.assertEqual((3, 3), (row['runs'], row['calls']))
+        self.assertAlmostEqual(1.5, row['cost_usd'])
+        self.assertFalse(hasattr(self.tracer, 'spans'))
+        self.assertEqual(6, len(self.read_spans('abc')))
+
+    def test_llm_cost_matches_model_versions(self):
+        self.assertAlmostEqual(20.0, llm_cost('gpt-4o-2024-05-13', 1_000_000, 1_000_000))
+        self.assertEqual(0.0, llm_cost('unknown-model', 1000, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
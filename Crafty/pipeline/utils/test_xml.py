@@ -0,0 +1,48 @@
+import unittest
+import xml.etree.ElementTree as ET
+
+from Crafty.pipeline.utils.xml import XmlUtil
+
+
+def notes_xml(sections_number):
+    """
+    Serialize a chapter of notes the way Notes does, from parsed model results with three regions per section.
+    """
+    sections = [f'Section {i}' for i in range(sections_number)]
+    results = [{f'Section_{i}': [{'Outline': f'Outline of section {i}. ' * 20},
+                                 {'Examples': f'Examples of section {i}. ' * 20},
+                                 {'Essentiality': f'Essentiality of section {i}. ' * 20}]}
+               for i in range(sections_number)]
+    notes_exp = dict(zip(sections, XmlUtil.nest_dict_to_xml(results)))
+    return ET.tostring(XmlUtil.dict_to_xml('notes_expansion', notes_exp), encoding='unicode')
+
+
+class TestNestDictToXml(unittest.TestCase):
+
+    def test_each_root_holds_only_its_item(self):
+        roots = XmlUtil.nest_dict_to_xml([{'Section_0': 'a'}, {'Section_1': 'b'}])
+        self.assertEqual(['Section_0'], [child.tag for child in roots[0]])
+        self.assertEqual(['Section_1'], [child.tag for child in roots[1]])
+
+    def test_notes_size_grows_linearly_with_sections(self):
+        sizes = {n: len(notes_xml(n)) for n in (5, 10, 20)}
+        per_section = [size / n for n, size in sizes.items()]
+        # Linear growth keeps the size per section constant, up to the wrapping element.
+        self.assertLess(max(per_section) / min(per_section), 1.05, f'notes XML size by sections per chapter: {sizes}')
+
+
+class TestSplitNotes(unittest.TestCase):
+
+    def test_sections_are_split_in_order(self):
+        notes = XmlUtil.split_notes(notes_xml(3), ['Section 0', 'Section 1', 'Section 2'])
+        self.assertEqual(['Section 0', 'Section 1', 'Section 2'], [section for section, _ in notes])
+        self.assertIn('Examples of section 1.', notes[1][1])
+        self.assertNotIn('section 0', notes[1][1])
+
+    def test_names_come_from_the_tags_without_a_matching_list(self):
+        notes = XmlUtil.split_notes('<notes_expansion><Limits_at_infinity>a</Limits_at_infinity></notes_expansion>', [])
+        self.assertEqual([('Limits at infinity', '<Limits_at_infinity>a</Limits_at_infinity>')], notes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,11 @@ import re
 
 
 class TexUtil:
+    # Line of the slides skeleton replaced by the frames of the sections.
+    SECTIONS_PLACEHOLDER = '%SECTIONS%'
+    # Frame patches returned by the refinement passes, see parse_frame_patches.
+    FRAME_PATCH = re.compile(r'^%%% FRAME (\d+)[ \t]*\n(.*?)^%%% END', re.DOTALL | re.MULTILINE)
+    NO_CHANGES = '%%% NO CHANGES'
 
     @staticmethod
     def generate_latex_template(style):
@@ -76,14 +81,15 @@ class TexUtil:
 
         return template
 
+    @staticmethod
+    def template_path(file_name):
+        return "Crafty/pipeline/templates/" + file_name + ".tex"
+
     @staticmethod
     def load_tex_content(file_name):
+        # Construct the full path to the file in the 'templates' folder
+        full_path = TexUtil.template_path(file_name)
         file_name = file_name + ".tex"
-        # Define the path to the 'templates' folder
-        folder_path = 'templates'
-        # Construct the full path to the file
-        # full_path = f'./{folder_path}/{file_name}'
-        full_path = "Crafty/pipeline/templates/" + file_name
         print("\nfull_path for pdf template: ", full_path)
         # Open the file and read its content
         try:
@@ -135,3 +141,114 @@ class TexUtil:
             modified_frames.append(modified_frame)
         # Return the list containing the modified text of all slides.
         return modified_frames
+
+    @staticmethod
+    def frame_group(latex_content):
+        """
+        The frames of a section generated on their own, without the code fences, preamble or document
+        environment a model may wrap them in.
+        """
+        text = re.sub(r'^\s*```[a-zA-Z]*\s*\n|\n\s*```\s*$', '', latex_content.strip())
+        body = re.search(r'\\begin\{document\}(.*?)(\\end\{document\}|$)', text, re.DOTALL)
+        if body:
+            text = body.group(1)
+        return text.strip()
+
+    @staticmethod
+    def stitch_sections(skeleton, groups):
+        """
+        Insert the frame groups of the sections into the slides skeleton, at its placeholder line.
+        Without the placeholder, they go before the summary and "Thank you" frames closing the skeleton.
+        """
+        body = '\n\n'.join(TexUtil.frame_group(group) for group in groups)
+        skeleton = TexUtil.frame_group(skeleton) if '\\begin{document}' not in skeleton else skeleton.strip()
+        if TexUtil.SECTIONS_PLACEHOLDER in skeleton:
+            return skeleton.replace(TexUtil.SECTIONS_PLACEHOLDER, body, 1)
+        frames = [m.start() for m in re.finditer(r'\\begin\{frame\}', skeleton)]
+        if len(frames) >= 4:
+            position = frames[-2]
+        elif '\\end{document}' in skeleton:
+            position = skeleton.rindex('\\end{document}')
+        else:
+            position = len(skeleton)
+        return skeleton[:position] + body + '\n\n' + skeleton[position:]
+
+    @staticmethod
+    def frame_spans(latex_content):
+        """
+        (start, end) offsets of every frame of the slides, in order.
+        """
+        return [m.span() for m in re.finditer(r'\\begin\{frame\}.*?\\end\{frame\}', latex_content, re.DOTALL)]
+
+    @staticmethod
+    def number_frames(latex_content):
+        """
+        The slides with a "% frame <number>" line above every frame, numbered from 1, and "% frame 0"
+        above the part before the first frame, so a model can refer to frames in patches.
+        """
+        parts = ['% frame 0\n']
+        position = 0
+        for number, (start, end) in enumerate(TexUtil.frame_spans(latex_content), start=1):
+            parts += [latex_content[position:start], f'% frame {number}\n', latex_content[start:end]]
+            position = end
+        parts.append(latex_content[position:])
+        return ''.join(parts)
+
+    @staticmethod
+    def frames_excerpt(latex_content, numbers):
+        """
+        Only the given frames of the slides, each under its "% frame <number>" line as in number_frames.
+        """
+        spans = TexUtil.frame_spans(latex_content)
+        first = spans[0][0] if spans else len(latex_content)
+        frames = [latex_content[:first]] + [latex_content[start:end] for start, end in spans]
+        return '\n\n'.join(f'% frame {number}\n{frames[number].strip()}' for number in sorted(set(numbers)) if number < len(frames))
+
+    @staticmethod
+    def insert_section_frames(latex_content):
+        """
+        Insert a frame holding only the title of each section, right after the section command,
+        unless the section already starts with such a frame.
+        """
+        def insert(m):
+            title = m.group(1)
+            following = latex_content[m.end():].lstrip()
+            if re.match(r'\\begin\{frame\}\{' + re.escape(title) + r'\}\s*\\end\{frame\}', following):
+                return m.group()
+            return m.group() + f'\n\\begin{{frame}}{{{title}}}\n\\end{{frame}}'
+        return re.sub(r'^[ \t]*\\section\*?(?:\[[^\]]*\])?\{((?:[^{}]|\{[^{}]*\})*)\}[^\n]*', insert, latex_content, flags=re.MULTILINE)
+
+    @staticmethod
+    def parse_frame_patches(response):
+        """
+        Frame patches from a model response, as a dictionary mapping frame numbers to their new LaTeX.
+        Each patch is written as "%%% FRAME <number>", the LaTeX replacing that frame (possibly several
+        frames, to insert pages) and "%%% END". A response with no change is "%%% NO CHANGES".
+
+        :raises ValueError: If the response holds neither patches nor the no change line.
+        """
+        patches = {int(number): latex.strip() for number, latex in TexUtil.FRAME_PATCH.findall(response)}
+        if not patches and TexUtil.NO_CHANGES not in response:
+            raise ValueError('The response holds no frame patch.')
+        return patches
+
+    @staticmethod
+    def apply_frame_patches(latex_content, patches):
+        """
+        Replace the frames of the slides by their patches. Patch 0 replaces the part before the first frame.
+        Text between the frames, e.g. section commands, is kept.
+
+        :raises ValueError: If a patch refers to a frame the slides do not have.
+        """
+        spans = TexUtil.frame_spans(latex_content)
+        unknown = [number for number in patches if not 0 <= number <= len(spans)]
+        if unknown:
+            raise ValueError(f'Patches for frames {unknown}, the slides have {len(spans)} frames.')
+        first = spans[0][0] if spans else len(latex_content)
+        parts = [patches[0] + '\n' if 0 in patches else latex_content[:first]]
+        position = first
+        for number, (start, end) in enumerate(spans, start=1):
+            parts += [latex_content[position:start], patches.get(number, latex_content[start:end])]
+            position = end
+        parts.append(latex_content[position:])
+        return ''.join(parts)
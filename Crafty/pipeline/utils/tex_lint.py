@@ -0,0 +1,330 @@
+import re
+
+from Crafty.pipeline.utils.tex import TexUtil
+
+
+class TexLintUtil:
+    """
+    Local checks and deterministic repairs of generated beamer slides, so that only the frames which
+    cannot be repaired locally are sent back to a model.
+
+    Frames are numbered from 1 as in TexUtil.number_frames, frame 0 being the part before the first frame.
+    """
+
+    # Environments in which & separates cells or alignment points.
+    ALIGNMENT_ENVIRONMENTS = ('tabular', 'tabularx', 'longtable', 'array', 'align', 'aligned', 'alignat',
+                              'eqnarray', 'split', 'cases', 'matrix', 'pmatrix', 'bmatrix', 'vmatrix', 'Vmatrix')
+    MATH_ENVIRONMENTS = ('equation', 'align', 'alignat', 'gather', 'multline', 'eqnarray', 'math', 'displaymath')
+    # Commands whose arguments are names, paths or links rather than text.
+    RAW_ARGUMENT_COMMANDS = ('url', 'href', 'label', 'ref', 'eqref', 'hyperlink', 'hypertarget', 'includegraphics',
+                             'input', 'include', 'cite', 'usepackage', 'usetheme', 'usecolortheme', 'begin', 'end')
+    # Code kept as typed: verbatim-like environments and inline \\verb or \\lstinline.
+    VERBATIM = re.compile(r'\\begin\{(verbatim|Verbatim|lstlisting|minted)(\*?)\}.*?\\end\{\1\2\}'
+                          r'|\\(?:verb|lstinline)\*?([^\sa-zA-Z*\[{]).*?\3', re.DOTALL)
+    # Options of an environment or a command, e.g. [label=intro_topic] or [width=0.5\textwidth].
+    OPTIONS = re.compile(r'(?:\\begin\{[^}]*\}|\\[a-zA-Z@]+\*?)(\[[^\]\n]*\])')
+    SPECIAL = re.compile(r'\\(?:begin|end)\{([^}]*)\}|\\[a-zA-Z@]+\*?|\\.|\$\$?|[&_#%{}]')
+
+    @staticmethod
+    def repair(latex_content):
+        """
+        Apply the deterministic repairs to the slides.
+
+        :return: The repaired slides and the list of repairs made.
+        """
+        fixes = []
+        text = TexLintUtil._repair_document(latex_content, fixes)
+        text = TexLintUtil._repair_frames(text, fixes)
+        spans = TexUtil.frame_spans(text)
+        parts, position = [], 0
+        for number, (start, end) in enumerate(spans, start=1):
+            frame = TexLintUtil._repair_environments(text[start:end], number, fixes)
+            frame = TexLintUtil._repair_braces(frame, number, fixes)
+            frame = TexLintUtil._escape_specials(frame, number, fixes)
+            parts += [text[position:start], frame]
+            position = end
+        parts.append(text[position:])
+        return ''.join(parts), fixes
+
+    @staticmethod
+    def lint(latex_content):
+        """
+        Problems of the slides which the deterministic repairs cannot fix.
+
+        :return: List of (frame number, message) pairs.
+        """
+        issues = []
+        if '\\documentclass' not in latex_content:
+            issues.append((0, 'no \\documentclass'))
+        if '\\begin{document}' not in latex_content or '\\end{document}' not in latex_content:
+            issues.append((0, 'missing document environment'))
+        spans = TexUtil.frame_spans(latex_content)
+        if not spans:
+            issues.append((0, 'no frames'))
+        for number, (start, end) in enumerate(spans, start=1):
+            frame = latex_content[start:end]
+            if TexLintUtil._count_dollars(frame) % 2:
+                issues.append((number, 'unbalanced $ math delimiters'))
+            if frame.count('\\begin{frame}') != 1:
+                issues.append((number, 'frame nested in a frame'))
+            opened = TexLintUtil._unbalanced_environments(frame)
+            if opened:
+                issues.append((number, f'unbalanced environments {opened}'))
+        return issues
+
+    @staticmethod
+    def log_errors(log_text, latex_content):
+        """
+        Errors of a xelatex log, mapped to the frames of the compiled slides by their line numbers.
+        Errors without a line number are mapped to frame 0.
+
+        :return: List of (frame number, message) pairs.
+        """
+        line_starts = [0] + [m.end() for m in re.finditer('\n', latex_content)]
+        spans = TexUtil.frame_spans(latex_content)
+
+        def frame_of(line):
+            offset = line_starts[min(line, len(line_starts)) - 1]
+            for number, (start, end) in enumerate(spans, start=1):
+                if offset < end:
+                    return number if offset >= start else max(0, number - 1)
+            return len(spans)
+
+        errors = []
+        lines = log_text.splitlines()
+        for index, line in enumerate(lines):
+            if not line.startswith('! '):
+                continue
+            message = line[2:].strip()
+            number = re.search(r'on input line (\d+)', line)
+            if number is None:
+                following = '\n'.join(lines[index + 1:index + 20])
+                number = re.search(r'^l\.(\d+)', following, re.MULTILINE)
+            errors.append((frame_of(int(number.group(1))) if number else 0, message))
+        return errors
+
+    @staticmethod
+    def _repair_document(text, fixes):
+        if re.search(r'^\s*```', text, re.MULTILINE):
+            text = re.sub(r'^\s*```[a-zA-Z]*[ \t]*\n?', '', text, flags=re.MULTILINE)
+            fixes.append((0, 'removed code fences'))
+        start = text.find('\\documentclass')
+        if start > 0 and text[:start].strip():
+            text = text[start:]
+            fixes.append((0, 'removed text before \\documentclass'))
+        spans = TexUtil.frame_spans(text)
+        if '\\begin{document}' not in text and spans:
+            text = text[:spans[0][0]] + '\\begin{document}\n' + text[spans[0][0]:]
+            fixes.append((0, 'added \\begin{document}'))
+        if '\\end{document}' not in text:
+            text = text.rstrip() + '\n\n\\end{document}\n'
+            fixes.append((0, 'added \\end{document}'))
+        else:
+            end = text.rindex('\\end{document}') + len('\\end{document}')
+            if text[end:].strip():
+                fixes.append((0, 'removed text after \\end{document}'))
+            text = text[:end] + '\n'
+        return text
+
+    @staticmethod
+    def _repair_frames(text, fixes):
+        """
+        Close every frame before the next one starts, and drop the frame ends which close nothing.
+        """
+        parts, position, open_frame = [], 0, False
+        for m in re.finditer(r'\\begin\{frame\}|\\end\{frame\}|\\end\{document\}', text):
+            parts.append(text[position:m.start()])
+            position = m.end()
+            if m.group() == '\\begin{frame}':
+                if open_frame:
+                    parts.append('\\end{frame}\n\n')
+                    fixes.append((0, 'closed a frame left open'))
+                open_frame = True
+                parts.append(m.group())
+            elif m.group() == '\\end{frame}':
+                if open_frame:
+                    parts.append(m.group())
+                else:
+                    fixes.append((0, 'removed a \\end{frame} closing nothing'))
+                open_frame = False
+            else:
+                if open_frame:
+                    parts.append('\\end{frame}\n\n')
+                    fixes.append((0, 'closed a frame left open'))
+                open_frame = False
+                parts.append(m.group())
+        parts.append(text[position:])
+        return ''.join(parts)
+
+    @staticmethod
+    def _environment_events(frame):
+        inner = frame[len('\\begin{frame}'):-len('\\end{frame}')]
+        return len('\\begin{frame}'), list(re.finditer(r'\\(begin|end)\{([^}]*)\}', inner))
+
+    @staticmethod
+    def _unbalanced_environments(frame):
+        _, events = TexLintUtil._environment_events(frame)
+        stack = []
+        for m in events:
+            if m.group(1) == 'begin':
+                stack.append(m.group(2))
+            elif stack and stack[-1] == m.group(2):
+                stack.pop()
+            else:
+                return stack + ['/' + m.group(2)]
+        return stack
+
+    @staticmethod
+    def _repair_environments(frame, number, fixes):
+        """
+        Close the environments of a frame left open, and drop the ends of environments which were not opened.
+        """
+        offset, events = TexLintUtil._environment_events(frame)
+        parts, position, stack = [frame[:offset]], offset, []
+        for m in events:
+            parts.append(frame[position:offset + m.start()])
+            position = offset + m.end()
+            name = m.group(2)
+            if m.group(1) == 'begin':
+                stack.append(name)
+                parts.append(m.group())
+            elif name in stack:
+                while stack[-1] != name:
+                    parts.append(f'\\end{{{stack.pop()}}}\n')
+                    fixes.append((number, 'closed an environment left open'))
+                stack.pop()
+                parts.append(m.group())
+            else:
+                fixes.append((number, f'removed \\end{{{name}}} closing nothing'))
+        body_end = len(frame) - len('\\end{frame}')
+        parts.append(frame[position:body_end].rstrip() + '\n')
+        while stack:
+            parts.append(f'\\end{{{stack.pop()}}}\n')
+            fixes.append((number, 'closed an environment left open'))
+        parts.append('\\end{frame}')
+        return ''.join(parts)
+
+    @staticmethod
+    def _repair_braces(frame, number, fixes):
+        """
+        Drop the closing braces which close nothing, and close the braces left open at the end of their line.
+        """
+        chars, opened = list(frame), []
+        verbatim = {start: end for start, end in TexLintUtil._raw_spans(frame, options=False)}
+        index = 0
+        while index < len(frame):
+            char = frame[index]
+            if index in verbatim:
+                index = verbatim[index]
+                continue
+            if char == '\\':
+                index += 2
+                continue
+            if char == '%' and not (index > 0 and frame[index - 1].isdigit()):
+                newline = frame.find('\n', index)
+                index = len(frame) if newline < 0 else newline
+                continue
+            if char == '{':
+                opened.append(index)
+            elif char == '}':
+                if opened:
+                    opened.pop()
+                else:
+                    chars[index] = ''
+                    fixes.append((number, 'removed a closing brace closing nothing'))
+            index += 1
+        for start in reversed(opened):
+            newline = frame.find('\n', start)
+            position = min(len(frame) if newline < 0 else newline, len(frame) - len('\\end{frame}'))
+            chars[position - 1] += '}'
+            fixes.append((number, 'closed a brace left open'))
+        return ''.join(chars)
+
+    @staticmethod
+    def _count_dollars(frame):
+        # Percent signs following a number are text, not comments.
+        text = TexLintUtil.VERBATIM.sub('', frame)
+        return len(re.findall(r'(?<!\\)\$', re.sub(r'(?<![\\\d])%.*', '', text)))
+
+    @staticmethod
+    def _raw_spans(frame, options=True):
+        """
+        (start, end) of the parts of a frame which are not text: code, and optionally the options of
+        environments and commands, in order.
+        """
+        spans = [m.span() for m in TexLintUtil.VERBATIM.finditer(frame)]
+        if options:
+            spans += [m.span(1) for m in TexLintUtil.OPTIONS.finditer(frame)
+                      if not any(start <= m.start() < end for start, end in spans)]
+        return sorted(spans)
+
+    @staticmethod
+    def _escape_specials(frame, number, fixes):
+        """
+        Escape & _ # and percent signs following a number where they are text: outside math, outside the
+        alignment environments, outside code (verbatim, lstlisting, minted, \\verb) and outside the options
+        and raw arguments of commands such as \\url or \\label.
+        Dollars before digits are escaped as currency when the dollars of the frame do not pair up.
+        """
+        if TexLintUtil._count_dollars(frame) % 2:
+            verbatim = TexLintUtil._raw_spans(frame, options=False)
+            currency = re.sub(r'(?<!\\)\$(?=\d)',
+                              lambda m: m.group() if any(start <= m.start() < end for start, end in verbatim) else '\\$', frame)
+            if TexLintUtil._count_dollars(currency) % 2 == 0 and currency != frame:
+                frame = currency
+                fixes.append((number, 'escaped $ used as currency'))
+        parts, position = [], 0
+        math, environments, raw_depth, depth = False, [], None, 0
+        raw = TexLintUtil._raw_spans(frame)
+        for m in TexLintUtil.SPECIAL.finditer(frame):
+            if m.start() < position:
+                # Within a comment.
+                continue
+            if any(start <= m.start() < end for start, end in raw):
+                # Code and options are copied as they are.
+                continue
+            token = m.group()
+            replacement = token
+            if token.startswith('\\begin{') or token.startswith('\\end{'):
+                name = m.group(1).rstrip('*')
+                if token.startswith('\\begin{'):
+                    environments.append(name)
+                elif name in environments:
+                    environments.remove(name)
+            elif token.startswith('\\'):
+                if token in ('\\(', '\\['):
+                    math = True
+                elif token in ('\\)', '\\]'):
+                    math = False
+                elif token[1:].rstrip('*') in TexLintUtil.RAW_ARGUMENT_COMMANDS and raw_depth is None:
+                    raw_depth = depth
+            elif token in ('$', '$$'):
+                math = not math
+            elif token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if raw_depth is not None and depth <= raw_depth:
+                    raw_depth = None
+            elif raw_depth is None or depth <= raw_depth:
+                in_math = math or any(e in TexLintUtil.MATH_ENVIRONMENTS for e in environments)
+                aligned = any(e in TexLintUtil.ALIGNMENT_ENVIRONMENTS for e in environments)
+                if token == '%':
+                    if m.start() > 0 and frame[m.start() - 1].isdigit():
+                        replacement = '\\%'
+                    else:
+                        # A comment runs to the end of its line.
+                        newline = frame.find('\n', m.start())
+                        parts.append(frame[position:len(frame) if newline < 0 else newline])
+                        position = len(frame) if newline < 0 else newline
+                        continue
+                elif token == '&' and not aligned:
+                    replacement = '\\&'
+                elif token in ('_', '#') and not in_math:
+                    replacement = '\\' + token
+            if replacement != token:
+                fixes.append((number, f'escaped {token}'))
+            parts += [frame[position:m.start()], replacement]
+            position = m.end()
+        parts.append(frame[position:])
+        return ''.join(parts)
@@ -0,0 +1,194 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from Crafty.config import Config
+
+
+class Span:
+    """
+    One timed operation: a step, a chapter or a model call. The course, step and chapter are inherited
+    from the parent span, so a model call can be attributed to the step it ran in.
+    """
+
+    INHERITED = ('course_id', 'step', 'chapter')
+
+    def __init__(self, name, trace_id, parent=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = {key: parent.attributes[key] for key in self.INHERITED
+                           if parent is not None and key in parent.attributes}
+        self.attributes.update({key: value for key, value in (attributes or {}).items() if value is not None})
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def add(self, key, value):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_otlp(self):
+        """
+        The span in the OTLP/JSON span layout, so the trace files can be loaded by OpenTelemetry tooling.
+        """
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': key, 'value': self._otlp_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 'STATUS_CODE_ERROR', 'message': self.error} if self.error else {'code': 'STATUS_CODE_OK'},
+        }
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+    @staticmethod
+    def _otlp_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+
+class Tracer:
+    """
+    Process wide recorder of spans. Finished spans are appended as JSON lines to the trace file of
+    their course and added to the totals per step printed at the end of a run. The spans themselves are
+    not kept, so a long-running worker does not grow with every job.
+    """
+
+    _instance = None
+    _current = contextvars.ContextVar('crafty_current_span', default=None)
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def current_span(cls):
+        return cls._current.get()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Time the enclosed block as a child of the current span. Spans follow asyncio tasks and
+        threads started inside the block, as those copy the context they are created in.
+        """
+        span = Span(name, self.trace_id, self.current_span(), attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            self._current.reset(token)
+            self.finish(span)
+
+    def start(self, name, parent=None, **attributes):
+        """
+        Start a span which is finished elsewhere, e.g. by a callback, without making it the current span.
+        """
+        return Span(name, self.trace_id, parent if parent is not None else self.current_span(), attributes)
+
+    def finish(self, span, error=None):
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = repr(error)
+        path = Config.OUTPUT_DIR + span.attributes['course_id'] + '/' + Config.TRACE_FILE \
+            if 'course_id' in span.attributes else Config.OUTPUT_DIR + Config.TRACE_FILE
+        with self._lock:
+            self._aggregate(span)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(span.to_otlp(), ensure_ascii=False) + '\n')
+
+    def add(self, key, value=1):
+        """
+        Add to a counter attribute of the current span, e.g. retries.
+        """
+        span = self.current_span()
+        if span is not None:
+            span.add(key, value)
+
+    def _aggregate(self, span):
+        if 'step' not in span.attributes:
+            return
+        row = self.rows.setdefault(span.attributes['step'], {
+            'runs': 0, 'skipped': 0, 'wall_s': 0.0, 'calls': 0, 'prompt_tokens': 0,
+            'completion_tokens': 0, 'cached_tokens': 0, 'cost_usd': 0.0, 'retries': 0,
+            'local_repairs': 0, 'llm_repairs': 0, 'hedges': 0, 'timeouts': 0,
+            'coalesced': 0, 'avoided_overflows': 0, 'errors': 0})
+        if span.name == 'step':
+            row['runs'] += 1
+            row['skipped'] += int(span.attributes.get('skipped', False))
+            row['wall_s'] += span.duration
+        else:
+            row['calls'] += int(span.name in ('llm', 'tts'))
+            for key in ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost_usd'):
+                row[key] += span.attributes.get(key, 0)
+        for key in ('retries', 'local_repairs', 'llm_repairs', 'hedges', 'timeouts', 'coalesced', 'avoided_overflows'):
+            row[key] += span.attributes.get(key, 0)
+        row['errors'] += int(span.error is not None)
+
+    def summary(self):
+        """
+        Totals per step: runs, wall time and the model calls made while running it.
+        """
+        with self._lock:
+            rows = {step: dict(row) for step, row in self.rows.items()}
+        for row in rows.values():
+            # Share of the prompt tokens served from the provider prompt prefix cache.
+            row['cache_hit_rate'] = row['cached_tokens'] / row['prompt_tokens'] if row['prompt_tokens'] else 0.0
+        return rows
+
+    def summary_table(self):
+        rows = self.summary()
+        header = f"{'step':<10}{'runs':>6}{'skip':>6}{'wall s':>10}{'calls':>7}{'prompt':>10}{'compl.':>9}" \
+                 f"{'cached':>9}{'hit %':>7}{'cost $':>9}{'retry':>7}{'fix':>9}{'hedge':>7}{'tmout':>7}{'coal.':>7}{'ovfl':>6}{'err':>5}"
+        lines = [header, '-' * len(header)]
+        for step, row in rows.items():
+            lines.append(f"{step:<10}{row['runs']:>6}{row['skipped']:>6}{row['wall_s']:>10.1f}{row['calls']:>7}"
+                         f"{row['prompt_tokens']:>10}{row['completion_tokens']:>9}{row['cached_tokens']:>9}"
+                         f"{row['cache_hit_rate'] * 100:>7.1f}{row['cost_usd']:>9.3f}{row['retries']:>7}"
+                         f"{str(row['local_repairs']) + '/' + str(row['llm_repairs']):>9}{row['hedges']:>7}{row['timeouts']:>7}{row['coalesced']:>7}{row['avoided_overflows']:>6}"
+                         f"{row['errors']:>5}")
+        total_cost = sum(row['cost_usd'] for row in rows.values())
+        total_wall = sum(row['wall_s'] for row in rows.values())
+        lines.append('-' * len(header))
+        lines.append(f"{'total':<10}{'':>12}{total_wall:>10.1f}{'':>42}{total_cost:>9.3f}")
+        return '\n'.join(lines)
+
+
+def llm_cost(model_name, prompt_tokens, completion_tokens, cached_tokens=0):
+    """
+    Estimated cost in USD of a model call, from the prices per million tokens in Config.MODEL_PRICES.
+    Models are matched by the longest known prefix, e.g. gpt-4o-2024-05-13 by gpt-4o.
+    """
+    matches = [name for name in Config.MODEL_PRICES if model_name and model_name.startswith(name)]
+    if not matches:
+        return 0.0
+    prompt_price, cached_price, completion_price = Config.MODEL_PRICES[max(matches, key=len)]
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1e6
@@ -46,15 +46,15 @@ class XmlUtil:
     def nest_dict_to_xml(data):
         """
         Helper function dict_to_xml
-        Convert a list of dictionaries to an XML tree.
+        Convert a list of dictionaries to XML trees, one root per dictionary.
         Handles nested dictionaries and lists.
         """
-        final_strings = []
         final_roots = []
 
-        root = ET.Element('root')
         for item in data:
             if isinstance(item, dict):
+                # Every item gets its own root, so each one only holds its own elements.
+                root = ET.Element('root')
                 for key, val in item.items():
                     if isinstance(val, dict):
                         elem = XmlUtil.simple_dict_to_xml(key, val)
@@ -68,7 +68,6 @@ class XmlUtil:
                         elem = ET.Element(key)
                         elem.text = str(val).strip()
                     root.append(elem)
-                final_strings.append(ET.tostring(root, encoding='unicode'))
                 final_roots.append(root)
 
         return final_roots
@@ -107,3 +106,17 @@ class XmlUtil:
         elem = ET.Element(tag)
         XmlUtil.build_element(elem, d)
         return elem
+
+    @staticmethod
+    def split_notes(notes_xml, sections):
+        """
+        Split the notes XML of a chapter into the notes of each section, in order.
+        Notes store one element per section, named after it or 'root', so the section names come from
+        the section list when its length matches.
+
+        :return: List of (section name, notes XML of the section) pairs.
+        """
+        elements = list(ET.fromstring(notes_xml.encode('utf-8')))
+        if len(elements) != len(sections):
+            sections = [element.tag.replace('_', ' ') for element in elements]
+        return [(section, ET.tostring(element, encoding='unicode')) for section, element in zip(sections, elements)]
@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import json
 import multiprocessing
 import os
@@ -10,6 +12,7 @@ from moviepy.video.compositing.concatenate import concatenate_videoclips
 from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.manifest import Manifest
 
 
 class Video(PipelineStep):
@@ -28,21 +31,81 @@ class Video(PipelineStep):
             self.chapter = para['chapter']
             self.read_meta_data_from_file()
 
-    def execute(self):
+    async def execute_async(self):
         if self.chapter is None or self.chapter < 0:
             raise ValueError("Chapter number is not provided or invalid.")
 
-        self.pdf2image(notes_set_number=self.chapter)
-        self.mp3_to_mp4_and_combine(notes_set_number=self.chapter)
+        # Rendering and encoding are CPU bound and blocking, so they run in a thread instead of on the loop.
+        await asyncio.to_thread(self.pdf2image, notes_set_number=self.chapter)
+        await asyncio.to_thread(self.mp3_to_mp4_and_combine, notes_set_number=self.chapter)
+
+    def artifact_inputs(self):
+        return super().artifact_inputs() + [self.videos_dir + f"full_slides_for_notes_set{self.chapter}.pdf"] \
+            + [os.path.join(self.videos_dir, f) for f in self.audio_files(self.chapter)]
+
+    def artifact_outputs(self):
+        return [os.path.join(self.final_dir, f"combined_video_chapter_{self.chapter}.mp4")]
+
+    def artifact_fingerprints(self):
+        pdf_file_path = self.videos_dir + f"full_slides_for_notes_set{self.chapter}.pdf"
+        if not os.path.exists(pdf_file_path):
+            return {}
+        with fitz.open(pdf_file_path) as doc:
+            images = self.page_fingerprints(doc)
+        return {'images': images, 'segments': self.segment_fingerprints(images, self.chapter)}
+
+    def audio_files(self, notes_set_number):
+        """
+        Voice files of the chapter, sorted by the index of their slide.
+        """
+        if not os.path.isdir(self.videos_dir):
+            return []
+        chapter_str = f"_chapter_{notes_set_number}.mp3"
+        return sorted([f for f in os.listdir(self.videos_dir) if f.startswith('voice_') and f.endswith(chapter_str)],
+                      key=lambda x: int(x.split('_')[1]))
+
+    @staticmethod
+    def page_fingerprints(doc):
+        """
+        Fingerprint of each PDF page from its content stream and images, without rendering it.
+        """
+        fingerprints = []
+        for page in doc:
+            sha256_hash = hashlib.sha256(page.read_contents())
+            for image in page.get_images(full=True):
+                sha256_hash.update(doc.xref_stream_raw(image[0]) or b'')
+            fingerprints.append(sha256_hash.hexdigest())
+        return fingerprints
+
+    def segment_fingerprints(self, images, notes_set_number):
+        """
+        Fingerprint of each video segment: the image of its slide and its voice.
+        """
+        audio_files = self.audio_files(notes_set_number)
+        count = int(audio_files[-1].split('_')[1]) + 1 if audio_files else 0
+        segments = []
+        for i in range(count):
+            image = images[i] if i < len(images) else None
+            voice = Manifest.file_hash(self.videos_dir + f"voice_{i}_chapter_{notes_set_number}.mp3")
+            segments.append(Manifest.value_hash([image, voice]))
+        return segments
 
     def pdf2image(self, notes_set_number=-1):
         """
         Convert the full slides PDF file into images for each page.
+
+        :return: The fingerprints of the pages.
         """
         pdf_file_path = self.videos_dir + f"full_slides_for_notes_set{notes_set_number}.pdf"
         doc = fitz.open(pdf_file_path)
 
-        for page_number in range(len(doc)):
+        # Only the pages which changed since the last build are rendered again.
+        images = self.page_fingerprints(doc)
+        missing = Manifest.reuse_files(self.previous_fingerprints('images'), images,
+                                       lambda i: self.videos_dir + f"image_{i}_chapter_{notes_set_number}.png")
+        click.echo(f"Rendering {len(missing)} of {len(doc)} slide images...")
+
+        for page_number in missing:
             page = doc.load_page(page_number)
 
             # Increase the dpi by adjusting the zoom factor. Default is 1.0 (72 dpi).
@@ -53,65 +116,99 @@ class Video(PipelineStep):
             pix = page.get_pixmap(matrix=mat)  # Use the matrix in get_pixmap
             image_path = self.videos_dir + f"image_{page_number}_chapter_{notes_set_number}.png"
             pix.save(image_path)
+        return images
 
     def mp3_to_mp4_and_combine(self, notes_set_number):
         """
         Converts MP3 files into MP4 files using corresponding images as static backgrounds,
         sets a default frame rate (fps) for the video, and combines all MP4 files into one,
-        skipping already existing MP4 files and the final combination if it exists, for a specific chapter number.
+        reusing the MP4 files whose image and voice did not change, for a specific chapter number.
 
         :param output_dir: Directory where the MP3 files, PNG files, MP4 files, and the final combined MP4 file are located.
         :param notes_set_number: Specific chapter number to match voice and image files.
         """
 
-        # Define the name of the final combined video file
-        final_output_filename = f"combined_video_chapter_{notes_set_number}.mp4"
-        final_output_path = os.path.join(self.final_dir, final_output_filename)
-
-        # Check if the combined MP4 file already exists
-        if os.path.exists(final_output_path):
-            click.echo(f"Combined video {final_output_path} already exists, skipping combination.")
-            return  # Exit the function if combined video already exists
+        # An existing combined video is not reused here: the build manifest decides whether
+        # the step has to run, so reaching this point means the voices or slides changed.
 
         # List all MP3 files and sort them by the index i for the specific chapter
-        chapter_str = f"_chapter_{notes_set_number}"
-        audio_files = sorted([f for f in os.listdir(self.videos_dir) if f.endswith('.mp3') and chapter_str in f],
-                             key=lambda x: int(x.split('_')[1]))
+        audio_files = self.audio_files(notes_set_number)
+
+        # Segments are reused by the fingerprint of their image and voice, stale ones are deleted
+        with fitz.open(self.videos_dir + f"full_slides_for_notes_set{notes_set_number}.pdf") as doc:
+            segments = self.segment_fingerprints(self.page_fingerprints(doc), notes_set_number)
+        missing = set(Manifest.reuse_files(self.previous_fingerprints('segments'), segments,
+                                           lambda i: os.path.join(self.videos_dir, f"voice_{i}_chapter_{notes_set_number}.mp4")))
 
         # List to hold all the individual video clips
-        video_clips = []
+        segment_paths = []
 
         for audio_file in audio_files:
             base_name = os.path.splitext(audio_file)[0]
             output_mp4_path = os.path.join(self.videos_dir, f"{base_name}.mp4")
 
-            # Check if MP4 file already exists to avoid re-generating it
-            if not os.path.exists(output_mp4_path):
-                image_file = f"{base_name.replace('voice_', 'image_')}.png"
-                audio_path = os.path.join(self.videos_dir, audio_file)
-                image_path = os.path.join(self.videos_dir, image_file)
+            index = int(base_name.split('_')[1])
+            if index in missing:
+                if not self.write_segment(index, notes_set_number):
+                    continue  # Skip to the next file if either file is missing
+            else:
+                click.echo(f"MP4 file {output_mp4_path} is up to date, skipping generation.")
+            segment_paths.append(output_mp4_path)
 
-                if os.path.exists(image_path) and os.path.exists(audio_path):
-                    # Load the audio file
-                    audio_clip = AudioFileClip(audio_path)
+        self.combine_segments(segment_paths, notes_set_number)
 
-                    # Create an image clip with the same duration as the audio file
-                    image_clip = ImageClip(image_path).set_duration(audio_clip.duration)
+    def write_segment(self, index, notes_set_number):
+        """
+        Encode the video segment of a slide from its image and its voice.
 
-                    # Set the audio of the image clip as the audio file
-                    video_clip = image_clip.set_audio(audio_clip)
+        :return: False if the image or the voice is missing.
+        """
+        base_name = f"voice_{index}_chapter_{notes_set_number}"
+        output_mp4_path = os.path.join(self.videos_dir, f"{base_name}.mp4")
+        audio_path = os.path.join(self.videos_dir, f"{base_name}.mp3")
+        image_path = os.path.join(self.videos_dir, f"image_{index}_chapter_{notes_set_number}.png")
 
-                    # Write the individual video clip to a file (MP4)
-                    video_clip.write_videofile(output_mp4_path, codec="libx264", audio_codec="aac", fps=12)
-                    click.echo(f"Generated {output_mp4_path}")
-                else:
-                    click.echo(f"Missing files for {base_name}, cannot generate MP4.")
-                    continue  # Skip to the next file if either file is missing
-            else:
-                click.echo(f"MP4 file {output_mp4_path} already exists, skipping generation.")
+        if not (os.path.exists(image_path) and os.path.exists(audio_path)):
+            click.echo(f"Missing files for {base_name}, cannot generate MP4.")
+            return False
+        # Load the audio file
+        audio_clip = AudioFileClip(audio_path)
+
+        # Create an image clip with the same duration as the audio file
+        image_clip = ImageClip(image_path).set_duration(audio_clip.duration)
 
-            # Load the existing or newly created MP4 file for final combination
-            video_clips.append(VideoFileClip(output_mp4_path))
+        # Set the audio of the image clip as the audio file
+        video_clip = image_clip.set_audio(audio_clip)
+
+        # Write the individual video clip to a file (MP4)
+        video_clip.write_videofile(output_mp4_path, codec="libx264", audio_codec="aac", fps=12)
+        click.echo(f"Generated {output_mp4_path}")
+        return True
+
+    def encode_segment(self, index, notes_set_number, images):
+        """
+        Video segment of a slide whose voice just arrived, reused if its image and voice did not change
+        since the last build.
+
+        :param images: Fingerprints of the pages, as returned by pdf2image.
+        :return: The path of the segment, or None if its image or voice is missing.
+        """
+        output_mp4_path = os.path.join(self.videos_dir, f"voice_{index}_chapter_{notes_set_number}.mp4")
+        voice = Manifest.file_hash(self.videos_dir + f"voice_{index}_chapter_{notes_set_number}.mp3")
+        segment = Manifest.value_hash([images[index] if index < len(images) else None, voice])
+        previous = self.previous_fingerprints('segments')
+        if index < len(previous) and previous[index] == segment and os.path.exists(output_mp4_path):
+            click.echo(f"MP4 file {output_mp4_path} is up to date, skipping generation.")
+            return output_mp4_path
+        return output_mp4_path if self.write_segment(index, notes_set_number) else None
+
+    def combine_segments(self, segment_paths, notes_set_number):
+        """
+        Concatenate the video segments of a chapter, in order, into its final video.
+        """
+        final_output_path = os.path.join(self.final_dir, f"combined_video_chapter_{notes_set_number}.mp4")
+        # Load the existing or newly created MP4 files for final combination
+        video_clips = [VideoFileClip(path) for path in segment_paths]
 
         # Combine all the video clips into one video file
         click.echo("Video clips generation done, start to combine.")
@@ -1,9 +1,13 @@
 import json
 import os
+import time
 import click
 from openai import OpenAI
 from pydub import AudioSegment
+from Crafty.config import Config
 from Crafty.pipeline.pipeline_step import PipelineStep
+from Crafty.pipeline.utils.manifest import Manifest
+from Crafty.pipeline.utils.trace import Tracer
 import asyncio
 # rate limiting pkg
 from openlimit import EmbeddingRateLimiter
@@ -25,12 +29,33 @@ class Voice(PipelineStep):
             self.chapter = para['chapter']
             self.read_meta_data_from_file()
 
-    def execute(self):
+    async def execute_async(self):
         if self.chapter is None or self.chapter < 0:
             raise ValueError("Chapter number is not provided or invalid.")
 
-        # Call the async function in a blocking manner
-        asyncio.run(self.scripts2voice(notes_set_number=self.chapter))
+        await self.scripts2voice(notes_set_number=self.chapter)
+
+    def artifact_inputs(self):
+        return super().artifact_inputs() + [f"{self.videos_dir}scripts_for_notes_set{self.chapter}.json"]
+
+    def artifact_outputs(self):
+        scripts_file_path = f"{self.videos_dir}scripts_for_notes_set{self.chapter}.json"
+        if not os.path.exists(scripts_file_path):
+            return []
+        with open(scripts_file_path, 'r') as json_file:
+            scripts = json.load(json_file)
+        return [f"{self.videos_dir}voice_{i}_chapter_{self.chapter}.mp3" for i in range(len(scripts))]
+
+    def artifact_fingerprints(self):
+        scripts_file_path = f"{self.videos_dir}scripts_for_notes_set{self.chapter}.json"
+        if not os.path.exists(scripts_file_path):
+            return {}
+        with open(scripts_file_path, 'r') as json_file:
+            scripts = json.load(json_file)
+        return {'voices': self.voice_fingerprints(scripts)}
+
+    def voice_fingerprints(self, scripts, model="tts-1", voice="alloy"):
+        return [Manifest.value_hash([str(script), model, voice]) for script in scripts]
 
     async def scripts2voice(self, speech_file_path=None, input_text=None, model="tts-1", voice="alloy", notes_set_number=-1):
         """
@@ -41,14 +66,38 @@ class Voice(PipelineStep):
         with open(scripts_file_path, 'r') as json_file:
             scripts = json.load(json_file)  # ["scripts"]
 
-        click.echo(f"Generating voice for {len(scripts)} scripts...")
-        for i, script in enumerate(scripts):
-            voice_file_path = speech_file_path if speech_file_path and (
-                        speech_file_path.endswith("/") and os.path.exists(speech_file_path)) else self.videos_dir
-            voice_file_path += f"voice_{i}_chapter_{notes_set_number}.mp3"
-            await self._voice_agent(speech_file_path=voice_file_path, input_text=str(script), model=model, voice=voice)
+        voice_dir = speech_file_path if speech_file_path and (
+                    speech_file_path.endswith("/") and os.path.exists(speech_file_path)) else self.videos_dir
+
+        # Only the scripts which changed since the last build are voiced again.
+        missing = Manifest.reuse_files(self.previous_fingerprints('voices'),
+                                       self.voice_fingerprints(scripts, model=model, voice=voice),
+                                       lambda i: voice_dir + f"voice_{i}_chapter_{notes_set_number}.mp3")
+
+        click.echo(f"Generating voice for {len(missing)} of {len(scripts)} scripts...")
+        for i in missing:
+            voice_file_path = voice_dir + f"voice_{i}_chapter_{notes_set_number}.mp3"
+            await self._voice_agent(speech_file_path=voice_file_path, input_text=str(scripts[i]), model=model, voice=voice)
             click.echo(f"Voice {i} saved to: {voice_file_path}")
 
+    async def stream_voice(self, i, script, notes_set_number, model="tts-1", voice="alloy"):
+        """
+        Voice script i of a chapter whose scripts arrive one by one. The voice of the last build is kept
+        if the script at this index did not change.
+
+        :return: The path of the voice file.
+        """
+        voice_file_path = self.videos_dir + f"voice_{i}_chapter_{notes_set_number}.mp3"
+        previous = self.previous_fingerprints('voices')
+        if i < len(previous) and previous[i] == self.voice_fingerprints([script], model=model, voice=voice)[0] \
+                and os.path.exists(voice_file_path):
+            click.echo(f"Voice {i} is up to date, skipping generation.")
+            return voice_file_path
+        await self._voice_agent(speech_file_path=voice_file_path, input_text=str(script), model=model, voice=voice,
+                                notes_set_number=notes_set_number)
+        click.echo(f"Voice {i} saved to: {voice_file_path}")
+        return voice_file_path
+
     async def _voice_agent(self, speech_file_path=None, input_text=None, model="tts-1", voice="alloy", notes_set_number=-1):
         """
         Generates an audio speech file from the given text using the specified voice and model, with a 1-second silent time after the content.
@@ -64,26 +113,38 @@ class Voice(PipelineStep):
         if speech_file_path is None:
             speech_file_path = self.videos_dir + f"voice_{-1}_chapter_{notes_set_number}.mp3"
 
-        try:
-            async with rate_limiter.limit(model=model, voice=voice, input=input_text):
-                # Generate the speech audio
-                response = OpenAI().audio.speech.create(model=model, voice=voice, input=input_text)
-                # Save the generated speech to a temporary file
-                temp_audio_file = f"temp_speech_{notes_set_number}.mp3"
-                with open(temp_audio_file, "wb") as f:
-                    f.write(response.content)
-
-                # Load the speech audio and create a 1-second silence
-                speech_audio = AudioSegment.from_file(temp_audio_file)
-                one_second_silence = AudioSegment.silent(duration=2000)  # 1,000 milliseconds
-
-                # Combine speech audio with silence
-                final_audio = speech_audio + one_second_silence
-
-                # Save the combined audio
-                final_audio.export(speech_file_path, format="mp3", parameters=["-ar", "16000"])
-
-                # Clean up the temporary file
-                os.remove(temp_audio_file)
-        except Exception as e:
-            print(f"Failed to generate audio: {e}")
+        # Text to speech is billed by character
+        cost = len(input_text) * Config.TTS_PRICES.get(model, 0) / 1e6
+        with Tracer.get().span('tts', model=model, voice=voice, characters=len(input_text), cost_usd=cost) as span:
+            queued = time.perf_counter()
+            try:
+                async with rate_limiter.limit(model=model, voice=voice, input=input_text):
+                    span.attributes['queue_wait_s'] = time.perf_counter() - queued
+                    # The client and the audio encoding block, so they run in a thread instead of on the loop.
+                    await asyncio.to_thread(self._synthesize, speech_file_path, input_text, model, voice, notes_set_number)
+            except Exception as e:
+                span.error = repr(e)
+                span.attributes['cost_usd'] = 0.0
+                print(f"Failed to generate audio: {e}")
+
+    @staticmethod
+    def _synthesize(speech_file_path, input_text, model, voice, notes_set_number):
+        # Generate the speech audio
+        response = OpenAI().audio.speech.create(model=model, voice=voice, input=input_text)
+        # Save the generated speech to a temporary file, one per voice file as several may be generated at once
+        temp_audio_file = f"{speech_file_path}.speech.mp3"
+        with open(temp_audio_file, "wb") as f:
+            f.write(response.content)
+
+        # Load the speech audio and create a 1-second silence
+        speech_audio = AudioSegment.from_file(temp_audio_file)
+        one_second_silence = AudioSegment.silent(duration=2000)  # 1,000 milliseconds
+
+        # Combine speech audio with silence
+        final_audio = speech_audio + one_second_silence
+
+        # Save the combined audio
+        final_audio.export(speech_file_path, format="mp3", parameters=["-ar", "16000"])
+
+        # Clean up the temporary file
+        os.remove(temp_audio_file)
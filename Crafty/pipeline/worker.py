@@ -0,0 +1,105 @@
+import os
+import socket
+import threading
+import time
+
+import click
+
+from Crafty.config import Config
+from Crafty.pipeline.utils.jobs import JobQueue
+from Crafty.pipeline.utils.trace import Tracer
+
+
+class Worker:
+    """
+    Long-running process consuming step jobs from a JobQueue.
+
+    Everything built while running a job stays warm for the next one: imported step modules, model
+    clients (ApiHandler.shared), document indexes (DocHandler.shared), the module level rate limiters and
+    the event loop the steps run on (PipelineStep.runner).
+    """
+
+    def __init__(self, queue_path, run_job, poll_interval=2.0):
+        """
+        :param queue_path: Path of the SQLite queue file.
+        :param run_job: Callable taking (step, para) which executes one job.
+        :param poll_interval: Seconds to wait before polling an empty queue again.
+        """
+        self.queue = JobQueue(queue_path)
+        self.run_job = run_job
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
+        self.latencies = []
+
+    def run(self, max_jobs=None, exit_when_empty=False):
+        click.echo(f'Worker {self.worker_id} consuming jobs from {self.queue.path}')
+        try:
+            while max_jobs is None or len(self.latencies) < max_jobs:
+                job = self.queue.claim(self.worker_id)
+                if job is None:
+                    if exit_when_empty:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                self.process(job)
+        except KeyboardInterrupt:
+            # Jobs interrupted half way are handed back to the queue for another worker.
+            self.queue.requeue(self.worker_id)
+            click.echo(f'Worker {self.worker_id} interrupted.')
+        finally:
+            self.report()
+            self.queue.close()
+
+    def process(self, job):
+        queue_wait = job['started_at'] - job['submitted_at']
+        click.secho(f"Job {job['id']}: step {job['step']} (waited {queue_wait:.1f}s in queue)", fg='green')
+        if job.get('reclaimed_from'):
+            click.echo(f"Job {job['id']} is taken over from {job['reclaimed_from']}, whose lease expired.")
+        start = time.perf_counter()
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=self.renew_lease, args=(job['id'], stop_renewing), daemon=True)
+        renewer.start()
+        error = None
+        try:
+            with Tracer.get().span('job', course_id=job['para'].get('course_id'), job_id=job['id'],
+                                   job_step=job['step'], queue_wait_s=queue_wait, worker=self.worker_id):
+                self.run_job(job['step'], job['para'])
+        except Exception as e:
+            error = e
+        finally:
+            # The lease is no longer renewed once the job ends, before its status changes.
+            stop_renewing.set()
+            renewer.join()
+        latency = time.perf_counter() - start
+        if error is not None:
+            self.queue.fail(job['id'], error)
+            click.echo(f"Job {job['id']} failed after {latency:.1f}s: {error}", err=True)
+        else:
+            self.queue.complete(job['id'])
+            click.echo(f"Job {job['id']} done in {latency:.1f}s")
+        self.latencies.append(latency)
+
+    def renew_lease(self, job_id, stop):
+        """
+        Renew the lease of the running job until stop is set, on a connection of its own since SQLite
+        connections are not shared between threads.
+        """
+        queue = JobQueue(self.queue.path)
+        try:
+            while not stop.wait(Config.JOB_LEASE / 3):
+                if not queue.renew(job_id, self.worker_id):
+                    click.echo(f'Job {job_id} is no longer leased to {self.worker_id}.', err=True)
+                    break
+        finally:
+            queue.close()
+
+    def report(self):
+        if not self.latencies:
+            click.echo('No jobs processed.')
+            return
+        latencies = sorted(self.latencies)
+        click.echo(f'Processed {len(latencies)} jobs: '
+                   f'mean {sum(latencies) / len(latencies):.1f}s, '
+                   f'p50 {latencies[len(latencies) // 2]:.1f}s, '
+                   f'max {latencies[-1]:.1f}s')
+        click.echo(Tracer.get().summary_table())
@@ -0,0 +1,61 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, 'Crafty', 'cli.py')
+
+# Packages which must never be imported just to parse the command line.
+HEAVY_PACKAGES = ['langchain', 'langchain_core', 'langchain_openai', 'langchain_community', 'openai',
+                  'pydub', 'moviepy', 'fitz', 'openlimit', 'pandas', 'chromadb', 'scipy', 'sklearn', 'numpy']
+
+# Budget for the imports of a `--help` invocation, in seconds. Interpreter startup is not included.
+HELP_IMPORT_BUDGET = 0.5
+
+
+def import_times(args):
+    """
+    Run python with `-X importtime` and return a dict of imported module -> cumulative import time in seconds.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def top_level_packages(times):
+    return {module.split('.')[0] for module in times}
+
+
+@unittest.skipUnless(importlib.util.find_spec('click'), 'click is not installed')
+class TestCliImportTime(unittest.TestCase):
+
+    def test_help_does_not_import_heavy_packages(self):
+        for args in ([CLI_PATH, '--help'], [CLI_PATH, 'step', '--help'], [CLI_PATH, 'create', '--help']):
+            imported = top_level_packages(import_times(args))
+            self.assertEqual([], [package for package in HEAVY_PACKAGES if package in imported], args)
+
+    def test_help_import_budget(self):
+        times = import_times([CLI_PATH, '--help'])
+        # Only top level entries are counted, their cumulative time already includes nested imports.
+        total = sum(seconds for module, seconds in times.items() if module in ('click', 'Crafty', 'Crafty.pipeline.steps'))
+        self.assertLess(total, HELP_IMPORT_BUDGET)
+
+    @unittest.skipUnless(importlib.util.find_spec('fitz') and importlib.util.find_spec('moviepy'), 'video dependencies are not installed')
+    def test_video_step_does_not_import_llm_packages(self):
+        imported = top_level_packages(import_times(['-c', 'from Crafty.pipeline.video import Video']))
+        for package in ['langchain', 'langchain_core', 'langchain_openai', 'openai', 'chromadb', 'pandas', 'openlimit']:
+            self.assertNotIn(package, imported)
+
+
+if __name__ == '__main__':
+    unittest.main()